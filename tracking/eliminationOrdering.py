@@ -0,0 +1,166 @@
+"""
+Heuristic elimination orders for variable elimination.
+
+The cost of variable elimination is dominated by the largest factor it
+builds, which depends heavily on the elimination order.  The greedy
+heuristics here work on the interaction graph of the bayes net (an edge
+between every two variables that appear in the same CPT), and
+eliminationOrderCost predicts the factor sizes an order produces.
+"""
+from collections import namedtuple
+from typing import List
+
+HEURISTICS = ('min-degree', 'min-fill', 'weighted-min-fill')
+
+EliminationOrderCost = namedtuple('EliminationOrderCost',
+                                  ['heuristic', 'order', 'largestFactorSize', 'totalTableEntries'])
+
+
+def interactionGraph(bayesNet, evidenceVariables=()):
+    """
+    Returns a dict {variable : set of neighbors} with an edge between
+    every two variables that share a CPT (a variable and its parents,
+    and every two parents of the same variable).
+
+    Evidence variables are left out: once their value is known they no
+    longer connect the variables around them.
+    """
+    evidenceVariables = set(evidenceVariables)
+    adjacency = dict([(variable, set()) for variable in bayesNet.variablesSet() - evidenceVariables])
+    inEdges = bayesNet.inEdges()
+    for variable in bayesNet.variablesSet():
+        scope = [var for var in set(inEdges[variable]) | {variable} if var not in evidenceVariables]
+        for var in scope:
+            adjacency[var].update(scope)
+    for variable, neighbors in adjacency.items():
+        neighbors.discard(variable)
+    return adjacency
+
+
+def _domainSizes(bayesNet, evidenceVariables):
+    " The number of values each variable can take once the evidence is assigned "
+    domainsDict = bayesNet.variableDomainsDict()
+    return dict([(variable, 1 if variable in evidenceVariables else len(domain))
+                 for variable, domain in domainsDict.items()])
+
+
+def _fillEdges(adjacency, variable):
+    " The pairs of neighbors of variable that are not yet connected "
+    neighbors = sorted(adjacency[variable])
+    return [(a, b) for i, a in enumerate(neighbors) for b in neighbors[i + 1:] if b not in adjacency[a]]
+
+
+def greedyEliminationOrder(bayesNet, eliminationVariables, evidenceVariables=(), heuristic='min-fill'):
+    """
+    Returns an order of eliminationVariables built greedily: at every
+    step the variable with the lowest heuristic score is eliminated
+    (ties go to the first variable in sorted order), and its neighbors
+    in the interaction graph are connected to each other.
+
+    heuristic is one of
+    min-degree:        the number of neighbors
+    min-fill:          the number of edges eliminating it would add
+    weighted-min-fill: the sum, over the edges eliminating it would add,
+                       of the product of the domain sizes of their ends
+    """
+    if heuristic not in HEURISTICS:
+        raise ValueError("Unknown elimination order heuristic: " + str(heuristic) + \
+                         ", expected one of " + str(HEURISTICS))
+    evidenceVariables = set(evidenceVariables)
+    adjacency = interactionGraph(bayesNet, evidenceVariables)
+    sizes = _domainSizes(bayesNet, evidenceVariables)
+
+    def score(variable):
+        if heuristic == 'min-degree':
+            return len(adjacency[variable])
+        fillEdges = _fillEdges(adjacency, variable)
+        if heuristic == 'min-fill':
+            return len(fillEdges)
+        return sum([sizes[a] * sizes[b] for (a, b) in fillEdges])
+
+    remaining = sorted(set(eliminationVariables) - evidenceVariables)
+    order = []
+    while remaining:
+        variable = min(remaining, key=score)
+        remaining.remove(variable)
+        order.append(variable)
+        neighbors = adjacency.pop(variable)
+        for neighbor in neighbors:
+            adjacency[neighbor].discard(variable)
+            adjacency[neighbor].update(neighbors - {neighbor})
+    return order
+
+
+def eliminationOrderCost(bayesNet, eliminationOrder: List[str], evidenceVariables=()):
+    """
+    Predicts the cost of running variable elimination with
+    eliminationOrder, without touching any probability tables.
+
+    Returns a tuple (largest factor size, total table entries): the
+    number of entries in the largest factor built by a join, and the
+    number of entries of all factors built by joins (including the final
+    join of the remaining factors) together.
+    """
+    sizes = _domainSizes(bayesNet, set(evidenceVariables))
+    inEdges = bayesNet.inEdges()
+    factors = [(set(inEdges[variable]) | {variable}, {variable}) for variable in bayesNet.variablesSet()]
+
+    def tableSize(scope):
+        size = 1
+        for variable in scope:
+            size *= sizes[variable]
+        return size
+
+    largestFactorSize = 0
+    totalTableEntries = 0
+    for eliminationVariable in eliminationOrder:
+        joined = [factor for factor in factors if eliminationVariable in factor[0]]
+        if not joined:
+            continue
+        factors = [factor for factor in factors if eliminationVariable not in factor[0]]
+        scope = set().union(*[factor[0] for factor in joined])
+        unconditioned = set().union(*[factor[1] for factor in joined])
+        joinedSize = tableSize(scope)
+        largestFactorSize = max(largestFactorSize, joinedSize)
+        totalTableEntries += joinedSize
+        # as in inferenceByVariableElimination, a joined factor with a single
+        # unconditioned variable is discarded instead of eliminated
+        if len(unconditioned) > 1:
+            factors.append((scope - {eliminationVariable}, unconditioned - {eliminationVariable}))
+
+    if factors:
+        finalSize = tableSize(set().union(*[factor[0] for factor in factors]))
+        largestFactorSize = max(largestFactorSize, finalSize)
+        totalTableEntries += finalSize
+    return largestFactorSize, totalTableEntries
+
+
+def compareEliminationOrders(bayesNet, queryVariables: List[str], evidenceVariables, heuristics=HEURISTICS):
+    """
+    Computes an order for the variables that are neither queried nor
+    observed with each heuristic (and the plain sorted order, for
+    comparison), and predicts its cost.
+
+    Returns a list of EliminationOrderCost, cheapest first: ordered by
+    the largest factor size, then by the total table entries.
+    """
+    evidenceVariables = set(evidenceVariables)
+    eliminationVariables = bayesNet.variablesSet() - set(queryVariables) - evidenceVariables
+    candidates = [('sorted', sorted(eliminationVariables))]
+    for heuristic in heuristics:
+        candidates.append((heuristic, greedyEliminationOrder(bayesNet, eliminationVariables, evidenceVariables, heuristic)))
+
+    costs = []
+    for heuristic, order in candidates:
+        largestFactorSize, totalTableEntries = eliminationOrderCost(bayesNet, order, evidenceVariables)
+        costs.append(EliminationOrderCost(heuristic, order, largestFactorSize, totalTableEntries))
+    return sorted(costs, key=lambda cost: (cost.largestFactorSize, cost.totalTableEntries))
+
+
+def chooseEliminationOrder(bayesNet, queryVariables: List[str], evidenceVariables, heuristics=HEURISTICS):
+    """
+    Returns the cheapest elimination order found by
+    compareEliminationOrders for the query
+    P(queryVariables | evidenceVariables).
+    """
+    return compareEliminationOrders(bayesNet, queryVariables, evidenceVariables, heuristics)[0].order
@@ -0,0 +1,281 @@
+"""
+Compiled variable elimination queries.
+
+A VariableEliminationPlan does the bookkeeping of
+inferenceByVariableElimination (which factors mention which variable,
+what every join and eliminate produces) once for a query shape, and
+then answers that query for any evidence values by running a fixed
+list of array contractions.  executeBatch answers it for many evidence
+assignments at once, with an extra batch axis on every table.
+"""
+from typing import Dict, List
+import numpy as np
+from bayesNet import ArrayFactor, normalize
+from eliminationOrdering import chooseEliminationOrder
+
+
+class VariableEliminationPlan:
+    """
+    A reusable schedule for the query
+
+    P(queryVariables | evidenceVariables = values)
+
+    on a bayes net, for a fixed set of evidence variables and a fixed
+    elimination order; only the evidence values change between runs.
+
+    Compiling takes a snapshot of the bayes net's CPTs, so compile a
+    new plan after changing them.  A plan reuses its intermediate
+    buffers between runs, so it must not be executed from several
+    threads at once.
+    """
+
+    def __init__(self, bayesNet, queryVariables: List[str], evidenceVariables, eliminationOrder: List[str] = None):
+        """
+        bayesNet:          The Bayes Net on which queries will be made.
+        queryVariables:    A list of the variables which are unconditioned
+                           in the inference query.
+        evidenceVariables: The names of the variables that will be given
+                           as evidence when the plan is executed.
+        eliminationOrder:  The order to eliminate the variables in, as for
+                           inferenceByVariableElimination.  If None, the
+                           cheapest order found by chooseEliminationOrder
+                           is used.
+        """
+        self.queryVariables = list(queryVariables)
+        self.evidenceVariables = frozenset(evidenceVariables)
+        overlap = self.evidenceVariables & set(self.queryVariables)
+        if overlap:
+            raise ValueError("Query variables can't also be evidence variables: " + str(overlap))
+        if eliminationOrder is None:
+            eliminationOrder = chooseEliminationOrder(bayesNet, self.queryVariables, self.evidenceVariables)
+        self.eliminationOrder = list(eliminationOrder)
+
+        self.variableDomainsDict = bayesNet.variableDomainsDict()
+        self.evidenceIndices = dict([(variable, dict([(value, i) for i, value in enumerate(self.variableDomainsDict[variable])]))
+                                     for variable in self.evidenceVariables])
+
+        # every factor is referred to by its slot number; the CPTs fill the first slots
+        self.tables = []
+        self.evidenceAxes = []
+        slots = []
+        for variable in sorted(bayesNet.variablesSet()):
+            CPT = ArrayFactor.fromFactor(bayesNet.getCPT(variable))
+            self.tables.append(CPT.asArray())
+            self.evidenceAxes.append([(axis, var) for axis, var in enumerate(CPT.variables()) if var in self.evidenceVariables])
+            slots.append((list(CPT.variables()), set(CPT.unconditionedVariables()), set(CPT.conditionedVariables())))
+
+        # replay variable elimination on the variable names only
+        self.steps = []
+        liveSlots = list(range(len(slots)))
+        for eliminationVariable in self.eliminationOrder:
+            joinedSlots = [slot for slot in liveSlots if eliminationVariable in slots[slot][0]]
+            if not joinedSlots:
+                continue
+            liveSlots = [slot for slot in liveSlots if slot not in joinedSlots]
+            unconditioned = set().union(*[slots[slot][1] for slot in joinedSlots])
+            conditioned = set().union(*[slots[slot][2] for slot in joinedSlots]) - unconditioned
+            if len(unconditioned) <= 1:
+                # the joined factor would be discarded instead of eliminated
+                continue
+            unconditioned.discard(eliminationVariable)
+            outputVariables = sorted(unconditioned) + sorted(conditioned)
+            slots.append((outputVariables, unconditioned, conditioned))
+            liveSlots.append(len(slots) - 1)
+            self.steps.append(self._compileStep(slots, joinedSlots, outputVariables))
+
+        unconditioned = set().union(*[slots[slot][1] for slot in liveSlots])
+        conditioned = set().union(*[slots[slot][2] for slot in liveSlots]) - unconditioned
+        self.unconditionedVariables = sorted(unconditioned)
+        self.conditionedVariables = sorted(conditioned)
+        self.finalStep = self._compileStep(slots, liveSlots, self.unconditionedVariables + self.conditionedVariables)
+        self.numSlots = len(slots)
+        self.slotVariables = [slot[0] for slot in slots]
+        self.posteriorVariables = [variable for variable in self.unconditionedVariables + self.conditionedVariables
+                                   if variable not in self.evidenceVariables]
+        self.batchSteps = None # compiled by the first executeBatch
+
+    def _compileStep(self, slots, inputSlots, outputVariables):
+        """
+        Returns (inputSlots, einsum operand labels, output labels,
+        contraction path, output buffer) for the step that multiplies
+        the factors in inputSlots and sums out every variable that is not
+        in outputVariables.
+        """
+        stepVariables = sorted(set(outputVariables).union(*[slots[slot][0] for slot in inputSlots]))
+        if len(stepVariables) > 52:
+            raise ValueError("einsum supports at most 52 variables in one step, this step has " + \
+                             str(len(stepVariables)) + ": " + str(stepVariables))
+        labels = dict([(variable, i) for i, variable in enumerate(stepVariables)])
+
+        def shape(variables):
+            return [1 if variable in self.evidenceVariables else len(self.variableDomainsDict[variable])
+                    for variable in variables]
+
+        operandLabels = [[labels[variable] for variable in slots[slot][0]] for slot in inputSlots]
+        outputLabels = [labels[variable] for variable in outputVariables]
+        einsumArguments = []
+        for slot, slotLabels in zip(inputSlots, operandLabels):
+            einsumArguments += [np.broadcast_to(np.float64(0), shape(slots[slot][0])), slotLabels]
+        path, _ = np.einsum_path(*einsumArguments, outputLabels, optimize='greedy')
+        return (inputSlots, operandLabels, outputLabels, path, np.empty(shape(outputVariables), dtype=np.float64))
+
+    def execute(self, evidenceDict: Dict):
+        """
+        Returns the factor P(queryVariables | evidenceDict), as
+        inferenceByVariableElimination would for the compiled query.
+
+        evidenceDict must assign a value to exactly the evidence variables
+        the plan was compiled for.
+        """
+        if set(evidenceDict.keys()) != self.evidenceVariables:
+            raise ValueError("This plan was compiled for the evidence variables " + \
+                             str(sorted(self.evidenceVariables)) + ", got: " + str(sorted(evidenceDict.keys())))
+        try:
+            evidenceIndex = dict([(variable, self.evidenceIndices[variable][value])
+                                  for variable, value in evidenceDict.items()])
+        except KeyError:
+            raise ValueError("Evidence value not in the variable's domain: " + str(evidenceDict))
+
+        # slicing the evidence axes of the CPTs gives views, nothing is copied
+        values = [None] * self.numSlots
+        for slot, (table, evidenceAxes) in enumerate(zip(self.tables, self.evidenceAxes)):
+            if evidenceAxes:
+                index = [slice(None)] * table.ndim
+                for axis, variable in evidenceAxes:
+                    index[axis] = slice(evidenceIndex[variable], evidenceIndex[variable] + 1)
+                table = table[tuple(index)]
+            values[slot] = table
+
+        slot = len(self.tables)
+        for step in self.steps:
+            values[slot] = self._executeStep(step, values)
+            slot += 1
+        finalTable = self._executeStep(self.finalStep, values)
+
+        reducedDomainsDict = dict(self.variableDomainsDict)
+        for variable, value in evidenceDict.items():
+            reducedDomainsDict[variable] = [value]
+        return normalize(ArrayFactor.fromArray(self.unconditionedVariables, self.conditionedVariables,
+                                               reducedDomainsDict, finalTable))
+
+    __call__ = execute
+
+    def executeBatch(self, evidence):
+        """
+        Answers the compiled query for many evidence assignments in one
+        pass, and returns a float64 array of shape
+        (number of assignments, domain sizes of posteriorVariables...)
+        where entry [i, ...] is the table of execute(i-th assignment)
+        with its axes in the order of posteriorVariables (the sorted
+        query variables).  The rows for evidence with probability 0,
+        where execute returns None, are NaN.  An empty batch gives an
+        array with no rows.
+
+        evidence is either a list of evidence dicts as for execute, or a
+        dict {evidence variable : list or array of values} with one value
+        per assignment for each evidence variable.
+        """
+        evidenceIndices, batchSize = self._batchEvidenceIndices(evidence)
+        if batchSize == 0:
+            return np.zeros((0,) + tuple([len(self.variableDomainsDict[variable])
+                                          for variable in self.posteriorVariables]))
+        if self.batchSteps is None:
+            self.batchSteps = self._compileBatchSteps()
+
+        # indexing each evidence axis of a CPT with an array of indices gives a leading batch axis
+        values = []
+        for table, evidenceAxes in zip(self.tables, self.evidenceAxes):
+            if evidenceAxes:
+                axes = [axis for axis, variable in evidenceAxes]
+                table = np.transpose(table, axes + [axis for axis in range(table.ndim) if axis not in axes])
+                table = table[tuple([evidenceIndices[variable] for axis, variable in evidenceAxes])]
+            values.append(table)
+        for step in self.batchSteps:
+            values.append(self._executeBatchStep(step, values))
+
+        finalTable = values[-1]
+        if finalTable.ndim == len(self.posteriorVariables): # no evidence reached it
+            finalTable = np.broadcast_to(finalTable, (batchSize,) + finalTable.shape)
+        totals = finalTable.reshape(batchSize, -1).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return finalTable / totals.reshape((batchSize,) + (1,) * len(self.posteriorVariables))
+
+    def _batchEvidenceIndices(self, evidence):
+        """
+        Returns ({evidence variable : array of the index of its value in
+        each assignment}, number of assignments) for the input of
+        executeBatch.
+        """
+        if isinstance(evidence, dict):
+            columns = evidence
+            batchSizes = set([len(values) for values in columns.values()])
+            if len(batchSizes) > 1:
+                raise ValueError("Every evidence variable needs one value per assignment, got " + \
+                                 str(dict([(variable, len(values)) for variable, values in columns.items()])))
+            batchSize = batchSizes.pop() if batchSizes else 1
+        else:
+            evidence = list(evidence)
+            batchSize = len(evidence)
+            for evidenceDict in evidence:
+                if set(evidenceDict.keys()) != self.evidenceVariables:
+                    raise ValueError("This plan was compiled for the evidence variables " + \
+                                     str(sorted(self.evidenceVariables)) + ", got: " + str(sorted(evidenceDict.keys())))
+            columns = dict([(variable, [evidenceDict[variable] for evidenceDict in evidence])
+                            for variable in self.evidenceVariables])
+        if set(columns.keys()) != self.evidenceVariables:
+            raise ValueError("This plan was compiled for the evidence variables " + \
+                             str(sorted(self.evidenceVariables)) + ", got: " + str(sorted(columns.keys())))
+        try:
+            evidenceIndices = dict([(variable, np.array([self.evidenceIndices[variable][value] for value in values],
+                                                        dtype=np.intp))
+                                    for variable, values in columns.items()])
+        except KeyError as error:
+            raise ValueError("Evidence value not in the variable's domain: " + str(error))
+        return evidenceIndices, batchSize
+
+    def _compileBatchSteps(self):
+        """
+        Returns the steps of executeBatch: the steps of the plan followed by
+        the final step, as (inputSlots, einsum operand labels, output
+        labels), where the evidence axes are left out and every table that
+        depends on the evidence gets a leading batch axis.
+        """
+        batched = [len(evidenceAxes) > 0 for evidenceAxes in self.evidenceAxes]
+        outputSlots = list(range(len(self.tables), len(self.tables) + len(self.steps))) + [None]
+        batchSteps = []
+        for step, outputSlot in zip(self.steps + [self.finalStep], outputSlots):
+            inputSlots = step[0]
+            outputVariables = self.slotVariables[outputSlot] if outputSlot is not None \
+                else self.unconditionedVariables + self.conditionedVariables
+            stepVariables = sorted(set(outputVariables).union(*[self.slotVariables[slot] for slot in inputSlots])
+                                   - self.evidenceVariables)
+            if len(stepVariables) + 1 > 52:
+                raise ValueError("einsum supports at most 52 axes in one step, this batched step has " + \
+                                 str(len(stepVariables) + 1))
+            labels = dict([(variable, i) for i, variable in enumerate(stepVariables)])
+            batchLabel = len(stepVariables)
+
+            def axisLabels(variables, isBatched):
+                return ([batchLabel] if isBatched else []) + \
+                       [labels[variable] for variable in variables if variable not in self.evidenceVariables]
+
+            outputBatched = any([batched[slot] for slot in inputSlots])
+            batched.append(outputBatched)
+            batchSteps.append((inputSlots,
+                               [axisLabels(self.slotVariables[slot], batched[slot]) for slot in inputSlots],
+                               axisLabels(outputVariables, outputBatched)))
+        return batchSteps
+
+    def _executeBatchStep(self, step, values):
+        inputSlots, operandLabels, outputLabels = step
+        einsumArguments = []
+        for slot, slotLabels in zip(inputSlots, operandLabels):
+            einsumArguments += [values[slot], slotLabels]
+        return np.einsum(*einsumArguments, outputLabels, optimize=True)
+
+    def _executeStep(self, step, values):
+        inputSlots, operandLabels, outputLabels, path, buffer = step
+        einsumArguments = []
+        for slot, slotLabels in zip(inputSlots, operandLabels):
+            einsumArguments += [values[slot], slotLabels]
+        return np.einsum(*einsumArguments, outputLabels, out=buffer, optimize=path)
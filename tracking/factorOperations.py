@@ -1,6 +1,8 @@
 from typing import List
-from bayesNet import Factor
+from bayesNet import Factor, ArrayFactor, LogFactor, SparseFactor, logSumExp
+from bayesNet import chooseFactorStorage, ravelCodes
 import functools
+import numpy as np
 from util import raiseNotDefined
 
 def joinFactorsByVariableWithCallTracking(callTrackingList=None):
@@ -87,12 +89,13 @@ def joinFactors(factors: List[Factor]):
 
 
     "*** YOUR CODE HERE ***"
+    factors = list(factors)
     # Initialize sets for tracking variables.
     unconditioned_variables = set()
     conditioned_variables = set()
 
     # Retrieve variable domain dictionary from the first factor.
-    domains_dict = list(factors)[0].variableDomainsDict()
+    domains_dict = factors[0].variableDomainsDict()
 
     # Populate sets with unconditioned and conditioned variables from all factors.
     for factor in factors:
@@ -102,20 +105,156 @@ def joinFactors(factors: List[Factor]):
     # Remove any conditioned variables that are also unconditioned.
     conditioned_variables -= unconditioned_variables
 
-    # Instantiate a new factor with no overlapping variables.
-    crafted_factor = Factor(unconditioned_variables, conditioned_variables, domains_dict)
-
-    # Assign probabilities to each possible combination of variable assignments.
-    for assignment in crafted_factor.getAllPossibleAssignmentDicts():
-        # Start with a neutral probability multiplier.
-        probability_multiplier = 1
-        # Combine probabilities across all factors for this assignment.
-        for factor in factors:
-            probability_multiplier *= factor.getProbability(assignment)
-        # Set the aggregated probability for the current assignment.
-        crafted_factor.setProbability(assignment, probability_multiplier)
+    # Fix an axis order for the joined table: unconditioned variables first, then conditioned.
+    unconditioned_order = sorted(unconditioned_variables)
+    conditioned_order = sorted(conditioned_variables)
+    output_variables = unconditioned_order + conditioned_order
+
+    # Mostly-zero factors are joined entry by entry, skipping the zeros.
+    if _isSparse(factors):
+        return _joinSparseFactors(factors, unconditioned_order, conditioned_order, domains_dict)
+
+    # If any input is a LogFactor, join in log space, where the product is a sum.
+    log_space = _inLogSpace(factors)
+    combine = np.add if log_space else np.multiply
+
+    # Multiply the tables of all factors at once, each broadcast over the variables it lacks.
+    joined_table = np.empty([len(domains_dict[variable]) for variable in output_variables], dtype=np.float64)
+    joined_table[...] = _alignedTable(factors[0], output_variables, domains_dict, log_space)
+    for factor in factors[1:]:
+        combine(joined_table, _alignedTable(factor, output_variables, domains_dict, log_space), out=joined_table)
+
     # The function concludes by returning the composed factor.
-    return crafted_factor
+    if log_space:
+        return LogFactor.fromLogArray(unconditioned_order, conditioned_order, domains_dict, joined_table)
+    return ArrayFactor.fromArray(unconditioned_order, conditioned_order, domains_dict, joined_table)
+
+
+def _inLogSpace(factors: List[Factor]):
+    " Factor operations work in log space when any of their inputs is a LogFactor "
+    return any([isinstance(factor, LogFactor) for factor in factors])
+
+
+def _isSparse(factors: List[Factor]):
+    " Factor operations skip zero entries when an input is a SparseFactor (and none is a LogFactor) "
+    return any([isinstance(factor, SparseFactor) for factor in factors]) and not _inLogSpace(factors)
+
+
+def _sparseEntries(factor: Factor, variableDomainsDict):
+    """
+    Returns ({variable : index of each non-zero entry along its axis},
+    the probabilities of the non-zero entries) of factor, with the
+    indices into the domains in variableDomainsDict.
+    """
+    coordinates, values = SparseFactor.fromFactor(factor).nonZeroEntries()
+    factorDomainsDict = factor.variableDomainsDict()
+    keep = np.ones(len(values), dtype=bool)
+    entries = {}
+    for axis, variable in enumerate(factor.variables()):
+        factorDomain = factorDomainsDict[variable]
+        outputDomain = variableDomainsDict[variable]
+        if factorDomain is outputDomain or list(factorDomain) == list(outputDomain):
+            entries[variable] = coordinates[axis]
+            continue
+        valueIndices = dict([(value, i) for i, value in enumerate(factorDomain)])
+        if not all(value in valueIndices for value in outputDomain):
+            raise ValueError("The input factors don't share the same variable domains.\n" +
+                             "variable: " + str(variable) + "\n" +
+                             "factor domain: " + str(factorDomain) + "\n" +
+                             "expected domain: " + str(outputDomain))
+        outputPositions = np.full(len(factorDomain), -1, dtype=np.int64)
+        for i, value in enumerate(outputDomain):
+            outputPositions[valueIndices[value]] = i
+        entries[variable] = outputPositions[coordinates[axis]]
+        keep &= entries[variable] >= 0
+    return dict([(variable, positions[keep]) for variable, positions in entries.items()]), values[keep]
+
+
+def _joinSparseFactors(factors: List[Factor], unconditionedOrder, conditionedOrder, variableDomainsDict):
+    """
+    joinFactors for a list with SparseFactors in it: the non-zero entries
+    of the factors are matched on the variables they share (a sort-merge
+    join), so the work grows with the number of non-zero entries.
+    """
+    sizes = dict([(variable, len(variableDomainsDict[variable])) for variable in unconditionedOrder + conditionedOrder])
+    joinedEntries, joinedValues = _sparseEntries(factors[0], variableDomainsDict)
+    for factor in factors[1:]:
+        entries, values = _sparseEntries(factor, variableDomainsDict)
+        shared = sorted(set(joinedEntries.keys()) & set(entries.keys()))
+        sharedShape = [sizes[variable] for variable in shared]
+        joinedKeys = ravelCodes([joinedEntries[variable] for variable in shared], sharedShape, len(joinedValues))
+        keys = ravelCodes([entries[variable] for variable in shared], sharedShape, len(values))
+
+        # every pair of entries with the same assignment to the shared variables
+        order = np.argsort(keys, kind='stable')
+        sortedKeys = keys[order]
+        starts = np.searchsorted(sortedKeys, joinedKeys, side='left')
+        counts = np.searchsorted(sortedKeys, joinedKeys, side='right') - starts
+        joinedRows = np.repeat(np.arange(len(joinedValues)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = order[np.repeat(starts, counts) + offsets]
+
+        joinedEntries = dict([(variable, positions[joinedRows]) for variable, positions in joinedEntries.items()])
+        for variable, positions in entries.items():
+            if variable not in joinedEntries:
+                joinedEntries[variable] = positions[rows]
+        joinedValues = joinedValues[joinedRows] * values[rows]
+
+    outputVariables = unconditionedOrder + conditionedOrder
+    nonZero = joinedValues != 0
+    codes = ravelCodes([joinedEntries[variable][nonZero] for variable in outputVariables],
+                       [sizes[variable] for variable in outputVariables], int(nonZero.sum()))
+    return chooseFactorStorage(SparseFactor.fromCodes(unconditionedOrder, conditionedOrder, variableDomainsDict,
+                                                      codes, joinedValues[nonZero]))
+
+
+def _factorTable(factor: Factor, logSpace=False):
+    " The table of factor, as log probabilities if logSpace is True "
+    if not logSpace:
+        return factor.asArray()
+    return LogFactor.fromFactor(factor).asLogArray()
+
+
+def _reindexedTable(factor: Factor, variableDomainsDict, logSpace=False):
+    """
+    Returns the probability table of factor (axes in factor.variables()
+    order, log probabilities if logSpace is True), with every axis whose
+    domain differs from the one in variableDomainsDict (e.g. a factor that
+    was specialized separately) reindexed to match it.
+    """
+    table = _factorTable(factor, logSpace)
+    factorDomainsDict = factor.variableDomainsDict()
+
+    for axis, variable in enumerate(factor.variables()):
+        factorDomain = factorDomainsDict[variable]
+        outputDomain = variableDomainsDict[variable]
+        if factorDomain is outputDomain or list(factorDomain) == list(outputDomain):
+            continue
+        valueIndices = dict([(value, i) for i, value in enumerate(factorDomain)])
+        if not all(value in valueIndices for value in outputDomain):
+            raise ValueError("The input factors don't share the same variable domains.\n" +
+                             "variable: " + str(variable) + "\n" +
+                             "factor domain: " + str(factorDomain) + "\n" +
+                             "expected domain: " + str(outputDomain))
+        table = np.take(table, [valueIndices[value] for value in outputDomain], axis=axis)
+    return table
+
+
+def _alignedTable(factor: Factor, outputVariables: List[str], variableDomainsDict, logSpace=False):
+    """
+    Returns the probability table of factor laid out for broadcasting
+    against a table over outputVariables with the domains in
+    variableDomainsDict: the axes follow the order of outputVariables,
+    and variables that factor doesn't contain get an axis of length 1.
+    """
+    table = _reindexedTable(factor, variableDomainsDict, logSpace)
+    factorVariables = factor.variables()
+    outputPositions = dict([(variable, i) for i, variable in enumerate(outputVariables)])
+    table = np.transpose(table, sorted(range(len(factorVariables)),
+                                       key=lambda axis: outputPositions[factorVariables[axis]]))
+    factorVariablesSet = factor.variablesSet()
+    return table.reshape([len(variableDomainsDict[variable]) if variable in factorVariablesSet else 1
+                          for variable in outputVariables])
 
 
 def eliminateWithCallTracking(callTrackingList=None):
@@ -163,33 +302,114 @@ def eliminateWithCallTracking(callTrackingList=None):
 
         "*** YOUR CODE HERE ***"
         # Define variables from the current factor, excluding the one to be eliminated.
-        active_unconditioned_vars = factor.unconditionedVariables() - {eliminationVariable}
-        dependent_vars = factor.conditionedVariables()
-        domains = factor.variableDomainsDict()
-
-        # Formulate a new factor without the eliminated variable.
-        crafted_factor = Factor(active_unconditioned_vars, dependent_vars, domains)
-
-        # Calculate probabilities for the new factor over all viable assignments.
-        for current_assignment in crafted_factor.getAllPossibleAssignmentDicts():
-            # Start with zero and incrementally add to this probability.
-            aggregated_probability = 0
-
-            # Iterate over possible values of the eliminated variable and sum their probabilities.
-            for elimination_var_value in domains[eliminationVariable]:
-                # Create a new assignment dictionary for the current scenario.
-                scenario_assignment = {**current_assignment, eliminationVariable: elimination_var_value}
-                # Increase the aggregated probability by the current scenario's probability.
-                aggregated_probability += factor.getProbability(scenario_assignment)
-
-            # Assign the total aggregated probability to the current assignment in the new factor.
-            crafted_factor.setProbability(current_assignment, aggregated_probability)
+        variables = list(factor.variables())
+        elimination_axis = variables.index(eliminationVariable)
+        del variables[elimination_axis]
+        active_unconditioned_vars = [var for var in variables if var in factor.unconditionedVariables()]
+        dependent_vars = [var for var in variables if var in factor.conditionedVariables()]
+
+        # Sum the table over the axis of the eliminated variable; the remaining axes keep their order.
+        if isinstance(factor, SparseFactor):
+            # Only the non-zero entries are summed, grouped by their code in the smaller table.
+            (coordinates, values), shape = factor.nonZeroEntries(), factor.tableShape()
+            remaining_axes = [axis for axis in range(len(shape)) if axis != elimination_axis]
+            codes = ravelCodes([coordinates[axis] for axis in remaining_axes],
+                               [shape[axis] for axis in remaining_axes], len(values))
+            summed_codes, positions = np.unique(codes, return_inverse=True)
+            summed_values = np.bincount(positions.ravel(), weights=values, minlength=len(summed_codes))
+            return chooseFactorStorage(SparseFactor.fromCodes(active_unconditioned_vars, dependent_vars,
+                                                              factor.variableDomainsDict(), summed_codes, summed_values))
+        if isinstance(factor, LogFactor):
+            # In log space the sum is a log-sum-exp, which can't underflow.
+            summed_table = logSumExp(factor.asLogArray(), axis=elimination_axis)
+            return LogFactor.fromLogArray(active_unconditioned_vars, dependent_vars, factor.variableDomainsDict(), summed_table)
+        summed_table = factor.asArray().sum(axis=elimination_axis)
 
         # Output the revised factor with updated probability values.
-        return crafted_factor
+        return ArrayFactor.fromArray(active_unconditioned_vars, dependent_vars, factor.variableDomainsDict(), summed_table)
 
     
     return eliminate
 
 eliminate = eliminateWithCallTracking()
 
+
+def joinAndEliminateByVariableWithCallTracking(callTrackingList=None):
+
+    def joinAndEliminateByVariable(factors: List[Factor], eliminationVariable: str):
+        """
+        Input factors is a list of factors.
+        Input eliminationVariable is the variable to join on and then
+        eliminate.
+
+        Computes the same result as calling joinFactorsByVariable on
+        eliminationVariable followed by eliminate on the joined factor,
+        but sums eliminationVariable out while multiplying, so the full
+        joined table is never materialized.
+
+        As in inferenceByVariableElimination, a joined factor with only
+        one unconditioned variable is discarded rather than eliminated,
+        and None is returned in its place (only the join is recorded in
+        callTrackingList in that case).
+
+        Returns a tuple of
+        (factors not joined, factor with eliminationVariable eliminated or None)
+        """
+        if not (callTrackingList is None):
+            callTrackingList.append(('join', eliminationVariable))
+
+        currentFactorsToJoin =    [factor for factor in factors if eliminationVariable in factor.variablesSet()]
+        currentFactorsNotToJoin = [factor for factor in factors if eliminationVariable not in factor.variablesSet()]
+
+        # typecheck portion, shared with joinFactorsByVariable and joinFactors
+        setsOfUnconditioned = [set(factor.unconditionedVariables()) for factor in currentFactorsToJoin]
+        intersect = functools.reduce(lambda x, y: x & y, setsOfUnconditioned) if len(setsOfUnconditioned) > 1 else set()
+        if len(intersect) > 0:
+            raise ValueError("unconditionedVariables can only appear in one factor. \n"
+                    + "unconditionedVariables: " + str(intersect) +
+                    "\nappear in more than one input factor.\n" +
+                    "Input factors: \n" +
+                    "\n".join(map(str, currentFactorsToJoin)))
+
+        unconditionedVariables = functools.reduce(lambda x, y: x | y, setsOfUnconditioned, set())
+        conditionedVariables = set()
+        for factor in currentFactorsToJoin:
+            conditionedVariables |= set(factor.conditionedVariables())
+        conditionedVariables -= unconditionedVariables
+
+        if len(unconditionedVariables) <= 1:
+            return currentFactorsNotToJoin, None
+
+        if not (callTrackingList is None):
+            callTrackingList.append(('eliminate', eliminationVariable))
+
+        # typecheck portion, shared with eliminate
+        if eliminationVariable not in unconditionedVariables:
+            raise ValueError("Elimination variable is not an unconditioned variable " \
+                            + "in the joined factor\n" +
+                            "eliminationVariable: " + str(eliminationVariable) + \
+                            "\nunconditionedVariables:" + str(unconditionedVariables))
+
+        domainsDict = currentFactorsToJoin[0].variableDomainsDict()
+        unconditionedOrder = sorted(unconditionedVariables - {eliminationVariable})
+        conditionedOrder = sorted(conditionedVariables)
+        outputVariables = unconditionedOrder + conditionedOrder
+
+        # einsum labels axes with small integers, and supports at most 52 of them;
+        # it also can't sum in log space or skip zero entries
+        labels = dict([(variable, i) for i, variable in enumerate(outputVariables + [eliminationVariable])])
+        if len(labels) > 52 or _inLogSpace(currentFactorsToJoin) or _isSparse(currentFactorsToJoin):
+            return currentFactorsNotToJoin, eliminate(joinFactors(currentFactorsToJoin), eliminationVariable)
+
+        einsumArguments = []
+        for factor in currentFactorsToJoin:
+            einsumArguments.append(_reindexedTable(factor, domainsDict))
+            einsumArguments.append([labels[variable] for variable in factor.variables()])
+        einsumArguments.append([labels[variable] for variable in outputVariables])
+        marginalTable = np.einsum(*einsumArguments, optimize=True)
+
+        return currentFactorsNotToJoin, ArrayFactor.fromArray(unconditionedOrder, conditionedOrder, domainsDict, marginalTable)
+
+    return joinAndEliminateByVariable
+
+joinAndEliminateByVariable = joinAndEliminateByVariableWithCallTracking()
@@ -0,0 +1,361 @@
+"""
+Gibbs sampling.
+
+A GibbsSampler is built for one query: it prunes the bayes net, finds
+the Markov blanket of every variable that is sampled (its parents, its
+children and the other parents of its children) and turns the CPTs that
+mention the variable into a table of its conditional distribution given
+its blanket.  Sampling then resamples each variable in turn from its row
+of that table, for many chains at once, and the chains can be spread
+over several processes.
+
+Successive states of a chain are correlated, so the number of samples
+drawn overstates how much they tell about the posterior;
+effectiveSampleSize estimates the number of independent samples they
+are worth, and GibbsSampler.run can stop once it is large enough.
+"""
+from collections import namedtuple
+from typing import Dict, List
+import multiprocessing
+import numpy as np
+from bayesNet import ArrayFactor
+from inference import prunedEvidenceIsPossible, cumulativeRows, sampleCumulativeRows
+
+# blanket-conditional tables with more entries than this are not
+# precomputed: the CPTs are multiplied for every resampling instead
+MAX_BLANKET_TABLE_SIZE = 2 ** 20
+
+GibbsEstimate = namedtuple('GibbsEstimate',
+                           ['posterior', 'effectiveSampleSize', 'numSamples', 'numChains'])
+
+
+def effectiveSampleSize(draws):
+    """
+    Estimates the number of independent samples that draws, an array of
+    numbers with one row per chain (or a single chain as a 1d array), is
+    worth.
+
+    The autocorrelation of the chains is estimated from their
+    autocovariance and the variance within and between the chains, and
+    summed over lags in pairs until a pair sum stops being positive
+    (Geyer's initial monotone sequence).  Draws that never change are
+    worth as many samples as there are draws.
+    """
+    draws = np.asarray(draws, dtype=np.float64)
+    if draws.ndim == 1:
+        draws = draws[None, :]
+    numChains, numDraws = draws.shape
+    if numDraws < 4:
+        return float(numChains * numDraws)
+
+    centered = draws - draws.mean(axis=1, keepdims=True)
+    fftSize = 1 << (2 * numDraws - 1).bit_length()
+    transform = np.fft.rfft(centered, fftSize, axis=1)
+    autocovariance = np.fft.irfft(transform * np.conjugate(transform), fftSize, axis=1)[:, :numDraws] / numDraws
+
+    withinVariance = (autocovariance[:, 0] * numDraws / (numDraws - 1.0)).mean()
+    betweenVariance = numDraws * draws.mean(axis=1).var(ddof=1) if numChains > 1 else 0.0
+    pooledVariance = (numDraws - 1.0) / numDraws * withinVariance + betweenVariance / numDraws
+    if pooledVariance <= 0.0:
+        return float(numChains * numDraws)
+
+    autocorrelation = 1.0 - (withinVariance - autocovariance.mean(axis=0)) / pooledVariance
+    autocorrelation[0] = 1.0
+    pairSums = autocorrelation[:numDraws - numDraws % 2].reshape(-1, 2).sum(axis=1)
+    nonPositive = np.flatnonzero(pairSums <= 0.0)
+    pairSums = pairSums[:nonPositive[0] if len(nonPositive) else len(pairSums)]
+    pairSums = np.minimum.accumulate(pairSums)
+    autocorrelationTime = max(-1.0 + 2.0 * pairSums.sum(), 1.0 / np.log10(max(numChains * numDraws, 10)))
+    return float(numChains * numDraws / autocorrelationTime)
+
+
+class GibbsSampler:
+    """
+    A Gibbs sampler for P(queryVariables | evidenceDict) on a bayes net.
+
+    The state of a chain is the index of the value of every variable of
+    the pruned bayes net in its domain (evidence variables have the
+    single value they are observed at, at index 0).  A sweep resamples
+    every unobserved variable once, in the order of
+    BayesNet.linearizeVariables(), from its conditional distribution
+    given the current values of its Markov blanket.
+    """
+
+    def __init__(self, bayesNet, queryVariables: List[str], evidenceDict: Dict,
+                 maxBlanketTableSize: int = None):
+        """
+        bayesNet:            The Bayes Net to sample from.
+        queryVariables:      The variables whose posterior is estimated.
+        evidenceDict:        An assignment dict {variable : value} for the
+                             observed variables.
+        maxBlanketTableSize: The largest blanket-conditional table that is
+                             precomputed.  If None, MAX_BLANKET_TABLE_SIZE
+                             is used.
+        """
+        if maxBlanketTableSize is None:
+            maxBlanketTableSize = MAX_BLANKET_TABLE_SIZE
+        observedQueryVariables = set(queryVariables) & set(evidenceDict.keys())
+        if observedQueryVariables:
+            raise ValueError("Query variables can't be observed: " + str(sorted(observedQueryVariables)))
+
+        self.queryVariables = sorted(queryVariables)
+        self.evidenceVariables = sorted(evidenceDict.keys())
+        self.variableDomainsDict = bayesNet.getReducedVariableDomains(evidenceDict)
+
+        prunedBayesNet = bayesNet.getPrunedBayesNet(queryVariables, evidenceDict.keys())
+        self.variables = prunedBayesNet.linearizeVariables()
+        self.columns = dict([(variable, i) for i, variable in enumerate(self.variables)])
+        self.domainSizes = [len(self.variableDomainsDict[variable]) for variable in self.variables]
+        self.sampledVariables = [variable for variable in self.variables if variable not in evidenceDict]
+        self.evidenceIsPossible = prunedEvidenceIsPossible(bayesNet, queryVariables, evidenceDict)
+
+        # every CPT with its evidence axes reduced to the observed value, as
+        # a table with one axis per column of the state
+        CPTTables = {}
+        for variable in self.variables:
+            CPT = ArrayFactor.fromFactor(prunedBayesNet.getCPTWithEvidence(variable, evidenceDict))
+            CPTTables[variable] = (CPT.asArray(), [self.columns[var] for var in CPT.variables()])
+        self.CPTTables = [CPTTables[variable] for variable in self.variables]
+
+        outEdges = prunedBayesNet.outEdges()
+        self.markovBlankets = {}
+        self.parentConditionals = {}
+        self.blanketConditionals = {}
+        for variable in self.sampledVariables:
+            column = self.columns[variable]
+            factors = [CPTTables[variable]] + [CPTTables[child] for child in sorted(outEdges[variable])]
+            blanketColumns = sorted(set([col for (_, cols) in factors for col in cols]) - {column})
+            self.markovBlankets[variable] = [self.variables[col] for col in blanketColumns
+                                             if self.variables[col] not in evidenceDict]
+            self.parentConditionals[variable] = (column, [self._movedToLastAxis(table, cols, column)
+                                                          for (table, cols) in factors[:1]])
+            self.blanketConditionals[variable] = self._blanketConditional(column, factors, blanketColumns,
+                                                                          maxBlanketTableSize)
+
+        self.queryColumns = [self.columns[variable] for variable in self.queryVariables]
+        self.queryShape = [self.domainSizes[col] for col in self.queryColumns]
+
+    def _movedToLastAxis(self, table, columns, column):
+        " The table with the axis of column moved last, and the columns of its other axes "
+        axis = columns.index(column)
+        return np.moveaxis(table, axis, -1), columns[:axis] + columns[axis + 1:]
+
+    def _blanketConditional(self, column, factors, blanketColumns, maxBlanketTableSize):
+        """
+        Returns ('table', blanketColumns, cumulative) where cumulative is
+        the conditional distribution of the variable in column given each
+        assignment of blanketColumns (in row-major order), as cumulative
+        probabilities shifted by the row number so that a single
+        searchsorted samples every row.
+
+        If that table would be too large, returns ('factors', factors)
+        with the factors moved so the variable is their last axis.
+        """
+        domainSize = self.domainSizes[column]
+        tableSize = domainSize * int(np.prod([self.domainSizes[col] for col in blanketColumns]))
+        if tableSize > maxBlanketTableSize or len(blanketColumns) >= 52:
+            return ('factors', [self._movedToLastAxis(table, cols, column) for (table, cols) in factors])
+
+        labels = dict([(col, i) for i, col in enumerate(blanketColumns + [column])])
+        args = []
+        for table, cols in factors:
+            args += [table, [labels[col] for col in cols]]
+        table = np.einsum(*args, [labels[col] for col in blanketColumns + [column]]).reshape(-1, domainSize)
+        return ('table', blanketColumns, cumulativeRows(table))
+
+    def initialStates(self, numChains: int, randomSource: np.random.Generator):
+        """
+        Returns the states of numChains new chains, each drawn by
+        sampling the unobserved variables from their CPTs in order (the
+        observed ones are kept at their values).
+        """
+        states = np.zeros((numChains, len(self.variables)), dtype=np.intp)
+        for variable in self.sampledVariables:
+            column, factors = self.parentConditionals[variable]
+            states[:, column] = _sampleProduct(factors, states, randomSource)
+        return states
+
+    def sweep(self, states, randomSource: np.random.Generator):
+        " Resamples every unobserved variable of every chain in states once, in place "
+        for variable in self.sampledVariables:
+            column = self.columns[variable]
+            conditional = self.blanketConditionals[variable]
+            if conditional[0] == 'table':
+                _, blanketColumns, cumulative = conditional
+                if blanketColumns:
+                    rows = np.ravel_multi_index(tuple(states[:, blanketColumns].T),
+                                                [self.domainSizes[col] for col in blanketColumns])
+                else:
+                    rows = np.zeros(len(states), dtype=np.intp)
+                states[:, column] = sampleCumulativeRows(cumulative, rows, randomSource)
+            else:
+                states[:, column] = _sampleProduct(conditional[1], states, randomSource)
+        return states
+
+    def possibleChains(self, states):
+        " A mask of the chains in states whose state has nonzero probability "
+        possible = np.ones(len(states), dtype=bool)
+        for table, columns in self.CPTTables:
+            possible &= table[tuple(states[:, columns].T)] > 0.0
+        return possible
+
+    def queryCodes(self, states):
+        " The index of the query assignment of each chain in states, in row-major order "
+        if not self.queryColumns:
+            return np.zeros(len(states), dtype=np.intp)
+        return np.ravel_multi_index(tuple(states[:, self.queryColumns].T), self.queryShape)
+
+    def advance(self, states, randomSource: np.random.Generator, numSweeps: int, thinning: int = 1):
+        """
+        Runs numSweeps sweeps on states (in place) and returns the query
+        codes of every thinning-th sweep, one column per kept sweep.
+        """
+        kept = []
+        for sweepNumber in range(1, numSweeps + 1):
+            self.sweep(states, randomSource)
+            if sweepNumber % thinning == 0:
+                kept.append(self.queryCodes(states))
+        if not kept:
+            return np.zeros((len(states), 0), dtype=np.intp)
+        return np.stack(kept, axis=1)
+
+    def posterior(self, codes):
+        " The estimate of P(queryVariables | evidenceDict) from the query codes of the kept samples "
+        size = int(np.prod(self.queryShape))
+        table = np.bincount(np.asarray(codes).ravel(), minlength=size).astype(np.float64)
+        table = (table / table.sum()).reshape(self.queryShape + [1] * len(self.evidenceVariables))
+        return ArrayFactor.fromArray(self.queryVariables, self.evidenceVariables, self.variableDomainsDict, table)
+
+    def queryEffectiveSampleSize(self, codes):
+        """
+        The effective sample size of the query codes of the kept samples
+        (one row per chain): the smallest effectiveSampleSize of the
+        indicator of any query assignment that the chains visited without
+        staying at it.
+        """
+        codes = np.asarray(codes)
+        values = np.unique(codes)
+        if len(values) < 2:
+            return float(codes.size)
+        return min([effectiveSampleSize(codes == value) for value in values])
+
+    def run(self, numSamples: int, burnIn: int = 100, thinning: int = 1, numChains: int = 4,
+            processes: int = None, seed=None, targetEffectiveSampleSize: float = None,
+            checkInterval: int = None):
+        """
+        Runs numChains chains and returns a GibbsEstimate of the posterior
+        from their samples.
+
+        A chain whose state has probability 0 resamples the variables with
+        no mass in their conditional uniformly, and once it reaches a state
+        with nonzero probability it never leaves those states.  Chains
+        still at a state with probability 0 at the end never held a
+        possible state, so their samples are dropped (numChains of the
+        estimate counts the chains kept), and None is returned when no
+        chain is kept or the evidence has probability 0.
+
+        numSamples:                The number of samples to keep per chain.
+        burnIn:                    The number of sweeps each chain runs
+                                   before any sample is kept.
+        thinning:                  One sample is kept every thinning sweeps.
+        numChains:                 The number of independent chains.
+        processes:                 If more than 1, the chains are split
+                                   among that many worker processes.
+        seed:                      Seeds the chains (see
+                                   numpy.random.SeedSequence); the result
+                                   only depends on it and on how the chains
+                                   are split among processes.
+        targetEffectiveSampleSize: If given, the effective sample size is
+                                   checked every checkInterval samples per
+                                   chain and sampling stops once it reaches
+                                   this value.
+        checkInterval:             Defaults to a tenth of numSamples.
+        """
+        if numSamples <= 0 or numChains <= 0 or thinning <= 0 or burnIn < 0:
+            raise ValueError("numSamples, numChains and thinning must be positive and burnIn non-negative, got: " + \
+                             str((numSamples, numChains, thinning, burnIn)))
+        if not self.evidenceIsPossible:
+            return None
+        if checkInterval is None:
+            checkInterval = max(numSamples // 10, 1)
+        if targetEffectiveSampleSize is None:
+            checkInterval = numSamples
+
+        numGroups = max(1, min(processes or 1, numChains))
+        groupSizes = [numChains // numGroups + (i < numChains % numGroups) for i in range(numGroups)]
+        randomSources = [np.random.default_rng(seedSequence)
+                         for seedSequence in np.random.SeedSequence(seed).spawn(numGroups)]
+        groups = [(self.initialStates(size, randomSource), randomSource)
+                  for size, randomSource in zip(groupSizes, randomSources)]
+        pool = multiprocessing.Pool(numGroups, _setWorkerSampler, (self,)) if numGroups > 1 else None
+        try:
+            groups = self._advanceGroups(pool, groups, burnIn, burnIn + 1)[0]
+            codes = np.zeros((numChains, 0), dtype=np.intp)
+            effectiveSamples = None
+            while codes.shape[1] < numSamples:
+                numKept = min(checkInterval, numSamples - codes.shape[1])
+                groups, newCodes = self._advanceGroups(pool, groups, numKept * thinning, thinning)
+                codes = np.concatenate([codes, newCodes], axis=1)
+                possible = self.possibleChains(np.concatenate([states for (states, _) in groups], axis=0))
+                if targetEffectiveSampleSize is not None and possible.any():
+                    effectiveSamples = self.queryEffectiveSampleSize(codes[possible])
+                    if effectiveSamples >= targetEffectiveSampleSize:
+                        break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if not possible.any():
+            return None
+        codes = codes[possible]
+        if effectiveSamples is None:
+            effectiveSamples = self.queryEffectiveSampleSize(codes)
+        return GibbsEstimate(self.posterior(codes), effectiveSamples, codes.shape[1], len(codes))
+
+    def _advanceGroups(self, pool, groups, numSweeps, thinning):
+        " Advances every group of chains, in the pool if there is one, and stacks their query codes "
+        work = [(states, randomSource, numSweeps, thinning) for (states, randomSource) in groups]
+        if pool is not None:
+            results = pool.map(_advanceGroup, work)
+        else:
+            results = [_advanceGroup(args, self) for args in work]
+        groups = [(states, randomSource) for (states, randomSource, _) in results]
+        return groups, np.concatenate([codes for (_, _, codes) in results], axis=0)
+
+
+# the sampler of a worker process, sent once when its pool is created
+_workerSampler = None
+
+
+def _setWorkerSampler(sampler):
+    global _workerSampler
+    _workerSampler = sampler
+
+
+def _advanceGroup(args, sampler=None):
+    " Worker for GibbsSampler.run: the states, random source and kept query codes after advancing "
+    if sampler is None:
+        sampler = _workerSampler
+    states, randomSource, numSweeps, thinning = args
+    codes = sampler.advance(states, randomSource, numSweeps, thinning)
+    return states, randomSource, codes
+
+
+def _gatheredProduct(factors, states):
+    """
+    Returns, for every chain in states, the product over factors of the
+    row of each factor (a table whose last axis is the variable being
+    sampled) selected by the chain's values of the other axes.
+    """
+    product = None
+    for table, columns in factors:
+        rows = table[tuple(states[:, columns].T)] if columns else np.broadcast_to(table, (len(states),) + table.shape)
+        product = rows if product is None else product * rows
+    return product
+
+
+def _sampleProduct(factors, states, randomSource):
+    " Samples the variable of factors for every chain in states from its row of _gatheredProduct "
+    return sampleCumulativeRows(cumulativeRows(_gatheredProduct(factors, states)), np.arange(len(states)),
+                                randomSource)
@@ -16,6 +16,12 @@ from game import Agent
 from game import Actions
 from game import Directions
 import re
+import itertools
+import numpy as np
+from eliminationPlans import VariableEliminationPlan
+from eliminationOrdering import greedyEliminationOrder, eliminationOrderCost, compareEliminationOrders
+from junctionTree import JunctionTree
+from gibbsSampling import GibbsSampler
 
 class GraphEqualityTest(testClasses.TestCase):
 
@@ -131,6 +137,41 @@ class BayesNetEqualityTest(GraphEqualityTest):
             handle.write(net.easierToParseString(printVariableDomainsDict=True))
         return True
 
+class ObservationCPTTest(GraphEqualityTest):
+    """
+    Checks every entry of the observation CPTs that
+    constructBayesNet(fillObservations=True) fills against the sonar model
+    busters.getObservationProbability.
+    """
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        net = inferenceModule.constructBayesNet(self.startState, fillObservations=True)
+        domainsDict = net.variableDomainsDict()
+        for observationVariable, ghostVariable in [('Observation0', 'Ghost0'), ('Observation1', 'Ghost1')]:
+            CPT = net.getCPT(observationVariable)
+            for pacmanPosition in domainsDict['Pacman']:
+                for ghostPosition in domainsDict[ghostVariable]:
+                    trueDistance = manhattanDistance(pacmanPosition, ghostPosition)
+                    for observation in domainsDict[observationVariable]:
+                        assignmentDict = {'Pacman': pacmanPosition, ghostVariable: ghostPosition,
+                                          observationVariable: observation}
+                        studentProbability = CPT.getProbability(assignmentDict)
+                        goldProbability = busters.getObservationProbability(observation, trueDistance)
+                        if abs(studentProbability - goldProbability) > 1e-12:
+                            self.addMessage('Observation CPT entry differs from the sonar model: ' + str(assignmentDict))
+                            self.addMessage('Student probability: ' + str(studentProbability))
+                            self.addMessage('Correct probability: ' + str(goldProbability))
+                            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks the observation CPTs against busters.getObservationProbability\n')
+        handle.close()
+        return True
+
+
 class FactorEqualityTest(testClasses.TestCase):
 
     def __init__(self, question, testDict):
@@ -266,6 +307,1062 @@ class BayesNetInputFactorEqualityTest(FactorEqualityTest):
         
         return solvedFactor
 
+class CopyOnWriteCPTTest(testClasses.TestCase):
+    """
+    Checks that the CPTs of a bayes net can't be changed through the
+    factors it hands out: changing a factor returned by getCPT leaves the
+    stored CPT as it was.  Also checks that Factor.copy() shares the table
+    of an ArrayFactor until one of the two factors is written, and that
+    the write only shows up in the factor that was written.
+    """
+
+    def __init__(self, question, testDict):
+        super(CopyOnWriteCPTTest, self).__init__(question, testDict)
+        self.problemBayesNet = parseBayesNetProblem(testDict)['problemBayesNet']
+
+    def execute(self, grades, moduleDict, solutionDict):
+        net = self.problemBayesNet
+        for variable in sorted(net.variablesSet()):
+            net.setCPT(variable, bayesNet.ArrayFactor.fromFactor(net.getCPT(variable)))
+            storedTable = net.getCPT(variable).asArray().copy()
+
+            fetchedCPT = net.getCPT(variable)
+            assignmentDict = fetchedCPT.getAllPossibleAssignmentDicts()[0]
+            fetchedCPT.setProbability(assignmentDict, fetchedCPT.getProbability(assignmentDict) + 1.0)
+            if not np.array_equal(net.getCPT(variable).asArray(), storedTable):
+                self.addMessage('Changing the factor returned by getCPT changed the CPT stored for ' + variable)
+                return self.testFail(grades)
+
+            CPT = net.getCPT(variable)
+            probability = CPT.getProbability(assignmentDict)
+            copiedCPT = CPT.copy()
+            if not np.shares_memory(copiedCPT.asArray(), CPT.asArray()):
+                self.addMessage('The copy of the CPT of ' + variable + ' should share its table until it is written')
+                return self.testFail(grades)
+            copiedCPT.setProbability(assignmentDict, probability + 1.0)
+            if np.shares_memory(copiedCPT.asArray(), CPT.asArray()) or not np.array_equal(CPT.asArray(), storedTable):
+                self.addMessage('Writing to the copy of the CPT of ' + variable + ' changed the original')
+                return self.testFail(grades)
+            if copiedCPT.getProbability(assignmentDict) != probability + 1.0:
+                self.addMessage('Writing to the copy of the CPT of ' + variable + ' did not change the copy')
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks that the CPTs of a bayes net are copied on write\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class PosteriorTest(testClasses.TestCase):
+    """
+    Base class of the tests that answer the query of a bayes net problem
+    and check the answer against enumeratePosterior.  solveProblem returns
+    the answer as an array with one axis per variable of
+    sorted(queryVariables), or None when the evidence has probability 0.
+    """
+
+    def __init__(self, question, testDict):
+        super(PosteriorTest, self).__init__(question, testDict)
+        parseDict = parseBayesNetProblem(testDict)
+        self.queryVariables = parseDict['queryVariables']
+        self.evidenceDict = parseDict['evidenceDict']
+        self.problemBayesNet = parseDict['problemBayesNet']
+        self.tolerance = float(testDict.get('tolerance', '1e-9'))
+
+    def posteriorTable(self, factor, evidenceDict=None):
+        """
+        The probabilities of factor, an answer to the query given
+        evidenceDict (by default the problem's), as an array with one axis
+        per variable of sorted(queryVariables) (None stays None).
+        """
+        if factor is None:
+            return None
+        if evidenceDict is None:
+            evidenceDict = self.evidenceDict
+        domainsDict = self.problemBayesNet.variableDomainsDict()
+        queryVariables = sorted(self.queryVariables)
+        table = np.zeros([len(domainsDict[variable]) for variable in queryVariables])
+        for index in np.ndindex(*table.shape):
+            assignmentDict = dict(evidenceDict)
+            assignmentDict.update([(variable, domainsDict[variable][i]) for variable, i in zip(queryVariables, index)])
+            table[index] = factor.getProbability(assignmentDict)
+        return table
+
+    def evidenceAssignments(self):
+        " Every assignment of the problem's evidence variables, as a list of evidence dicts "
+        domainsDict = self.problemBayesNet.variableDomainsDict()
+        evidenceVariables = sorted(self.evidenceDict.keys())
+        return [dict(zip(evidenceVariables, values))
+                for values in itertools.product(*[domainsDict[variable] for variable in evidenceVariables])]
+
+    def checkPosterior(self, name, studentTable, goldTable):
+        " Whether studentTable is within tolerance of goldTable (or both are None); adds messages if not "
+        if goldTable is None or studentTable is None:
+            correct = goldTable is None and studentTable is None
+        else:
+            correct = np.abs(studentTable - goldTable).max() <= self.tolerance
+        if not correct:
+            self.addMessage(name + ' differs from the posterior by enumeration by more than ' + str(self.tolerance))
+            self.addMessage('Student answer:\n' + str(studentTable))
+            self.addMessage('Correct answer:\n' + str(goldTable))
+        return correct
+
+    def execute(self, grades, moduleDict, solutionDict):
+        goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, self.evidenceDict)
+        if not self.checkPosterior(self.answerName, self.solveProblem(moduleDict), goldTable):
+            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks %s against the posterior by enumeration\n' % self.answerName)
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class VariableEliminationPlanTest(PosteriorTest):
+    """
+    Compiles one VariableEliminationPlan for the query and the evidence
+    variables of the problem, and executes it for every assignment of the
+    evidence variables: each answer must match the posterior by
+    enumeration, and be None for evidence with probability 0.
+    """
+
+    def execute(self, grades, moduleDict, solutionDict):
+        plan = VariableEliminationPlan(self.problemBayesNet, self.queryVariables, self.evidenceDict.keys())
+        for evidenceDict in self.evidenceAssignments():
+            goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, evidenceDict)
+            studentTable = self.posteriorTable(plan.execute(evidenceDict), evidenceDict)
+            if not self.checkPosterior('The plan executed with ' + str(evidenceDict), studentTable, goldTable):
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks a compiled plan against the posterior by enumeration for every evidence assignment\n')
+        handle.close()
+        return True
+
+class EliminationOrderTest(testClasses.TestCase):
+    """
+    Checks the elimination order that greedyEliminationOrder builds with
+    heuristic for the variables that are neither queried nor observed,
+    and the (largest factor size, total table entries) that
+    eliminationOrderCost predicts for it and for the sorted order,
+    against the solution.  compareEliminationOrders must list the same
+    costs, cheapest first.
+    """
+
+    def __init__(self, question, testDict):
+        super(EliminationOrderTest, self).__init__(question, testDict)
+        parseDict = parseBayesNetProblem(testDict)
+        self.queryVariables = parseDict['queryVariables']
+        self.evidenceVariables = list(parseDict['evidenceDict'].keys())
+        self.problemBayesNet = parseDict['problemBayesNet']
+        self.heuristic = testDict['heuristic']
+
+    def solveProblem(self):
+        " The heuristic's order, its cost and the cost of the sorted order "
+        net = self.problemBayesNet
+        eliminationVariables = net.variablesSet() - set(self.queryVariables) - set(self.evidenceVariables)
+        order = greedyEliminationOrder(net, eliminationVariables, self.evidenceVariables, self.heuristic)
+        cost = eliminationOrderCost(net, order, self.evidenceVariables)
+        sortedCost = eliminationOrderCost(net, sorted(eliminationVariables), self.evidenceVariables)
+        return order, tuple(cost), tuple(sortedCost)
+
+    def execute(self, grades, moduleDict, solutionDict):
+        order, cost, sortedCost = self.solveProblem()
+        goldOrder = solutionDict['order'].split(' ')
+        goldCost, goldSortedCost = eval(solutionDict['cost']), eval(solutionDict['sortedCost'])
+        if order != goldOrder or cost != goldCost or sortedCost != goldSortedCost:
+            self.addMessage('Student %s order: %s, cost: %s, cost of the sorted order: %s' % (self.heuristic, order, cost, sortedCost))
+            self.addMessage('Correct %s order: %s, cost: %s, cost of the sorted order: %s' % (self.heuristic, goldOrder, goldCost, goldSortedCost))
+            return self.testFail(grades)
+
+        comparison = compareEliminationOrders(self.problemBayesNet, self.queryVariables, self.evidenceVariables)
+        costs = [(entry.largestFactorSize, entry.totalTableEntries) for entry in comparison]
+        heuristicCosts = dict([(entry.heuristic, (entry.largestFactorSize, entry.totalTableEntries)) for entry in comparison])
+        if costs != sorted(costs) or heuristicCosts.get(self.heuristic) != goldCost or heuristicCosts.get('sorted') != goldSortedCost:
+            self.addMessage('compareEliminationOrders should list the costs of every order, cheapest first, got: ' + str(comparison))
+            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        order, cost, sortedCost = self.solveProblem()
+        with open(filePath, 'w') as handle:
+            handle.write('# This is the solution file for %s.\n\n' % self.path)
+            handle.write('order: "%s"\n' % ' '.join(order))
+            handle.write('cost: "%s"\n' % str(cost))
+            handle.write('sortedCost: "%s"\n' % str(sortedCost))
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class CPTEvidenceBatchTest(testClasses.TestCase):
+    """
+    For every CPT of the bayes net and every evidence dict that assigns
+    each variable of evidenceDict either its value or nothing, checks the
+    factor from getCPTWithEvidenceBatch and the CPT specialized to the
+    reduced domains (specializeVariableDomains) against the factor
+    getCPTWithEvidence returns for that evidence dict alone: they must
+    have the same domains, and every entry must equal the entry of the
+    whole CPT.
+    """
+
+    def __init__(self, question, testDict):
+        super(CPTEvidenceBatchTest, self).__init__(question, testDict)
+        parseDict = parseBayesNetProblem(testDict)
+        self.evidenceDict = parseDict['evidenceDict']
+        self.problemBayesNet = parseDict['problemBayesNet']
+
+    def evidenceDicts(self):
+        " The evidence dicts with each evidence variable assigned its value or left out "
+        evidenceItems = sorted(self.evidenceDict.items())
+        return [dict([item for item, kept in zip(evidenceItems, keptItems) if kept])
+                for keptItems in itertools.product([False, True], repeat=len(evidenceItems))]
+
+    def execute(self, grades, moduleDict, solutionDict):
+        net = self.problemBayesNet
+        evidenceDicts = self.evidenceDicts()
+        for variable in sorted(net.variablesSet()):
+            CPT = net.getCPT(variable)
+            batchCPTs = net.getCPTWithEvidenceBatch(variable, evidenceDicts)
+            for evidenceDict, batchCPT in zip(evidenceDicts, batchCPTs):
+                rowCPT = net.getCPTWithEvidence(variable, evidenceDict)
+                specializedCPT = CPT.specializeVariableDomains(net.getReducedVariableDomains(evidenceDict))
+                for name, factor in [('getCPTWithEvidenceBatch', batchCPT), ('specializeVariableDomains', specializedCPT)]:
+                    if not self.sameEntries(factor, rowCPT, CPT):
+                        self.addMessage('The CPT of %s from %s for the evidence %s differs from getCPTWithEvidence' % \
+                                        (variable, name, evidenceDict))
+                        self.addMessage('Student factor:\n' + str(factor))
+                        self.addMessage('getCPTWithEvidence factor:\n' + str(rowCPT))
+                        return self.testFail(grades)
+        return self.testPass(grades)
+
+    def sameEntries(self, factor, rowCPT, CPT):
+        " Whether factor has the domains of rowCPT, and the entries of CPT for every assignment "
+        if sorted(factor.variables()) != sorted(rowCPT.variables()):
+            return False
+        for variable in rowCPT.variables():
+            if list(factor.variableDomainsDict()[variable]) != list(rowCPT.variableDomainsDict()[variable]):
+                return False
+        for assignmentDict in rowCPT.getAllPossibleAssignmentDicts():
+            probability = CPT.getProbability(assignmentDict)
+            if factor.getProbability(assignmentDict) != probability or rowCPT.getProbability(assignmentDict) != probability:
+                return False
+        return True
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks batched and specialized CPTs against getCPTWithEvidence\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class PrunedInferenceTest(PosteriorTest):
+    """
+    Answers the query with inferenceByEnumeration and
+    inferenceByVariableElimination on the pruned bayes net (prune=True),
+    and checks both answers against the posterior by enumeration on the
+    whole bayes net.
+    """
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        net, queryVariables, evidenceDict = self.problemBayesNet, self.queryVariables, self.evidenceDict
+        goldTable = enumeratePosterior(net, queryVariables, evidenceDict)
+        answers = [('Pruned inferenceByEnumeration',
+                    inferenceModule.inferenceByEnumeration(net, queryVariables, evidenceDict, prune=True)),
+                   ('Pruned inferenceByVariableElimination',
+                    inferenceModule.inferenceByVariableElimination(net, queryVariables, evidenceDict, None, prune=True))]
+        for name, factor in answers:
+            if not self.checkPosterior(name, self.posteriorTable(factor), goldTable):
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks pruned inference against the posterior by enumeration\n')
+        handle.close()
+        return True
+
+class LogFactorOperationsTest(PosteriorTest):
+    """
+    Runs the steps of variable elimination for the query both on the CPTs
+    and on LogFactors made from them: joinFactors of the CPTs with the
+    evidence, eliminate of every variable that is neither queried nor
+    observed, and normalize.  After every step the log-space result must
+    be a LogFactor with the probabilities of the linear one.  The answers
+    of inferenceByEnumeration and inferenceByVariableElimination with
+    logSpace=True must match the posterior by enumeration.
+    """
+
+    def execute(self, grades, moduleDict, solutionDict):
+        factorOperationsModule = moduleDict['factorOperations']
+        inferenceModule = moduleDict['inference']
+        net, queryVariables, evidenceDict = self.problemBayesNet, self.queryVariables, self.evidenceDict
+
+        factors = net.getAllCPTsWithEvidence(evidenceDict)
+        logFactors = [bayesNet.LogFactor.fromFactor(factor) for factor in factors]
+        steps = [('LogFactor.fromFactor', factor, logFactor) for factor, logFactor in zip(factors, logFactors)]
+        joined = factorOperationsModule.joinFactors(factors)
+        logJoined = factorOperationsModule.joinFactors(logFactors)
+        steps.append(('joinFactors', joined, logJoined))
+        for variable in sorted(net.variablesSet() - set(queryVariables) - set(evidenceDict.keys())):
+            joined = factorOperationsModule.eliminate(joined, variable)
+            logJoined = factorOperationsModule.eliminate(logJoined, variable)
+            steps.append(('eliminate ' + variable, joined, logJoined))
+        steps.append(('normalize', bayesNet.normalize(joined), bayesNet.normalize(logJoined)))
+        for name, factor, logFactor in steps:
+            if not isinstance(logFactor, bayesNet.LogFactor) or not self.sameProbabilities(factor, logFactor):
+                self.addMessage('In log space, %s should give a LogFactor with the probabilities of the linear factor' % name)
+                self.addMessage('Linear factor:\n' + str(factor))
+                self.addMessage('Log-space factor:\n' + str(logFactor))
+                return self.testFail(grades)
+
+        goldTable = enumeratePosterior(net, queryVariables, evidenceDict)
+        answers = [('inferenceByEnumeration with logSpace=True',
+                    inferenceModule.inferenceByEnumeration(net, queryVariables, evidenceDict, logSpace=True)),
+                   ('inferenceByVariableElimination with logSpace=True',
+                    inferenceModule.inferenceByVariableElimination(net, queryVariables, evidenceDict, None, logSpace=True))]
+        for name, factor in answers:
+            if not self.checkPosterior(name, self.posteriorTable(factor), goldTable):
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def sameProbabilities(self, factor, logFactor):
+        " Whether the two factors give the same probabilities, up to rounding, for every assignment of factor "
+        for assignmentDict in factor.getAllPossibleAssignmentDicts():
+            if not np.isclose(factor.getProbability(assignmentDict), logFactor.getProbability(assignmentDict),
+                              rtol=1e-9, atol=1e-15):
+                return False
+        return True
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks factor operations on LogFactors against the same operations on linear factors\n')
+        handle.close()
+        return True
+
+class SparseFactorEliminationTest(PosteriorTest):
+    """
+    Stores the CPTs of the bayes net as SparseFactors, by lowering the
+    thresholds of bayesNet.chooseFactorStorage for the duration of the
+    test so that every CPT and every factor built from them is sparse.
+    Checks that the CPTs are SparseFactors, and the answer of
+    inferenceByVariableElimination on them against the posterior by
+    enumeration.
+    """
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, self.evidenceDict)
+        sparseFillRatio, sparseMinSize = bayesNet.SPARSE_FILL_RATIO, bayesNet.SPARSE_MIN_SIZE
+        bayesNet.SPARSE_FILL_RATIO, bayesNet.SPARSE_MIN_SIZE = 1.0, 0
+        try:
+            sparseNet = self.copiedBayesNet()
+            for variable in sorted(sparseNet.variablesSet()):
+                if not isinstance(sparseNet.getCPT(variable), bayesNet.SparseFactor):
+                    self.addMessage('The CPT of ' + variable + ' should be stored as a SparseFactor')
+                    return self.testFail(grades)
+            studentTable = self.posteriorTable(inferenceModule.inferenceByVariableElimination(
+                sparseNet, self.queryVariables, self.evidenceDict, None))
+        finally:
+            bayesNet.SPARSE_FILL_RATIO, bayesNet.SPARSE_MIN_SIZE = sparseFillRatio, sparseMinSize
+        if not self.checkPosterior('inferenceByVariableElimination on SparseFactors', studentTable, goldTable):
+            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def copiedBayesNet(self):
+        " A new bayes net with the problem's structure, whose CPTs are stored again by setCPT "
+        net = self.problemBayesNet
+        inEdges = net.inEdges()
+        copiedNet = bayesNet.constructEmptyBayesNet(sorted(net.variablesSet()),
+                                                    [(parent, variable) for variable in sorted(net.variablesSet())
+                                                     for parent in inEdges[variable]],
+                                                    net.variableDomainsDict())
+        for variable in net.variablesSet():
+            copiedNet.setCPT(variable, net.getCPT(variable))
+        return copiedNet
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks variable elimination on SparseFactors against the posterior by enumeration\n')
+        handle.close()
+        return True
+
+class VariableEliminationBatchTest(PosteriorTest):
+    """
+    Answers the query for every assignment of the evidence variables of
+    the problem with one call to inferenceByVariableEliminationBatch, and
+    checks each row against the posterior by enumeration; the rows for
+    evidence with probability 0 must be NaN.  An empty batch, given as an
+    empty list of evidence dicts or as empty value columns, must give an
+    array with no rows.
+    """
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        evidenceDicts = self.evidenceAssignments()
+        tables = inferenceModule.inferenceByVariableEliminationBatch(self.problemBayesNet, self.queryVariables, evidenceDicts)
+        if len(tables) != len(evidenceDicts):
+            self.addMessage('Expected %d rows in the batch, got %d' % (len(evidenceDicts), len(tables)))
+            return self.testFail(grades)
+        for evidenceDict, table in zip(evidenceDicts, tables):
+            goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, evidenceDict)
+            studentTable = None if np.isnan(table).any() else table
+            if not self.checkPosterior('The row of the batch for ' + str(evidenceDict), studentTable, goldTable):
+                return self.testFail(grades)
+
+        shape = (0,) + tables.shape[1:]
+        plan = VariableEliminationPlan(self.problemBayesNet, self.queryVariables, self.evidenceDict.keys())
+        emptyBatches = [('An empty list of evidence dicts',
+                         inferenceModule.inferenceByVariableEliminationBatch(self.problemBayesNet, self.queryVariables, [])),
+                        ('Empty evidence value columns',
+                         plan.executeBatch(dict([(variable, []) for variable in self.evidenceDict])))]
+        for name, emptyTables in emptyBatches:
+            if emptyTables.shape != shape:
+                self.addMessage('%s should give an array of shape %s, got %s' % (name, shape, emptyTables.shape))
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks every row of a batch against the posterior by enumeration\n')
+        handle.close()
+        return True
+
+class LogSpaceUnderflowTest(PosteriorTest):
+    """
+    Builds a bayes net X -> E1, ..., En with a uniform X, where
+    evidenceProbabilities gives P(Ei = e1 | X = x0) and
+    P(Ei = e1 | X = x1), and queries X given every Ei = e1.  For a large
+    n the probability of the evidence underflows to 0.0 in linear space.
+    The answers of inferenceByEnumeration and
+    inferenceByVariableElimination with logSpace=True must match the
+    closed-form posterior, and so must the linear answers when the
+    evidence does not underflow.
+    """
+
+    def __init__(self, question, testDict):
+        testClasses.TestCase.__init__(self, question, testDict)
+        self.numEvidenceVariables = int(testDict['numEvidenceVariables'])
+        self.evidenceProbabilities = [float(probability) for probability in testDict['evidenceProbabilities'].split()]
+        self.tolerance = float(testDict.get('tolerance', '1e-9'))
+        evidenceVariables = ['E%d' % i for i in range(1, self.numEvidenceVariables + 1)]
+        variableDomainsDict = dict([(variable, ['e0', 'e1']) for variable in evidenceVariables])
+        variableDomainsDict['X'] = ['x0', 'x1']
+
+        self.problemBayesNet = bayesNet.constructEmptyBayesNet(['X'] + evidenceVariables,
+                                                               [('X', variable) for variable in evidenceVariables],
+                                                               variableDomainsDict)
+        prior = bayesNet.Factor(['X'], [], variableDomainsDict)
+        prior.setProbability({'X': 'x0'}, 0.5)
+        prior.setProbability({'X': 'x1'}, 0.5)
+        self.problemBayesNet.setCPT('X', prior)
+        for variable in evidenceVariables:
+            CPT = bayesNet.Factor([variable], ['X'], variableDomainsDict)
+            for x, probability in zip(['x0', 'x1'], self.evidenceProbabilities):
+                CPT.setProbability({'X': x, variable: 'e1'}, probability)
+                CPT.setProbability({'X': x, variable: 'e0'}, 1.0 - probability)
+            self.problemBayesNet.setCPT(variable, CPT)
+        self.queryVariables = ['X']
+        self.evidenceDict = dict([(variable, 'e1') for variable in evidenceVariables])
+
+    def closedFormPosterior(self):
+        " P(X | every Ei = e1), worked out from the ratio of the evidence probabilities "
+        p0, p1 = self.evidenceProbabilities
+        oddsOfX0 = np.exp(self.numEvidenceVariables * (np.log(p0) - np.log(p1)))
+        return np.array([oddsOfX0, 1.0]) / (1.0 + oddsOfX0)
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        net, queryVariables, evidenceDict = self.problemBayesNet, self.queryVariables, self.evidenceDict
+        goldTable = self.closedFormPosterior()
+        answers = [('inferenceByEnumeration with logSpace=True',
+                    inferenceModule.inferenceByEnumeration(net, queryVariables, evidenceDict, logSpace=True)),
+                   ('inferenceByVariableElimination with logSpace=True',
+                    inferenceModule.inferenceByVariableElimination(net, queryVariables, evidenceDict, None, logSpace=True))]
+        if max(self.evidenceProbabilities) ** self.numEvidenceVariables > 0:
+            answers += [('inferenceByEnumeration', inferenceModule.inferenceByEnumeration(net, queryVariables, evidenceDict)),
+                        ('inferenceByVariableElimination',
+                         inferenceModule.inferenceByVariableElimination(net, queryVariables, evidenceDict, None))]
+        for name, factor in answers:
+            if not self.checkPosterior(name, self.posteriorTable(factor), goldTable):
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks log-space inference against the closed-form posterior\n')
+        handle.close()
+        return True
+
+class JunctionTreeTest(PosteriorTest):
+    """
+    Calibrates a JunctionTree of the bayes net with the evidence of the
+    problem, and checks its answer to the query against the posterior by
+    enumeration.
+    """
+
+    answerName = 'The junction tree'
+
+    def solveProblem(self, moduleDict):
+        tree = JunctionTree(self.problemBayesNet).calibrate(self.evidenceDict)
+        return self.posteriorTable(tree.query(self.queryVariables))
+
+class JunctionTreeEvidenceTest(PosteriorTest):
+    """
+    Calibrates a junction tree without evidence, then changes its evidence
+    one variable at a time with the steps in evidenceSequence, one per
+    line: "absorb variable : value" or "retract variable".  After every
+    step the answer of the tree to the query is checked against the
+    posterior by enumeration with the evidence entered so far.
+    """
+
+    def __init__(self, question, testDict):
+        super(JunctionTreeEvidenceTest, self).__init__(question, testDict)
+        self.evidenceSequence = [line.split() for line in testDict['evidenceSequence'].strip().split('\n')]
+
+    def execute(self, grades, moduleDict, solutionDict):
+        tree = JunctionTree(self.problemBayesNet).calibrate()
+        evidenceDict = {}
+        for step in self.evidenceSequence:
+            if step[0] == 'absorb':
+                tree.absorbEvidence(step[1], step[3])
+                evidenceDict[step[1]] = step[3]
+            elif step[0] == 'retract':
+                tree.retractEvidence(step[1])
+                del evidenceDict[step[1]]
+            else:
+                raise Exception("[JunctionTreeEvidenceTest] Unknown evidence step: " + ' '.join(step))
+            goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, evidenceDict)
+            studentTable = self.posteriorTable(tree.query(self.queryVariables), evidenceDict)
+            if not self.checkPosterior('The junction tree after ' + ' '.join(step), studentTable, goldTable):
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks a junction tree against the posterior by enumeration as its evidence changes\n')
+        handle.close()
+        return True
+
+class LikelihoodWeightingTest(PosteriorTest):
+    """
+    Answers the query with inferenceByLikelihoodWeightingSampling drawing
+    numSamples samples from a numpy generator seeded with seed, and checks
+    the answer against the posterior by enumeration within tolerance.
+    """
+
+    answerName = 'Seeded likelihood weighting'
+
+    def __init__(self, question, testDict):
+        super(LikelihoodWeightingTest, self).__init__(question, testDict)
+        self.seed = int(testDict.get('seed', '188'))
+        self.numSamples = int(testDict['numSamples'])
+
+    def solveProblem(self, moduleDict):
+        inferenceModule = moduleDict['inference']
+        inferenceFunction = inferenceModule.inferenceByLikelihoodWeightingSamplingRandomSource(
+            np.random.default_rng(self.seed))
+        return self.posteriorTable(inferenceFunction(self.problemBayesNet, self.queryVariables, self.evidenceDict,
+                                                     self.numSamples))
+
+class GibbsSamplingTest(PosteriorTest):
+    """
+    Runs a GibbsSampler seeded with seed for numSamples samples per chain,
+    and checks its estimate against the posterior by enumeration within
+    tolerance (both are None when the evidence has probability 0).  With
+    targetEffectiveSampleSize, the run must also have stopped early, with
+    at least that effective sample size.
+    """
+
+    def __init__(self, question, testDict):
+        super(GibbsSamplingTest, self).__init__(question, testDict)
+        self.seed = int(testDict.get('seed', '188'))
+        self.numSamples = int(testDict['numSamples'])
+        self.targetEffectiveSampleSize = None
+        if 'targetEffectiveSampleSize' in testDict:
+            self.targetEffectiveSampleSize = float(testDict['targetEffectiveSampleSize'])
+
+    def execute(self, grades, moduleDict, solutionDict):
+        goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, self.evidenceDict)
+        sampler = GibbsSampler(self.problemBayesNet, self.queryVariables, self.evidenceDict)
+        estimate = sampler.run(self.numSamples, seed=self.seed, targetEffectiveSampleSize=self.targetEffectiveSampleSize)
+        studentTable = None if estimate is None else self.posteriorTable(estimate.posterior)
+        if not self.checkPosterior('GibbsSampler', studentTable, goldTable):
+            return self.testFail(grades)
+        if estimate is not None and self.targetEffectiveSampleSize is not None:
+            if estimate.numSamples >= self.numSamples or estimate.effectiveSampleSize < self.targetEffectiveSampleSize:
+                self.addMessage('GibbsSampler should stop once the effective sample size reaches ' + \
+                                str(self.targetEffectiveSampleSize) + ', but it kept ' + str(estimate.numSamples) + \
+                                ' of ' + str(self.numSamples) + ' samples per chain with an effective sample size of ' + \
+                                str(estimate.effectiveSampleSize))
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks a seeded GibbsSampler against the posterior by enumeration\n')
+        handle.close()
+        return True
+
+class FactorSamplerTest(testClasses.TestCase):
+    """
+    Samples every CPT of the bayes net with one FactorSampler, so that it
+    caches a table for each, then replaces the CPT with setCPT by one that
+    always gives the last value of its variable: the samples from the new
+    CPT must all take that value.  Then writes the CPT returned by getCPT
+    in place, after sampling it, so that it always gives the first value:
+    the samples must follow the write.
+    """
+
+    def __init__(self, question, testDict):
+        super(FactorSamplerTest, self).__init__(question, testDict)
+        self.problemBayesNet = parseBayesNetProblem(testDict)['problemBayesNet']
+        self.seed = int(testDict.get('seed', '188'))
+        self.numSamples = int(testDict.get('numSamples', '50'))
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        net = self.problemBayesNet
+        sampler = inferenceModule.FactorSampler(random.Random(self.seed))
+        for variable in sorted(net.variablesSet()):
+            domain = net.variableDomainsDict()[variable]
+            CPT = net.getCPT(variable)
+            for conditionedAssignments in self.conditionedAssignmentDicts(CPT):
+                sampler.sampleMany(CPT, self.numSamples, conditionedAssignments)
+
+            net.setCPT(variable, self.deterministicCPT(CPT, variable, domain[-1]))
+            if not self.samplesTake(sampler, net.getCPT(variable), variable, domain[-1]):
+                self.addMessage('After setCPT, the samples of ' + variable + ' should all be ' + str(domain[-1]))
+                return self.testFail(grades)
+
+            CPT = net.getCPT(variable)
+            for conditionedAssignments in self.conditionedAssignmentDicts(CPT):
+                sampler.sampleMany(CPT, self.numSamples, conditionedAssignments)
+            for assignmentDict in CPT.getAllPossibleAssignmentDicts():
+                CPT.setProbability(assignmentDict, 1.0 if assignmentDict[variable] == domain[0] else 0.0)
+            if not self.samplesTake(sampler, CPT, variable, domain[0]):
+                self.addMessage('After writing the CPT of ' + variable + ' in place, its samples should all be ' + \
+                                str(domain[0]))
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def conditionedAssignmentDicts(self, CPT):
+        " Every assignment of the conditioned variables of CPT "
+        conditionedVariables = sorted(CPT.conditionedVariables())
+        domainsDict = CPT.variableDomainsDict()
+        return [dict(zip(conditionedVariables, values))
+                for values in itertools.product(*[domainsDict[variable] for variable in conditionedVariables])]
+
+    def deterministicCPT(self, CPT, variable, value):
+        " A CPT like CPT, in which variable takes value with probability 1 "
+        deterministicCPT = bayesNet.Factor(CPT.unconditionedVariables(), CPT.conditionedVariables(),
+                                           CPT.variableDomainsDict())
+        for assignmentDict in deterministicCPT.getAllPossibleAssignmentDicts():
+            deterministicCPT.setProbability(assignmentDict, 1.0 if assignmentDict[variable] == value else 0.0)
+        return deterministicCPT
+
+    def samplesTake(self, sampler, CPT, variable, value):
+        " Whether every sample of variable from every row of CPT is value "
+        for conditionedAssignments in self.conditionedAssignmentDicts(CPT):
+            for sample in sampler.sampleMany(CPT, self.numSamples, conditionedAssignments):
+                if sample[variable] != value:
+                    return False
+        return True
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks that a FactorSampler follows changes to the factors it has sampled\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class AncestralSamplingTest(PosteriorTest):
+    """
+    Draws numSamples samples from the prior of the bayes net with
+    ancestralSamples and a numpy generator seeded with seed, and keeps
+    the ones that match the evidence (rejection sampling).  Their
+    frequencies are samples from the posterior, and must be within
+    tolerance of the posterior by enumeration; there is no answer when no
+    sample matches.
+    """
+
+    answerName = 'The frequencies of the ancestral samples'
+
+    def __init__(self, question, testDict):
+        super(AncestralSamplingTest, self).__init__(question, testDict)
+        self.seed = int(testDict.get('seed', '188'))
+        self.numSamples = int(testDict['numSamples'])
+
+    def solveProblem(self, moduleDict):
+        inferenceModule = moduleDict['inference']
+        net = self.problemBayesNet
+        samples = inferenceModule.ancestralSamples(net, self.numSamples, np.random.default_rng(self.seed))
+        domainsDict = net.variableDomainsDict()
+        for variable, value in self.evidenceDict.items():
+            samples = samples[samples[variable] == domainsDict[variable].index(value)]
+        if len(samples) == 0:
+            return None
+        queryVariables = sorted(self.queryVariables)
+        shape = [len(domainsDict[variable]) for variable in queryVariables]
+        codes = np.ravel_multi_index(tuple([samples[variable].astype(np.intp) for variable in queryVariables]), shape)
+        return np.bincount(codes, minlength=int(np.prod(shape))).reshape(shape) / len(samples)
+
+class MaxProductTest(PosteriorTest):
+    """
+    Checks the assignment from inferenceByMaxProductVariableElimination
+    against the posterior by enumeration: it must assign the query
+    variables a value of largest posterior probability, within tolerance
+    (both are None when the evidence has probability 0).  With
+    mpe: "True" the query variables are every unobserved variable and
+    the MPE assignment (queryVariables=None) is checked.
+    """
+
+    def __init__(self, question, testDict):
+        super(MaxProductTest, self).__init__(question, testDict)
+        self.mpe = testDict.get('mpe', 'False') == 'True'
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        goldTable = enumeratePosterior(self.problemBayesNet, self.queryVariables, self.evidenceDict)
+        assignment = inferenceModule.inferenceByMaxProductVariableElimination(
+            self.problemBayesNet, self.evidenceDict, None if self.mpe else self.queryVariables)
+        if goldTable is None or assignment is None:
+            correct = goldTable is None and assignment is None
+        elif sorted(assignment.keys()) != sorted(self.queryVariables):
+            correct = False
+        else:
+            domainsDict = self.problemBayesNet.variableDomainsDict()
+            index = tuple([domainsDict[variable].index(assignment[variable]) for variable in sorted(self.queryVariables)])
+            correct = goldTable[index] >= goldTable.max() - self.tolerance
+        if not correct:
+            self.addMessage('inferenceByMaxProductVariableElimination returned ' + str(assignment) + \
+                            ', which is not a most likely assignment of ' + str(sorted(self.queryVariables)))
+            self.addMessage('Posterior by enumeration:\n' + str(goldTable))
+            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks a max-product assignment against the posterior by enumeration\n')
+        handle.close()
+        return True
+
+class PositionDistributionTest(testClasses.TestCase):
+    """
+    Runs every dict method against a PositionDistribution over positions,
+    starting from an empty one, and checks after each call that the
+    positions of the index stay keys backed by the weight vector: len,
+    total and asArray must agree with the weights written so far.
+    """
+
+    def __init__(self, question, testDict):
+        super(PositionDistributionTest, self).__init__(question, testDict)
+        self.positions = eval(testDict['positions'])
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        distribution = inferenceModule.PositionDistribution(inferenceModule.positionIndexFor(self.positions))
+        for correct, description in self.checks(distribution, inferenceModule):
+            if not correct:
+                self.addMessage('Check failed: ' + description)
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def checks(self, d, inferenceModule):
+        """
+        Generates (correct, description) for every check, calling the
+        dict methods of d in between; it expects three positions, the
+        first three of (1, 1), (1, 2) and (2, 2) below.
+        """
+        a, b, c = self.positions
+        yield len(d) == 3 and d.total() == 0.0, 'an empty distribution has every position as a key, with weight 0'
+        d.update({a: 0.5, b: 0.5})
+        yield d[a] == 0.5 and d[b] == 0.5 and d.asArray().tolist() == [0.5, 0.5, 0.0], 'update with a dict'
+        yield d.total() == 1.0 and len(d) == 3, 'update with a dict adds no keys'
+        d.update([(c, 0.25)], **{})
+        yield d.asArray().tolist() == [0.5, 0.5, 0.25] and len(d) == 3, 'update with a list of items'
+        outside = (0, 0)
+        yield d[outside] == 0 and outside not in d and len(d) == 3, 'reading a position outside the index'
+        yield d.setdefault(a, 7.0) == 0.5 and d[a] == 0.5, 'setdefault of a position with a weight'
+        yield d.pop(a) == 0.5 and d[a] == 0.0 and a in d and d.total() == 0.75, 'pop keeps the position, with weight 0'
+        yield d.pop(outside, 'missing') == 'missing', 'pop of a position outside the index'
+        del d[b]
+        yield d[b] == 0.0 and d.total() == 0.25 and len(d) == 3, 'del keeps the position, with weight 0'
+        d[(5, 5)] = 1.0
+        yield d.total() == 1.25 and len(d) == 4 and d.argMax() == (5, 5), 'setting a position outside the index'
+        yield d.popitem() == ((5, 5), 1.0) and len(d) == 3, 'popitem of the position outside the index'
+        yield d.popitem() == (c, 0.25) and d.total() == 0.0, 'popitem of the last position with a weight'
+        d |= {b: 2.0}
+        yield isinstance(d, inferenceModule.PositionDistribution) and d.asArray().tolist() == [0.0, 2.0, 0.0], \
+            '|= with a dict'
+        e = d | {c: 1.0}
+        yield e.asArray().tolist() == [0.0, 2.0, 1.0] and d.asArray().tolist() == [0.0, 2.0, 0.0], \
+            '| with a dict leaves the distribution as it was'
+        d.clear()
+        yield d.total() == 0.0 and len(d) == 3 and dict(d.items()) == {a: 0.0, b: 0.0, c: 0.0}, \
+            'clear keeps every position, with weight 0'
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks the dict methods of a PositionDistribution\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class ResamplingTest(testClasses.TestCase):
+    """
+    Resamples a DiscreteDistribution over positions with the given
+    weights, numSamples keys at a time, with every method and seeds
+    0 to numSeeds - 1.  Every resample must have numSamples keys and
+    leave the distribution as it was.  With systematic resampling a key
+    of expected count c is picked floor(c) or ceil(c) times, and with
+    stratified resampling at most one time fewer or more.  Resampling
+    shortfallSamples keys from shortfallWeights, with uniform draws just
+    below 1, must not drop a key to rounding either.  Finally a
+    ParticleFilter of numParticles particles on the layout must still
+    have numParticles particles after observing observation.
+    """
+
+    def __init__(self, question, testDict):
+        super(ResamplingTest, self).__init__(question, testDict)
+        self.positions = eval(testDict['positions'])
+        self.weights = [float(weight) for weight in testDict['weights'].split()]
+        self.numSamples = int(testDict['numSamples'])
+        self.numSeeds = int(testDict['numSeeds'])
+        self.shortfallWeights = [float(weight) for weight in testDict['shortfallWeights'].split()]
+        self.shortfallSamples = int(testDict['shortfallSamples'])
+        self.layoutText = testDict['layout']
+        self.numParticles = int(testDict['numParticles'])
+        self.observation = int(testDict['observation'])
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        distribution = inferenceModule.DiscreteDistribution(zip(self.positions, self.weights))
+        total = distribution.total()
+        expectedCounts = [self.numSamples * weight / total for weight in self.weights]
+        for method in ['multinomial', 'stratified', 'systematic']:
+            for seed in range(self.numSeeds):
+                samples = distribution.resample(self.numSamples, method, np.random.default_rng(seed))
+                if len(samples) != self.numSamples or distribution.total() != total:
+                    self.addMessage('%s resampling with seed %d should give %d keys and leave the distribution as it was' % \
+                                    (method, seed, self.numSamples))
+                    return self.testFail(grades)
+                if method == 'multinomial':
+                    continue
+                slack = 0 if method == 'systematic' else 1
+                for position, expectedCount in zip(self.positions, expectedCounts):
+                    count = samples.count(position)
+                    if count < np.floor(expectedCount) - slack or count > np.ceil(expectedCount) + slack:
+                        self.addMessage('%s resampling with seed %d picked %s %d times, expected about %f' % \
+                                        (method, seed, position, count, expectedCount))
+                        return self.testFail(grades)
+
+        distribution = inferenceModule.DiscreteDistribution(zip(self.positions, self.shortfallWeights))
+        for method in ['stratified', 'systematic']:
+            samples = distribution.resample(self.shortfallSamples, method, NearlyOneRandomSource())
+            if len(samples) != self.shortfallSamples:
+                self.addMessage('%s resampling with uniform draws just below 1 should give %d keys, it gave %d' % \
+                                (method, self.shortfallSamples, len(samples)))
+                return self.testFail(grades)
+
+        state = busters.GameState()
+        state.initialize(layout.Layout([row.strip() for row in self.layoutText.strip().split('\n')]), 1)
+        particleFilter = inferenceModule.ParticleFilter(SeededRandomGhostAgent(1), self.numParticles)
+        particleFilter.initialize(state)
+        random.seed(188)
+        particleFilter.observeUpdate(self.observation, state)
+        if len(particleFilter.particles) != self.numParticles:
+            self.addMessage('The particle filter should keep %d particles, it has %d' % \
+                            (self.numParticles, len(particleFilter.particles)))
+            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks the number and the spread of resampled keys\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class NearlyOneRandomSource:
+    " A random source whose uniform draws are all the largest float below 1 "
+
+    def random(self):
+        return 1 - 2 ** -53
+
+class DiscreteDistributionCacheTest(testClasses.TestCase):
+    """
+    Reads total, argMax and entropy of a DiscreteDistribution made from
+    items, so that they are cached, then changes it with each dict method
+    and normalize in turn.  After every change the three must match the
+    ones of a new distribution with the same items.
+    """
+
+    def __init__(self, question, testDict):
+        super(DiscreteDistributionCacheTest, self).__init__(question, testDict)
+        self.items = eval(testDict['items'])
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        distribution = inferenceModule.DiscreteDistribution(self.items)
+        changes = [('__setitem__ of a new key', lambda d: d.__setitem__('new', 10.0)),
+                   ('__setitem__ of a key', lambda d: d.__setitem__('new', 0.5)),
+                   ('normalize', lambda d: d.normalize()),
+                   ('update', lambda d: d.update({'new': 4.0, 'other': 0.25})),
+                   ('setdefault of a new key', lambda d: d.setdefault('unseen', 20.0)),
+                   ('pop', lambda d: d.pop('unseen')),
+                   ('__delitem__', lambda d: d.__delitem__('new')),
+                   ('popitem', lambda d: d.popitem()),
+                   ('|=', lambda d: d.__ior__({'merged': 30.0})),
+                   ('clear', lambda d: d.clear())]
+        for name, change in changes:
+            self.aggregates(distribution)
+            change(distribution)
+            studentAggregates = self.aggregates(distribution)
+            goldAggregates = self.aggregates(inferenceModule.DiscreteDistribution(dict(distribution)))
+            if studentAggregates[:2] != goldAggregates[:2] or not np.isclose(studentAggregates[2], goldAggregates[2]):
+                self.addMessage('After %s, total, argMax and entropy should be %s, got %s' % \
+                                (name, goldAggregates, studentAggregates))
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def aggregates(self, distribution):
+        return distribution.total(), distribution.argMax(), distribution.entropy()
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks the cached aggregates of a DiscreteDistribution after every change\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class AliasSamplerTest(testClasses.TestCase):
+    """
+    Builds an AliasSampler for a DiscreteDistribution made from items.
+    The probability its thresholds and aliases give each key must be the
+    normalized value of the key, up to rounding, and the frequencies of
+    numSamples draws from a numpy generator seeded with seed must be
+    within tolerance of it.
+    """
+
+    def __init__(self, question, testDict):
+        super(AliasSamplerTest, self).__init__(question, testDict)
+        self.items = eval(testDict['items'])
+        self.numSamples = int(testDict['numSamples'])
+        self.seed = int(testDict.get('seed', '188'))
+        self.tolerance = float(testDict['tolerance'])
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        distribution = inferenceModule.DiscreteDistribution(self.items)
+        sampler = inferenceModule.AliasSampler(distribution)
+        total = distribution.total()
+        goldProbabilities = dict([(key, value / total) for key, value in self.items])
+
+        # a slot keeps its own key below its threshold, and takes its alias above it
+        numSlots = len(sampler.keys)
+        slotProbabilities = dict([(key, 0.0) for key, value in self.items])
+        for slot, key in enumerate(sampler.keys):
+            slotProbabilities[key] += sampler.thresholds[slot] / numSlots
+            slotProbabilities[sampler.keys[sampler.aliases[slot]]] += (1.0 - sampler.thresholds[slot]) / numSlots
+        for key, probability in goldProbabilities.items():
+            if abs(slotProbabilities[key] - probability) > 1e-12:
+                self.addMessage('The thresholds and aliases give %s probability %f, expected %f' % \
+                                (key, slotProbabilities[key], probability))
+                return self.testFail(grades)
+
+        samples = sampler.sampleMany(self.numSamples, np.random.default_rng(self.seed))
+        for key, probability in goldProbabilities.items():
+            frequency = samples.count(key) / float(self.numSamples)
+            if abs(frequency - probability) > self.tolerance:
+                self.addMessage('%s was drawn with frequency %f, expected %f' % (key, frequency, probability))
+                return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks an AliasSampler against the distribution it was built from\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
+class TransitionMatrixTest(testClasses.TestCase):
+    """
+    Tracks a GoSouthAgent ghost on the layout with two ExactInference
+    modules, one of which has no transition matrix, so that its
+    elapseTime takes the per-position path.  After every elapseTime and
+    every observeUpdate of each observation, the beliefs of the two must
+    agree at every position, and the module with the matrix must have
+    cached one matrix for Pacman's position.
+    """
+
+    def __init__(self, question, testDict):
+        super(TransitionMatrixTest, self).__init__(question, testDict)
+        self.layoutText = testDict['layout']
+        self.observations = [int(observation) for observation in testDict['observations'].split()]
+
+    def execute(self, grades, moduleDict, solutionDict):
+        inferenceModule = moduleDict['inference']
+        state = busters.GameState()
+        state.initialize(layout.Layout([row.strip() for row in self.layoutText.strip().split('\n')]), 1)
+        matrixModule = inferenceModule.ExactInference(GoSouthAgent(1))
+        fallbackModule = inferenceModule.ExactInference(GoSouthAgent(1))
+        fallbackModule.transitionMatrix = lambda gameState: None
+        for module in [matrixModule, fallbackModule]:
+            module.initialize(state)
+
+        for observation in self.observations:
+            for step in ['elapseTime', 'observeUpdate of ' + str(observation)]:
+                for module in [matrixModule, fallbackModule]:
+                    if step == 'elapseTime':
+                        module.elapseTime(state)
+                    else:
+                        module.observeUpdate(observation, state)
+                matrixBeliefs = matrixModule.getBeliefDistribution()
+                fallbackBeliefs = fallbackModule.getBeliefDistribution()
+                for position in matrixModule.positionIndex.positions:
+                    if abs(matrixBeliefs[position] - fallbackBeliefs[position]) > 1e-12:
+                        self.addMessage('After %s, the belief in %s is %f with the transition matrix and %f without' % \
+                                        (step, position, matrixBeliefs[position], fallbackBeliefs[position]))
+                        return self.testFail(grades)
+        if len(matrixModule.transitionMatrices) != 1:
+            self.addMessage('ExactInference should cache one transition matrix for Pacman\'s position, it has %d' % \
+                            len(matrixModule.transitionMatrices))
+            return self.testFail(grades)
+        return self.testPass(grades)
+
+    def writeSolution(self, moduleDict, filePath):
+        handle = open(filePath, 'w')
+        handle.write('# This test checks the transition matrix path of ExactInference against the per-position path\n')
+        handle.close()
+        return True
+
+    def createPublicVersion(self):
+        pass
+
 class MostLikelyFoodHousePositionTest(testClasses.TestCase):
 
     def __init__(self, question, testDict):
@@ -561,6 +1658,31 @@ def parseBayesNetProblem(testDict):
 
     return parseDict
 
+def enumeratePosterior(bayesNet, queryVariables, evidenceDict):
+    """
+    Returns P(queryVariables | evidenceDict) as an array with one axis per
+    variable of sorted(queryVariables), or None if the evidence has
+    probability 0.  Every full assignment consistent with the evidence is
+    enumerated and the product of its CPT entries is added up, without
+    any of the inference code being tested, so it is only meant for the
+    small bayes nets of the tests.
+    """
+    domainsDict = bayesNet.variableDomainsDict()
+    variables = sorted(bayesNet.variablesSet())
+    queryVariables = sorted(queryVariables)
+    CPTs = [bayesNet.getCPT(variable) for variable in variables]
+    table = np.zeros([len(domainsDict[variable]) for variable in queryVariables])
+    domains = [[evidenceDict[variable]] if variable in evidenceDict else domainsDict[variable] for variable in variables]
+    for values in itertools.product(*domains):
+        assignmentDict = dict(zip(variables, values))
+        probability = 1.0
+        for CPT in CPTs:
+            probability *= CPT.getProbability(assignmentDict)
+        table[tuple([list(domainsDict[variable]).index(assignmentDict[variable]) for variable in queryVariables])] += probability
+    if table.sum() == 0:
+        return None
+    return table / table.sum()
+
 ###################################
 ####### From fa21 Tracking Project
 fixed_order = ['West', 'East', 'Stop', 'South', 'North']
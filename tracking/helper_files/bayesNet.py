@@ -1,7 +1,79 @@
 import itertools
 from collections import defaultdict
 import random
-from copy import deepcopy, copy
+import numpy as np
+
+
+class ReadOnlyDict(dict):
+    """
+    A dict that can't be modified after construction.
+
+    Used for the domain and edge maps handed out by BayesNet and Factor,
+    so they can return their internal maps without copying them.
+    Copying it (dict(readOnlyDict) or readOnlyDict.copy()) gives a
+    regular, mutable dict.
+    """
+    def __readOnly(self, *args, **kwargs):
+        raise TypeError("This dict is read-only; copy it with dict(...) to modify it")
+
+    __setitem__ = __delitem__ = __ior__ = __readOnly
+    clear = pop = popitem = setdefault = update = __readOnly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class VariableDomains(ReadOnlyDict):
+    """
+    The read-only {variable : domain tuple} map of a BayesNet or Factor.
+
+    Also keeps a {value : position} map for each domain, built the first
+    time it is asked for, so that looking a value up in a domain is O(1).
+    Factors built from the same map share these lookups.
+    """
+    def valueIndices(self, variable):
+        """
+        Returns a read-only dict mapping each value in variable's domain
+        to its position in the domain.
+        """
+        indexCache = self.__dict__.setdefault('_indexCache', {})
+        if variable not in indexCache:
+            indexCache[variable] = ReadOnlyDict([(value, i) for i, value in enumerate(self[variable])])
+        return indexCache[variable]
+
+    def withDomains(self, newVariableDomainsDict):
+        """
+        Returns a VariableDomains where the domains in
+        newVariableDomainsDict replace the ones in this map.  Value lookups
+        already built for domains that are not replaced are kept.
+        """
+        domainsDict = dict(self)
+        for (variable, domain) in newVariableDomainsDict.items():
+            domainsDict[variable] = tuple(domain)
+        newDomains = VariableDomains(domainsDict)
+        oldIndexCache = self.__dict__.get('_indexCache', {})
+        newDomains._indexCache = dict([(variable, indices) for variable, indices in oldIndexCache.items()
+                                       if newDomains[variable] is self[variable]])
+        return newDomains
+
+
+def freezeVariableDomains(variableDomainsDict):
+    """
+    Returns a VariableDomains with the same variables as
+    variableDomainsDict, where each domain is a tuple.  Maps that are
+    already frozen are returned as is, and domains that already are
+    tuples are not copied.
+    """
+    if isinstance(variableDomainsDict, VariableDomains):
+        return variableDomainsDict
+    return VariableDomains([(variable, tuple(domain)) for (variable, domain) in variableDomainsDict.items()])
+
 
 class BayesNet(object):
 
@@ -24,38 +96,36 @@ class BayesNet(object):
         Doesn't initialize the conditional probability table for any variables.
         """
         # Each variable is unique (so that they can be keys in dicts)
-        self.__variablesSet = set(variables)
+        self.__variablesSet = frozenset(variables)
         self.__variables = sorted(list(variables))
-        # self.__inEdges[v] = [u if the edge (u, v) exists]
-        self.__inEdges  = inputInEdges 
-        # self.__outEdges[u] = [v if the edge (u, v) exists]
-        self.__outEdges = inputOutEdges
-
-        # make sure that the edge maps contain all variables
-        for variable in self.__variablesSet:
-            if variable not in self.__inEdges:
-                self.__inEdges[variable]  = set()
-            if variable not in self.__outEdges:
-                self.__outEdges[variable] = set()
-
-        self.__variableDomainsDict = inputVariableDomains
+        # self.__inEdges[v] = frozenset([u if the edge (u, v) exists])
+        # self.__outEdges[u] = frozenset([v if the edge (u, v) exists])
+        # the edge maps contain all variables, and are read-only so the
+        # accessors below can hand them out without copying
+        self.__inEdges  = ReadOnlyDict([(variable, frozenset(inputInEdges.get(variable, ()))) \
+                                        for variable in self.__variablesSet | set(inputInEdges.keys())])
+        self.__outEdges = ReadOnlyDict([(variable, frozenset(inputOutEdges.get(variable, ()))) \
+                                        for variable in self.__variablesSet | set(inputOutEdges.keys())])
+
+        self.__variableDomainsDict = freezeVariableDomains(inputVariableDomains)
         self.__CPTDict = {}
+        self.__prunedBayesNets = {} # {(query variables, evidence variables) : pruned bayes net}
 
     def variablesSet(self):
-        " Returns a copy of the set of variables in the bayes net "
-        return copy(self.__variablesSet)
+        " Returns the (frozen) set of variables in the bayes net "
+        return self.__variablesSet
 
     def variableDomainsDict(self):
-        " Returns a copy of the variable domains in the bayes net "
-        return deepcopy(self.__variableDomainsDict)
+        " Returns a read-only view of the variable domains in the bayes net "
+        return self.__variableDomainsDict
 
     def inEdges(self):
-        " Returns a copy of the incoming edges in the bayes net "
-        return deepcopy(self.__inEdges)
+        " Returns a read-only view of the incoming edges in the bayes net "
+        return self.__inEdges
 
     def outEdges(self):
-        " Returns a copy of the outgoing edges in the bayes net "
-        return deepcopy(self.__outEdges)
+        " Returns a read-only view of the outgoing edges in the bayes net "
+        return self.__outEdges
 
     def __str__(self):
         """
@@ -95,7 +165,7 @@ class BayesNet(object):
 
         Useful for sampling.
         """
-        inEdgesIncremental = dict([(var, edgeSet.copy()) for (var, edgeSet) in self.__inEdges.items()])
+        inEdgesIncremental = dict([(var, set(edgeSet)) for (var, edgeSet) in self.__inEdges.items()])
         noIncomingList = [var for var in self.__variables if len(self.__inEdges[var]) == 0]
 
         linearizedList = []
@@ -119,11 +189,14 @@ class BayesNet(object):
         """
         Returns a copy of the conditional probability table in the bayes net
         for variable.  This is instantiated as a factor.
+
+        The copy shares its table with the one stored in the bayes net
+        until it is modified (see Factor.copy), so this is O(1).
         """
         if variable not in self.__variablesSet:
             raise ValueError("Variable not in bayes net: " + str(variable))
         else:
-            return deepcopy(self.__CPTDict[variable])
+            return self.__CPTDict[variable].copy()
 
     def setCPT(self, variable, CPT):
         """
@@ -161,7 +234,28 @@ class BayesNet(object):
                                        "conditionedVariables: " + str(conditionedVariables) + \
                                        "\nparent: " + str(var))
 
-            self.__CPTDict[variable] = deepcopy(CPT)
+            self.__CPTDict[variable] = self.__storedCPT(CPT)
+            self.__prunedBayesNets.clear()
+
+    def __storedCPT(self, CPT):
+        """
+        Returns the factor that setCPT stores for CPT: an ArrayFactor, or
+        a SparseFactor for a large and mostly-zero table (see
+        chooseFactorStorage).
+
+        When CPT's domains are the ones in this bayes net, the stored
+        factor uses the bayes net's domain map, so the CPTs share their
+        value lookups (see VariableDomains.valueIndices).
+        """
+        CPT = chooseFactorStorage(CPT)
+        CPTDomains = CPT.variableDomainsDict()
+        if type(CPT) is ArrayFactor and CPTDomains is not self.__variableDomainsDict and \
+                all([CPTDomains[var] == self.__variableDomainsDict[var] for var in CPT.variables()]):
+            numUnconditioned = len(CPT.unconditionedVariables())
+            variables = list(CPT.variables())
+            return ArrayFactor.fromArray(variables[:numUnconditioned], variables[numUnconditioned:],
+                                         self.__variableDomainsDict, CPT.asArray())
+        return CPT.copy()
 
     def getReducedVariableDomains(self, evidenceDict):
         """
@@ -172,7 +266,7 @@ class BayesNet(object):
         variable's domain is the single value that it is being
         assigned to (and is otherwise unchanged).
         """
-        reducedVariableDomainsDict = self.variableDomainsDict()
+        reducedVariableDomainsDict = dict(self.__variableDomainsDict)
         for (evidenceVariable, value) in evidenceDict.items():
             reducedVariableDomainsDict[evidenceVariable] = [value]
         return reducedVariableDomainsDict
@@ -187,13 +281,23 @@ class BayesNet(object):
         Input evidenceDict is optional.
         If it is not provided, the CPTs for all variables without 
         specializing the domains is provided.
+
+        The returned factor's table is a view of the stored one (each
+        evidence variable selects a single index along its axis), so this
+        allocates no table; the view is copied if it is ever modified.
         """
         if evidenceDict is None or len(evidenceDict.items()) == 0:
             return self.getCPT(variable)
+        elif variable not in self.__variablesSet:
+            raise ValueError("Variable not in bayes net: " + str(variable))
         else:
-            reducedVariableDomains = self.getReducedVariableDomains(evidenceDict)
-            variableCPT = self.getCPT(variable)
-            return variableCPT.specializeVariableDomains(reducedVariableDomains)
+            return self.__CPTWithEvidence(variable, evidenceDict)
+
+    def __CPTWithEvidence(self, variable, evidenceDict):
+        # every returned CPT carries the reduced domains of all the evidence
+        # variables, as in getReducedVariableDomains
+        evidenceDomainsDict = dict([(var, [value]) for (var, value) in evidenceDict.items()])
+        return self.__CPTDict[variable].specializeVariableDomains(evidenceDomainsDict)
 
     def getAllCPTsWithEvidence(self, evidenceDict=None):
         """
@@ -206,6 +310,32 @@ class BayesNet(object):
         """
         return [self.getCPTWithEvidence(var, evidenceDict) for var in self.__variablesSet]
 
+    def getCPTWithEvidenceBatch(self, variable, evidenceDicts):
+        """
+        Returns a list with getCPTWithEvidence(variable, evidenceDict) for
+        each evidenceDict in evidenceDicts.
+
+        The stored table is looked up once for the whole batch, and every
+        returned factor is a view of it.
+        """
+        if variable not in self.__variablesSet:
+            raise ValueError("Variable not in bayes net: " + str(variable))
+        return [self.__CPTWithEvidence(variable, evidenceDict) if evidenceDict else self.getCPT(variable)
+                for evidenceDict in evidenceDicts]
+
+    def getPrunedBayesNet(self, queryVariables, evidenceVariables):
+        """
+        Returns pruneBayesNet(self, queryVariables, evidenceVariables).
+
+        The pruned bayes net only depends on which variables are queried
+        and observed, so it is built once per such signature and reused
+        until a CPT of this bayes net is changed with setCPT.
+        """
+        signature = (frozenset(queryVariables), frozenset(evidenceVariables))
+        if signature not in self.__prunedBayesNets:
+            self.__prunedBayesNets[signature] = pruneBayesNet(self, queryVariables, evidenceVariables)
+        return self.__prunedBayesNets[signature]
+
     def easierToParseString(self, printVariableDomainsDict=False):
         " Used internally for computer-readable printing "
         returnStrings = []
@@ -250,42 +380,98 @@ class Factor(object):
 
 
         self.__variables = tuple(inputUnconditionedVariables) + tuple(inputConditionedVariables) # variables are unique string identifiersk
-        self.__variablesSet = set(self.__variables)
+        self.__variablesSet = frozenset(self.__variables)
 
         if not self.__variablesSet.issubset(set(inputVariableDomainsDict.keys())): # it's okay for variableDomainsDict to have more items than needed
             raise ValueError("variableDomainsDict doesn't have all the input variables \n" \
                                + str(self.__variablesSet))
 
-        self.__unconditionedVariables = set(inputUnconditionedVariables)
-        self.__conditionedVariables = set(inputConditionedVariables)
-        self.__variableDomainsDict = deepcopy(inputVariableDomainsDict) # dict that maps {variable : variableDomain}
+        self.__unconditionedVariables = frozenset(inputUnconditionedVariables)
+        self.__conditionedVariables = frozenset(inputConditionedVariables)
+        self.__variableDomainsDict = freezeVariableDomains(inputVariableDomainsDict) # read-only dict that maps {variable : variableDomain}
 
         self.__variableOrders = dict([(variable, i) for i, variable in enumerate(self.__variables)]) # internal order of the variables
+        self.__sharesTable = False # set by copy(), the table is copied before the next write
+        self.__tableVersion = object() # replaced on every write, shared by copies (see tableVersion)
+        self._initializeTable()
+
+    def _initializeTable(self):
+        """
+        Allocates the probability table with an entry of 0.0 for every
+        possible assignmentDict.  Subclasses that store the table
+        differently (see ArrayFactor) override this.
+        """
         self.__probDict = {} # probability values are stored in an {assignmentValuesTuple : probability} dict,
                             # since we can't index using assignmentDicts. this is why we have to sort
-        products = list(itertools.product(*[inputVariableDomainsDict[variable] for variable in self.__variables]))
+        products = list(itertools.product(*[self.__variableDomainsDict[variable] for variable in self.__variables]))
         for assignmentsInOrder in products:
             self.__probDict[tuple(assignmentsInOrder)] = 0.0
 
     def variableDomainsDict(self):
-        " Retuns a copy of the variable domains in the factor "
-        return deepcopy(self.__variableDomainsDict)
+        " Retuns a read-only view of the variable domains in the factor "
+        return self.__variableDomainsDict
 
     def variables(self):
-        " Retuns a copy of the tuple of variables in the factor "
-        return copy(self.__variables)
+        " Retuns the tuple of variables in the factor "
+        return self.__variables
 
     def variablesSet(self):
-        " Retuns a copy of the set of variables in the factor "
-        return copy(self.__variablesSet)
+        " Retuns the (frozen) set of variables in the factor "
+        return self.__variablesSet
 
     def unconditionedVariables(self):
-        " Retuns a copy of the unconditioned variables in the factor "
-        return copy(self.__unconditionedVariables)
+        " Retuns the (frozen) set of unconditioned variables in the factor "
+        return self.__unconditionedVariables
 
     def conditionedVariables(self):
-        " Retuns a copy of the conditioned variables in the factor "
-        return copy(self.__conditionedVariables)
+        " Retuns the (frozen) set of conditioned variables in the factor "
+        return self.__conditionedVariables
+
+    def copy(self):
+        """
+        Returns a copy of the factor in O(1).
+
+        The copy shares the probability table with this factor until
+        either of them is modified; the one being modified then copies
+        the table first, so changes never show up in the other.
+        """
+        newFactor = object.__new__(type(self))
+        newFactor.__dict__.update(self.__dict__)
+        self._markTableShared()
+        newFactor._markTableShared()
+        return newFactor
+
+    def tableVersion(self):
+        """
+        Returns a token for the current contents of the probability
+        table: a copy of the factor has the same token until either of
+        them is modified, and every write gives the factor a new token,
+        so caches of values computed from the table can be keyed on it.
+        """
+        return self.__tableVersion
+
+    def _markTableShared(self, shared=True):
+        """
+        Marks the probability table as shared with another factor, so it
+        is copied before the next write (or, with shared=False, as owned
+        by this factor alone).
+        """
+        self.__sharesTable = shared
+
+    def _prepareTableForWrite(self):
+        """
+        Called before every write to the probability table: copies the
+        table first if it is shared with another factor, and gives it a
+        new tableVersion.
+        """
+        self.__tableVersion = object()
+        if self.__sharesTable:
+            self._copyTable()
+            self.__sharesTable = False
+
+    def _copyTable(self):
+        " Replaces the probability table with a private copy of it "
+        self.__probDict = dict(self.__probDict)
 
     def __eq__(self, other):
         """
@@ -375,6 +561,7 @@ class Factor(object):
                 raise ValueError("The input assignmentDict is not contained in this factor: \n" \
                                   +  str(self) + str(assignmentDict))
             else:
+                self._prepareTableForWrite()
                 self.__probDict[assignmentsInOrder] = probability
 
     def __getAssignmentsInOrder(self, assignmentDict):
@@ -405,6 +592,23 @@ class Factor(object):
                                          key=lambda var_val_tuple : self.__variableOrders[var_val_tuple[0]])
         return tuple([val for (var, val) in variablesAndAssignments])
 
+    def asArray(self):
+        """
+        Returns the probability table as a dense float64 numpy array with
+        one axis per variable, in the order given by variables().  Entry
+        [i, j, ...] holds the probability of the assignment where each
+        variable takes the value at that index of its domain.
+
+        This builds a new array from the stored rows, so modifying it
+        does not change the factor.
+        """
+        domains = [self.__variableDomainsDict[variable] for variable in self.__variables]
+        valueIndices = [self.__variableDomainsDict.valueIndices(variable) for variable in self.__variables]
+        table = np.zeros([len(domain) for domain in domains], dtype=np.float64)
+        for assignmentsInOrder, probability in self.__probDict.items():
+            table[tuple([indices[value] for indices, value in zip(valueIndices, assignmentsInOrder)])] = probability
+        return table
+
     def getAllPossibleAssignmentDicts(self):
         """
         Use this function to get the assignmentDict for each 
@@ -485,7 +689,7 @@ class Factor(object):
 
     def __repr__(self):
         returnRepr = "Factor("
-        initArgs = [self.__unconditionedVariables, self.__conditionedVariables, self.__variableDomainsDict]
+        initArgs = [set(self.__unconditionedVariables), set(self.__conditionedVariables), self.__variableDomainsDict]
         returnRepr += ", ".join([repr(arg) for arg in initArgs])
         returnRepr += ")"
         return returnRepr
@@ -536,7 +740,7 @@ class Factor(object):
         oldVariableDomains = self.variableDomainsDict()
         for (variable, domain) in newVariableDomainsDict.items():
             if variable in self.variablesSet():
-                oldVariableDomain = oldVariableDomains[variable]
+                oldVariableDomain = oldVariableDomains.valueIndices(variable)
                 for value in domain:
                     if value not in oldVariableDomain:
                         raise ValueError("newVariableDomainsDict is not a subset of factor.variableDomainsDict ",
@@ -554,6 +758,516 @@ class Factor(object):
         return newFactor
 
 
+class ArrayFactor(Factor):
+
+    def __init__(self, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict):
+        """
+        Factor whose probability table is stored as a float64
+        numpy array with one axis per variable, in the order given by
+        variables() (the unconditioned variables followed by the
+        conditioned variables, as passed in).
+
+        Takes the same inputs as the Factor constructor and supports the
+        same interface, so it can be used anywhere a Factor is expected.
+        Operations that touch every row of the table should use asArray
+        and fromArray instead of getProbability and setProbability.
+        """
+        Factor.__init__(self, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict)
+
+    def _initializeTable(self):
+        domainsDict = self.variableDomainsDict()
+        shape = [len(domainsDict[variable]) for variable in self.variables()]
+        # a read-only broadcast of 0.0 takes no memory, the first write copies it
+        self.__table = np.broadcast_to(self._toStored(np.float64(0.0)), shape)
+        self._markTableShared()
+
+    @classmethod
+    def fromArray(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, table):
+        """
+        Constructs an ArrayFactor whose probability table is table.
+
+        The axes of table must follow the order of inputUnconditionedVariables
+        followed by inputConditionedVariables (so pass lists rather than sets
+        when there is more than one variable), and each axis must have the
+        length of that variable's domain.
+
+        The factor takes ownership of table when it already is a float64
+        array, so the caller should not modify it afterwards.  A read-only
+        table (such as a view of another factor's table) is copied the
+        first time the factor is modified.
+        """
+        table = np.asarray(table, dtype=np.float64)
+        if table.size > 0 and table.min() < 0:
+            raise ValueError("Probabilty entries can't be set to negative values: " + \
+                               str(table.min()))
+        return cls._fromValidArray(inputUnconditionedVariables, inputConditionedVariables,
+                                   inputVariableDomainsDict, table)
+
+    @classmethod
+    def _fromValidArray(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, table):
+        " fromArray for a float64 table that is already in the stored format (and valid) "
+        newFactor = cls(inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict)
+        if table.shape != newFactor.__table.shape:
+            raise ValueError("Table shape " + str(table.shape) + " doesn't match the variable domains " + \
+                               "of the factor: " + str(newFactor.__table.shape) + "\n" + \
+                               "variables: " + str(newFactor.variables()))
+        newFactor.__table = table
+        newFactor._markTableShared(not table.flags.writeable)
+        return newFactor
+
+    @classmethod
+    def fromFactor(cls, factor):
+        """
+        Returns an ArrayFactor with the same variables, domains and
+        probability entries as factor.
+        """
+        if isinstance(factor, cls):
+            return factor
+        return cls.fromArray(list(factor.variables())[:len(factor.unconditionedVariables())],
+                             list(factor.variables())[len(factor.unconditionedVariables()):],
+                             factor.variableDomainsDict(), factor.asArray())
+
+    def asArray(self):
+        """
+        Returns a read-only view of the probability table, with one axis
+        per variable in the order given by variables().
+
+        Copy the array before modifying it, and use fromArray to build a
+        factor from the result.
+        """
+        return self._fromStored(self._storedTable())
+
+    def _storedTable(self):
+        " Returns a read-only view of the table as it is stored "
+        table = self.__table.view()
+        table.flags.writeable = False
+        return table
+
+    def _toStored(self, probability):
+        " Converts probabilities to the stored format (see LogFactor) "
+        return probability
+
+    def _fromStored(self, storedTable):
+        " Converts entries in the stored format to probabilities "
+        return storedTable
+
+    def __getIndexInOrder(self, assignmentDict):
+        """
+        Internal utility function that turns an assignmentDict into an
+        index tuple into the probability table.
+
+        Use factor.getProbability and factor.setProbability instead,
+        for a better interface.
+        """
+        domainsDict = self.variableDomainsDict()
+        try:
+            return tuple([domainsDict.valueIndices(variable)[assignmentDict[variable]]
+                          for variable in self.variables()])
+        except (KeyError, TypeError):
+            raise ValueError("The input assignmentDict is not contained in this factor: \n" \
+                                +  str(self) + str(assignmentDict))
+
+    def getProbability(self, assignmentDict):
+        return float(self._fromStored(self.__table[self.__getIndexInOrder(assignmentDict)]))
+
+    def setProbability(self, assignmentDict, probability):
+        if probability < 0:
+            raise ValueError("Probabilty entries can't be set to negative values: " + \
+                               str(probability))
+        index = self.__getIndexInOrder(assignmentDict)
+        self._prepareTableForWrite()
+        self.__table[index] = self._toStored(probability)
+
+    def _copyTable(self):
+        self.__table = self.__table.copy()
+
+    def specializeVariableDomains(self, newVariableDomainsDict):
+        """
+        Returns a factor of the same class with the same variables as
+        this factor but with the reduced variable domains given by
+        newVariableDomainsDict.
+
+        Reducing a domain to a single value (as evidence does) selects one
+        index along that variable's axis, so when every reduced domain is a
+        single value or a contiguous run of the old domain, the new factor's
+        table is a view of this one and nothing is copied until one of the
+        two factors is modified.  Other reductions copy the selected entries
+        one axis at a time.
+        """
+        oldVariableDomains = self.variableDomainsDict()
+        basicIndex = []
+        takenAxes = []
+        for axis, variable in enumerate(self.variables()):
+            if variable not in newVariableDomainsDict or \
+                    newVariableDomainsDict[variable] is oldVariableDomains[variable]:
+                basicIndex.append(slice(None))
+                continue
+            valueIndices = oldVariableDomains.valueIndices(variable)
+            indices = []
+            for value in newVariableDomainsDict[variable]:
+                if value not in valueIndices:
+                    raise ValueError("newVariableDomainsDict is not a subset of factor.variableDomainsDict ",
+                                        "for variables contained in factor. " + "factor: " +  str(self) +
+                                        " newVariableDomainsDict: " + str(newVariableDomainsDict) +
+                                        " factor.variableDomainsDict: " + str(self.variableDomainsDict()) +
+                                        " variable: " + str(variable) +
+                                        " value: " + str(value))
+                indices.append(valueIndices[value])
+            if len(indices) > 0 and indices == list(range(indices[0], indices[0] + len(indices))):
+                basicIndex.append(slice(indices[0], indices[0] + len(indices)))
+            else:
+                basicIndex.append(slice(None))
+                takenAxes.append((axis, indices))
+
+        table = self._storedTable()[tuple(basicIndex)]
+        for axis, indices in takenAxes:
+            table = np.take(table, indices, axis=axis)
+
+        numUnconditioned = len(self.unconditionedVariables())
+        variables = list(self.variables())
+        return type(self)._fromValidArray(variables[:numUnconditioned], variables[numUnconditioned:],
+                                          oldVariableDomains.withDomains(newVariableDomainsDict), table)
+
+
+class LogFactor(ArrayFactor):
+
+    def __init__(self, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict):
+        """
+        ArrayFactor whose table stores the natural log of each probability
+        entry (-inf for 0.0), so that long chains of products don't
+        underflow to 0.0.
+
+        getProbability, setProbability and asArray still work with
+        probabilities; asLogArray and fromLogArray work with the log
+        table.  joinFactors adds log tables, eliminate uses log-sum-exp
+        and normalize subtracts the log of the total, so a computation on
+        LogFactors stays in log space until the probabilities are read.
+        """
+        ArrayFactor.__init__(self, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict)
+
+    def _toStored(self, probability):
+        with np.errstate(divide='ignore'):
+            return np.log(probability)
+
+    def _fromStored(self, storedTable):
+        return np.exp(storedTable)
+
+    @classmethod
+    def fromArray(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, table):
+        """
+        Constructs a LogFactor from a table of probabilities, laid out as
+        for ArrayFactor.fromArray.
+        """
+        table = np.asarray(table, dtype=np.float64)
+        if table.size > 0 and table.min() < 0:
+            raise ValueError("Probabilty entries can't be set to negative values: " + \
+                               str(table.min()))
+        with np.errstate(divide='ignore'):
+            logTable = np.log(table)
+        return cls._fromValidArray(inputUnconditionedVariables, inputConditionedVariables,
+                                   inputVariableDomainsDict, logTable)
+
+    @classmethod
+    def fromLogArray(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, logTable):
+        """
+        Constructs a LogFactor whose table of log probabilities is
+        logTable, laid out as for ArrayFactor.fromArray.  The factor takes
+        ownership of logTable when it already is a float64 array.
+        """
+        logTable = np.asarray(logTable, dtype=np.float64)
+        if np.isnan(logTable).any():
+            raise ValueError("Log probability entries can't be NaN")
+        return cls._fromValidArray(inputUnconditionedVariables, inputConditionedVariables,
+                                   inputVariableDomainsDict, logTable)
+
+    def asLogArray(self):
+        """
+        Returns a read-only view of the table of log probabilities, with
+        one axis per variable in the order given by variables().
+        """
+        return self._storedTable()
+
+    def toArrayFactor(self):
+        " Returns an ArrayFactor with the probabilities of this factor "
+        numUnconditioned = len(self.unconditionedVariables())
+        variables = list(self.variables())
+        return ArrayFactor.fromArray(variables[:numUnconditioned], variables[numUnconditioned:],
+                                     self.variableDomainsDict(), self.asArray())
+
+
+# tables with at least SPARSE_MIN_SIZE entries, of which at most a fraction
+# SPARSE_FILL_RATIO are non-zero, are stored in a SparseFactor
+SPARSE_FILL_RATIO = 0.1
+SPARSE_MIN_SIZE = 1024
+
+
+class SparseFactor(Factor):
+
+    def __init__(self, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict):
+        """
+        Factor that only stores its non-zero probability entries: a sorted
+        array of their flat codes (the position of each entry in the dense
+        table of an ArrayFactor with the same variables, as given by
+        np.ravel_multi_index) and an array of their probabilities.
+
+        Memory use, and the work done by joinFactors and eliminate, grow
+        with the number of non-zero entries rather than with the size of
+        the table.  Takes the same inputs as the Factor constructor and
+        supports the same interface.  See chooseFactorStorage for picking
+        between a SparseFactor and an ArrayFactor.
+        """
+        Factor.__init__(self, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict)
+
+    def _initializeTable(self):
+        self.__codes = np.empty(0, dtype=np.int64)
+        self.__values = np.empty(0, dtype=np.float64)
+
+    def tableShape(self):
+        " The shape of the dense table, one axis per variable in variables() order "
+        domainsDict = self.variableDomainsDict()
+        return tuple([len(domainsDict[variable]) for variable in self.variables()])
+
+    @classmethod
+    def fromCodes(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, codes, values):
+        """
+        Constructs a SparseFactor whose entry at each flat code in codes
+        (see the class docstring) has the probability at the same position
+        in values; all other entries are 0.0.  codes can't have repeats.
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if codes.ndim != 1 or codes.shape != values.shape:
+            raise ValueError("codes and values must be 1-dimensional arrays of the same length: " + \
+                               str(codes.shape) + ", " + str(values.shape))
+        if values.size > 0 and values.min() < 0:
+            raise ValueError("Probabilty entries can't be set to negative values: " + \
+                               str(values.min()))
+        nonZero = values != 0
+        return cls._fromValidCodes(inputUnconditionedVariables, inputConditionedVariables,
+                                   inputVariableDomainsDict, codes[nonZero], values[nonZero])
+
+    @classmethod
+    def _fromValidCodes(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, codes, values):
+        " fromCodes for int64 codes and positive float64 values, which are sorted here if needed "
+        newFactor = cls(inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict)
+        if codes.size > 0 and (codes.min() < 0 or codes.max() >= np.prod(newFactor.tableShape(), dtype=np.int64)):
+            raise ValueError("Codes out of range for the variable domains of the factor: " + \
+                               str(newFactor.tableShape()))
+        if np.any(codes[1:] <= codes[:-1]):
+            order = np.argsort(codes, kind='stable')
+            codes, values = codes[order], values[order]
+            if np.any(codes[1:] == codes[:-1]):
+                raise ValueError("A code appears more than once in the input codes")
+        newFactor.__codes = codes
+        newFactor.__values = values
+        return newFactor
+
+    @classmethod
+    def fromArray(cls, inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict, table):
+        """
+        Constructs a SparseFactor with the non-zero entries of table, which
+        is laid out as for ArrayFactor.fromArray.
+        """
+        table = np.asarray(table, dtype=np.float64)
+        if table.size > 0 and table.min() < 0:
+            raise ValueError("Probabilty entries can't be set to negative values: " + \
+                               str(table.min()))
+        newFactor = cls(inputUnconditionedVariables, inputConditionedVariables, inputVariableDomainsDict)
+        if table.shape != newFactor.tableShape():
+            raise ValueError("Table shape " + str(table.shape) + " doesn't match the variable domains " + \
+                               "of the factor: " + str(newFactor.tableShape()) + "\n" + \
+                               "variables: " + str(newFactor.variables()))
+        codes = np.flatnonzero(table)
+        newFactor.__codes = codes.astype(np.int64)
+        newFactor.__values = table.ravel()[codes]
+        return newFactor
+
+    @classmethod
+    def fromFactor(cls, factor):
+        """
+        Returns a SparseFactor with the same variables, domains and
+        probability entries as factor.
+        """
+        if isinstance(factor, cls):
+            return factor
+        return cls.fromArray(list(factor.variables())[:len(factor.unconditionedVariables())],
+                             list(factor.variables())[len(factor.unconditionedVariables()):],
+                             factor.variableDomainsDict(), factor.asArray())
+
+    def asCodes(self):
+        """
+        Returns read-only views of (the sorted flat codes of the non-zero
+        entries, their probabilities).
+        """
+        codes, values = self.__codes.view(), self.__values.view()
+        codes.flags.writeable = values.flags.writeable = False
+        return codes, values
+
+    def nonZeroEntries(self):
+        """
+        Returns (a tuple with the index along each axis, in variables()
+        order, of every non-zero entry, their probabilities).
+        """
+        return unravelCodes(self.__codes, self.tableShape()), self.asCodes()[1]
+
+    def numNonZero(self):
+        " The number of non-zero probability entries "
+        return len(self.__codes)
+
+    def fillRatio(self):
+        " The fraction of the entries of the table that are non-zero "
+        return self.numNonZero() / float(max(1, np.prod(self.tableShape(), dtype=np.int64)))
+
+    def asArray(self):
+        """
+        Returns the probability table as a new dense float64 array, laid
+        out as ArrayFactor.asArray.
+        """
+        table = np.zeros(self.tableShape(), dtype=np.float64)
+        table.ravel()[self.__codes] = self.__values
+        return table
+
+    def __codeOf(self, assignmentDict):
+        " The flat code of the entry for assignmentDict "
+        domainsDict = self.variableDomainsDict()
+        try:
+            index = [domainsDict.valueIndices(variable)[assignmentDict[variable]] for variable in self.variables()]
+        except (KeyError, TypeError):
+            raise ValueError("The input assignmentDict is not contained in this factor: \n" \
+                                +  str(self) + str(assignmentDict))
+        return int(ravelCodes(index, self.tableShape(), 1)) if index else 0
+
+    def getProbability(self, assignmentDict):
+        code = self.__codeOf(assignmentDict)
+        position = np.searchsorted(self.__codes, code)
+        if position < len(self.__codes) and self.__codes[position] == code:
+            return float(self.__values[position])
+        return 0.0
+
+    def setProbability(self, assignmentDict, probability):
+        if probability < 0:
+            raise ValueError("Probabilty entries can't be set to negative values: " + \
+                               str(probability))
+        code = self.__codeOf(assignmentDict)
+        position = np.searchsorted(self.__codes, code)
+        present = position < len(self.__codes) and self.__codes[position] == code
+        if not present and probability == 0:
+            return
+        self._prepareTableForWrite()
+        if present and probability == 0:
+            self.__codes = np.delete(self.__codes, position)
+            self.__values = np.delete(self.__values, position)
+        elif present:
+            self.__values[position] = probability
+        else:
+            self.__codes = np.insert(self.__codes, position, code)
+            self.__values = np.insert(self.__values, position, probability)
+
+    def _copyTable(self):
+        self.__codes = self.__codes.copy()
+        self.__values = self.__values.copy()
+
+    def specializeVariableDomains(self, newVariableDomainsDict):
+        """
+        Returns a SparseFactor with the same variables as this factor
+        but with the reduced variable domains given by
+        newVariableDomainsDict, keeping the non-zero entries that are
+        in the reduced domains.
+        """
+        oldVariableDomains = self.variableDomainsDict()
+        coordinates, values = self.nonZeroEntries()
+        keep = np.ones(len(values), dtype=bool)
+        newCoordinates = []
+        newShape = []
+        for axis, variable in enumerate(self.variables()):
+            if variable not in newVariableDomainsDict or \
+                    newVariableDomainsDict[variable] is oldVariableDomains[variable]:
+                newCoordinates.append(coordinates[axis])
+                newShape.append(len(oldVariableDomains[variable]))
+                continue
+            valueIndices = oldVariableDomains.valueIndices(variable)
+            newPositions = np.full(len(oldVariableDomains[variable]), -1, dtype=np.int64)
+            for newPosition, value in enumerate(newVariableDomainsDict[variable]):
+                if value not in valueIndices:
+                    raise ValueError("newVariableDomainsDict is not a subset of factor.variableDomainsDict ",
+                                        "for variables contained in factor. " + "factor: " +  str(self) +
+                                        " newVariableDomainsDict: " + str(newVariableDomainsDict) +
+                                        " factor.variableDomainsDict: " + str(self.variableDomainsDict()) +
+                                        " variable: " + str(variable) +
+                                        " value: " + str(value))
+                newPositions[valueIndices[value]] = newPosition
+            axisPositions = newPositions[coordinates[axis]]
+            keep &= axisPositions >= 0
+            newCoordinates.append(axisPositions)
+            newShape.append(len(newVariableDomainsDict[variable]))
+
+        codes = ravelCodes([axisPositions[keep] for axisPositions in newCoordinates], newShape, int(keep.sum()))
+        numUnconditioned = len(self.unconditionedVariables())
+        variables = list(self.variables())
+        return type(self)._fromValidCodes(variables[:numUnconditioned], variables[numUnconditioned:],
+                                          oldVariableDomains.withDomains(newVariableDomainsDict),
+                                          codes, values[keep])
+
+
+def ravelCodes(coordinates, shape, numEntries):
+    " np.ravel_multi_index for numEntries entries, which also handles a table with no axes "
+    if len(shape) == 0:
+        return np.zeros(numEntries, dtype=np.int64)
+    return np.ravel_multi_index(tuple(coordinates), tuple(shape)).astype(np.int64)
+
+
+def unravelCodes(codes, shape):
+    " np.unravel_index, which also handles a table with no axes "
+    if len(shape) == 0:
+        return ()
+    return np.unravel_index(codes, tuple(shape))
+
+
+def chooseFactorStorage(factor, sparseFillRatio=None, sparseMinSize=None):
+    """
+    Returns factor as a SparseFactor if its table has at least
+    sparseMinSize entries of which at most a fraction sparseFillRatio are
+    non-zero, and as an ArrayFactor otherwise.  LogFactors are returned
+    as they are.
+
+    sparseFillRatio and sparseMinSize default to SPARSE_FILL_RATIO and
+    SPARSE_MIN_SIZE.
+    """
+    if sparseFillRatio is None:
+        sparseFillRatio = SPARSE_FILL_RATIO
+    if sparseMinSize is None:
+        sparseMinSize = SPARSE_MIN_SIZE
+    if isinstance(factor, LogFactor):
+        return factor
+    size = 1
+    for variable in factor.variables():
+        size *= len(factor.variableDomainsDict()[variable])
+    if size < sparseMinSize:
+        return ArrayFactor.fromFactor(factor)
+    if isinstance(factor, SparseFactor):
+        numNonZero = factor.numNonZero()
+    else:
+        factor = ArrayFactor.fromFactor(factor)
+        numNonZero = np.count_nonzero(factor.asArray())
+    if numNonZero <= sparseFillRatio * size:
+        return SparseFactor.fromFactor(factor)
+    return ArrayFactor.fromFactor(factor)
+
+def logSumExp(logTable, axis=None):
+    """
+    Returns log(sum(exp(logTable))) along axis (over all entries if axis
+    is None), without leaving log space: the largest entry is factored
+    out first, so the exponentials can't all underflow to 0.0.
+    """
+    largest = np.max(logTable, axis=axis, keepdims=True)
+    largest = np.where(np.isfinite(largest), largest, 0.0)
+    with np.errstate(divide='ignore'):
+        result = np.log(np.sum(np.exp(logTable - largest), axis=axis, keepdims=True)) + largest
+    if axis is None:
+        return float(result.reshape(()))
+    return np.squeeze(result, axis=axis)
+
+
 ### bayes net construction utils
 
 def constructEmptyBayesNet(variableList, edgeTuplesList, variableDomainsDict):
@@ -703,6 +1417,79 @@ def reduceBayesNetVariablesWithEvidence(bayesNet, variablesToRemove,
     return newBayesNet
 
 
+def pruneBayesNet(bayesNet, queryVariables, evidenceVariables):
+    """
+    Returns a new Bayes net, over a subset of the variables of bayesNet,
+    that gives the same P(queryVariables | evidenceVariables = values)
+    as bayesNet for any values of the evidence variables (that have a
+    non-zero probability).
+
+    Two kinds of variables are pruned away, using only the edges:
+    barren variables, that are neither an ancestor of a query variable
+    nor of an evidence variable, and variables that are not connected
+    to a query variable once the evidence is assigned (a CPT connects
+    the unobserved variables it contains).  The CPTs of the pruned
+    variables only scale the result, which normalize removes.
+
+    An evidence variable that is kept only because a kept CPT is
+    conditioned on it becomes a root of the new Bayes net with a
+    uniform CPT, since its own CPT only scales the result as well.
+    The domains are not reduced, so the result can be reused for any
+    evidence values (see BayesNet.getPrunedBayesNet).
+    """
+    evidenceVariables = set(evidenceVariables)
+    queryVariables = set(queryVariables) - evidenceVariables
+    inEdges = bayesNet.inEdges()
+
+    ancestors = set()
+    frontier = list(queryVariables | evidenceVariables)
+    while frontier:
+        variable = frontier.pop()
+        if variable not in ancestors:
+            ancestors.add(variable)
+            frontier.extend(inEdges[variable])
+
+    neighbors = dict([(variable, set()) for variable in ancestors - evidenceVariables])
+    for variable in ancestors:
+        scope = [var for var in inEdges[variable] | {variable} if var not in evidenceVariables]
+        for var in scope:
+            neighbors[var].update(scope)
+
+    connected = set()
+    frontier = list(queryVariables)
+    while frontier:
+        variable = frontier.pop()
+        if variable not in connected:
+            connected.add(variable)
+            frontier.extend(neighbors[variable])
+
+    # the CPTs that mention a connected variable, and the evidence variables they are conditioned on
+    keptCPTVariables = set([variable for variable in ancestors
+                            if variable in connected or inEdges[variable] & connected])
+    rootEvidenceVariables = set()
+    for variable in keptCPTVariables:
+        rootEvidenceVariables.update(inEdges[variable] & evidenceVariables)
+    rootEvidenceVariables -= keptCPTVariables
+    newVariables = keptCPTVariables | rootEvidenceVariables
+
+    variableDomainsDict = bayesNet.variableDomainsDict()
+    newInEdges = dict([(variable, set(inEdges[variable])) for variable in keptCPTVariables])
+    newOutEdges = defaultdict(set)
+    for variable, parents in newInEdges.items():
+        for parent in parents:
+            newOutEdges[parent].add(variable)
+    newBayesNet = BayesNet(newVariables, newInEdges, newOutEdges,
+                           dict([(variable, variableDomainsDict[variable]) for variable in newVariables]))
+
+    for variable in keptCPTVariables:
+        newBayesNet.setCPT(variable, bayesNet.getCPT(variable))
+    for variable in rootEvidenceVariables:
+        domain = variableDomainsDict[variable]
+        newBayesNet.setCPT(variable, ArrayFactor.fromArray([variable], [], variableDomainsDict,
+                                                           np.full(len(domain), 1.0 / len(domain))))
+    return newBayesNet
+
+
 def printStarterBayesNet():
     """
     Exploring Bayes net functions, printing, and creation.
@@ -852,11 +1639,38 @@ def normalize(factor):
                             "assignment of the \n" + "conditional variables, " + \
                             "so that total probability will sum to 1\n" + 
                             str(factor))
-    newUCVars, newCVars = factor.unconditionedVariables(), factor.conditionedVariables()
+    newUCVars, newCVars = set(factor.unconditionedVariables()), set(factor.conditionedVariables())
     for var in variableDomainsDict:
         if len(variableDomainsDict[var]) == 1 and var in newUCVars:
             newUCVars.remove(var)
             newCVars.add(var)
+    if isinstance(factor, LogFactor):
+        logTable = factor.asLogArray()
+        logPartition = logSumExp(logTable)
+        if logPartition == -np.inf:
+            return None
+        newUCVars, newCVars = list(newUCVars), list(newCVars)
+        axes = [factor.variables().index(var) for var in newUCVars + newCVars]
+        return LogFactor.fromLogArray(newUCVars, newCVars, variableDomainsDict,
+                                      np.transpose(logTable, axes) - logPartition)
+    if isinstance(factor, SparseFactor):
+        (coordinates, values), shape = factor.nonZeroEntries(), factor.tableShape()
+        probSum = values.sum()
+        if not probSum:
+            return None
+        newUCVars, newCVars = list(newUCVars), list(newCVars)
+        axes = [factor.variables().index(var) for var in newUCVars + newCVars]
+        codes = ravelCodes([coordinates[axis] for axis in axes], [shape[axis] for axis in axes], len(values))
+        return SparseFactor._fromValidCodes(newUCVars, newCVars, variableDomainsDict, codes, values / probSum)
+    if isinstance(factor, ArrayFactor):
+        table = factor.asArray()
+        probSum = table.sum()
+        if not probSum:
+            return None
+        newUCVars, newCVars = list(newUCVars), list(newCVars)
+        axes = [factor.variables().index(var) for var in newUCVars + newCVars]
+        return ArrayFactor.fromArray(newUCVars, newCVars, variableDomainsDict,
+                                     np.transpose(table, axes) / probSum)
     newFactor = Factor(newUCVars, newCVars, variableDomainsDict)
     probSum = sum([factor.getProbability(a) for a in factor.getAllPossibleAssignmentDicts()])
     if not probSum:
@@ -1,5 +1,12 @@
 import random
+import bisect
 import itertools
+import math
+import multiprocessing
+import weakref
+import numpy as np
+from collections import OrderedDict
+from collections.abc import ItemsView, KeysView, Mapping, ValuesView
 from itertools import product
 from typing import List, Dict, Tuple
 import busters
@@ -9,14 +16,59 @@ from bayesNet import normalize
 import hunters
 from util import manhattanDistance, raiseNotDefined
 from factorOperations import joinFactorsByVariableWithCallTracking, joinFactors
-from factorOperations import eliminateWithCallTracking
+from factorOperations import eliminateWithCallTracking, joinAndEliminateByVariableWithCallTracking
+from factorOperations import joinAndEliminateByVariable
+from eliminationOrdering import chooseEliminationOrder, greedyEliminationOrder, interactionGraph
+from eliminationPlans import VariableEliminationPlan
 
 
 
-def constructBayesNet(gameState: hunters.GameState):
+class LRUCache:
+    """
+    Keeps the value built for each key, evicting the least recently used
+    one once it holds more than maxSize.
+    """
+    def __init__(self, maxSize: int):
+        if maxSize <= 0:
+            raise ValueError("An LRU cache must hold at least one value, got maxSize: " + str(maxSize))
+        self.maxSize = maxSize
+        self.__values = OrderedDict()
+
+    def __len__(self):
+        return len(self.__values)
+
+    def __contains__(self, key):
+        return key in self.__values
+
+    def get(self, key, build):
+        " Returns the value cached for key, built with build() if it isn't cached "
+        if key in self.__values:
+            self.__values.move_to_end(key)
+            return self.__values[key]
+        value = build()
+        self.__values[key] = value
+        if len(self.__values) > self.maxSize:
+            self.__values.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.__values.clear()
+
+
+MAX_CACHED_BOARD_SIZES = 16
+
+# the variable domains of constructBayesNet, built once per board size and
+# shared by every bayes net built for that size
+_variableDomainsByBoardSize = LRUCache(MAX_CACHED_BOARD_SIZES)
+# the observation CPT tables of fillObservationCPTs, built once per board size
+_observationTablesByBoardSize = LRUCache(MAX_CACHED_BOARD_SIZES)
+
+
+def constructBayesNet(gameState: hunters.GameState, fillObservations: bool = False):
     """
     Construct an empty Bayes net according to the structure given in Figure 1
-    of the project description.
+    of the project description.  With fillObservations, the CPTs of the
+    observation variables are filled in as well (see fillObservationCPTs).
 
     You *must* name all variables using the constants in this function.
 
@@ -41,45 +93,77 @@ def constructBayesNet(gameState: hunters.GameState):
     Y_RANGE = gameState.getWalls().height
     MAX_NOISE = 7
 
-    variables = []
-    edges = []
-    variableDomainsDict = {}
-
-    variables.extend([PAC, GHOST0, GHOST1, OBS0, OBS1])
-    edges.extend([(GHOST0, OBS0), (GHOST1, OBS1), (PAC, OBS0), (PAC, OBS1)])
-    for var in variables:
-        if var == GHOST0 or var == PAC or var == GHOST1:
-            # put all coordinates
-            coord_list = list(product(range(X_RANGE), range(Y_RANGE)))
-            variableDomainsDict[var] = coord_list
-        else:
-            # Calculate observed Manhattan distances and adjust for potential noise.
-            obs0_distances = set()
-            obs1_distances = set()
-            # Iterate over PAC's coordinates to compute distances from both GHOST0 and GHOST1.
-            for pacX, pacY in variableDomainsDict[PAC]:
-                # Update the sets with all unique distances for GHOST0.
-                obs0_distances.update(manhattanDistance((pacX, pacY), ghost) for ghost in variableDomainsDict[GHOST0])
-                # Update the sets with all unique distances for GHOST1.
-                obs1_distances.update(manhattanDistance((pacX, pacY), ghost) for ghost in variableDomainsDict[GHOST1])
-            # Construct ranges to represent possible noise adjustments for the observed distances.
-            extend_above_obs0 = [i for i in range(max(obs0_distances) + 1, max(obs0_distances) + 1 + MAX_NOISE)]
-            extend_below_obs0 = [i for i in range(min(obs0_distances) - MAX_NOISE, min(obs0_distances))]
-            extend_above_obs1 = [i for i in range(max(obs1_distances) + 1, max(obs1_distances) + 1 + MAX_NOISE)]
-            extend_below_obs1 = [i for i in range(min(obs1_distances) - MAX_NOISE, min(obs1_distances))]
-            # Combine original distances with noise adjustments and remove any duplicates by converting to a set and back to a list.
-            variableDomainsDict[OBS0] = sorted(list(set(extend_below_obs0 + list(obs0_distances) + extend_above_obs0)))
-            variableDomainsDict[OBS1] = sorted(list(set(extend_below_obs1 + list(obs1_distances) + extend_above_obs1)))
-            # Exclude any non-positive values from the distance lists to ensure all distances are valid (nonzero and positive).
-            variableDomainsDict[OBS0] = [i for i in variableDomainsDict[OBS0] if i >= 0]
-            variableDomainsDict[OBS1] = [i for i in variableDomainsDict[OBS1] if i >= 0]
+    variables = [PAC, GHOST0, GHOST1, OBS0, OBS1]
+    edges = [(GHOST0, OBS0), (GHOST1, OBS1), (PAC, OBS0), (PAC, OBS1)]
+    boardSize = (X_RANGE, Y_RANGE, MAX_NOISE)
+    def buildVariableDomains():
+        # put all coordinates
+        positions = list(product(range(X_RANGE), range(Y_RANGE)))
+        # two positions are between 0 (the same position) and
+        # (X_RANGE - 1) + (Y_RANGE - 1) (opposite corners) apart, and noise
+        # moves an observed distance by at most MAX_NOISE without making it
+        # negative, so every distance in between is observable
+        maxDistance = (X_RANGE - 1) + (Y_RANGE - 1)
+        observations = list(range(0, maxDistance + MAX_NOISE + 1))
+        return bn.freezeVariableDomains(
+            {PAC: positions, GHOST0: positions, GHOST1: positions, OBS0: observations, OBS1: observations})
+    variableDomainsDict = _variableDomainsByBoardSize.get(boardSize, buildVariableDomains)
     "*** END YOUR CODE HERE ***"
 
     net = bn.constructEmptyBayesNet(variables, edges, variableDomainsDict)
+    if fillObservations:
+        fillObservationCPTs(net, gameState)
     return net
 
 
-def inferenceByEnumeration(bayesNet: bn, queryVariables: List[str], evidenceDict: Dict):
+def fillObservationCPTs(bayesNet: bn, gameState: hunters.GameState):
+    """
+    Fills the CPT of each observation variable of a bayes net built by
+    constructBayesNet with the sonar model of busters:
+
+    P(observation | Pacman, ghost) =
+        busters.getObservationProbability(observation, manhattanDistance(Pacman, ghost))
+
+    The table is computed with numpy once per board size (for the
+    MAX_CACHED_BOARD_SIZES most recently used sizes) and shared,
+    read-only, by the CPTs of every bayes net filled for that size (a CPT
+    copies it only if it is modified).
+    """
+    PAC = "Pacman"
+    OBSERVATIONS = ["Observation0", "Observation1"]
+    X_RANGE = gameState.getWalls().width
+    Y_RANGE = gameState.getWalls().height
+
+    domainsDict = bayesNet.variableDomainsDict()
+    positions = domainsDict[PAC]
+    observations = domainsDict[OBSERVATIONS[0]]
+    boardSize = (X_RANGE, Y_RANGE, len(positions), tuple(observations))
+    def buildTable():
+        coordinates = np.array(positions, dtype=np.intp)
+        distances = np.abs(coordinates[:, None, :] - coordinates[None, :, :]).sum(axis=2)
+        observationValues = np.array(observations, dtype=np.intp)
+
+        # sonarTable[o, d] = getObservationProbability(observations[o], d): the
+        # noise values that turn the true distance d into the observation
+        sonarTable = np.zeros((len(observations), distances.max() + 1))
+        for error, probability in zip(busters.SONAR_NOISE_VALUES, busters.SONAR_NOISE_PROBS):
+            trueDistances = np.maximum(1, observationValues - int(error))
+            inRange = trueDistances < sonarTable.shape[1]
+            np.add.at(sonarTable, (np.flatnonzero(inRange), trueDistances[inRange]), probability)
+
+        table = sonarTable[:, distances]
+        table.flags.writeable = False
+        return table
+    table = _observationTablesByBoardSize.get(boardSize, buildTable)
+
+    for observationVariable in OBSERVATIONS:
+        ghostVariable = [var for var in bayesNet.inEdges()[observationVariable] if var != PAC][0]
+        bayesNet.setCPT(observationVariable,
+                        bn.ArrayFactor.fromArray([observationVariable], [PAC, ghostVariable], domainsDict, table))
+
+
+def inferenceByEnumeration(bayesNet: bn, queryVariables: List[str], evidenceDict: Dict, prune: bool = False,
+                           logSpace: bool = False, processes: int = None):
     """
     An inference by enumeration implementation provided as reference.
     This function performs a probabilistic inference query that
@@ -93,7 +177,30 @@ def inferenceByEnumeration(bayesNet: bn, queryVariables: List[str], evidenceDict
     evidenceDict:   An assignment dict {variable : value} for the
                     variables which are presented as evidence
                     (conditioned) in the inference query. 
+    prune:          If True, the query is answered on the pruned bayes
+                    net from BayesNet.getPrunedBayesNet, which leaves out
+                    the variables that can't change the result.  Off by
+                    default, so that this stays the reference the other
+                    inference functions are checked against.
+    logSpace:       If True, the computation is done on log probabilities
+                    (see bayesNet.LogFactor), so that long products can't
+                    underflow to 0, and the result is a LogFactor.
+    processes:      When pruning splits the query into independent
+                    components (see _queryComponents), the components that
+                    are large enough are answered on a pool of this many
+                    processes.
     """
+    if prune:
+        queryGroups = _queryComponents(bayesNet, queryVariables, evidenceDict.keys())
+        if len(queryGroups) > 1:
+            return _inferenceByComponents(
+                lambda subnet, group: inferenceByEnumeration(subnet, group, evidenceDict, prune=False, logSpace=logSpace),
+                True, bayesNet, queryGroups, evidenceDict, None, logSpace, processes)
+        prunedBayesNet = bayesNet.getPrunedBayesNet(queryVariables, evidenceDict.keys())
+        return _withPrunedEvidence(inferenceByEnumeration(prunedBayesNet, queryVariables, evidenceDict,
+                                                          prune=False, logSpace=logSpace),
+                                   bayesNet, queryVariables, evidenceDict)
+
     callTrackingList = []
     joinFactorsByVariable = joinFactorsByVariableWithCallTracking(callTrackingList)
     eliminate = eliminateWithCallTracking(callTrackingList)
@@ -105,6 +212,8 @@ def inferenceByEnumeration(bayesNet: bn, queryVariables: List[str], evidenceDict
 
     # grab all factors where we know the evidence variables (to reduce the size of the tables)
     currentFactorsList = bayesNet.getAllCPTsWithEvidence(evidenceDict)
+    if logSpace:
+        currentFactorsList = [bn.LogFactor.fromFactor(factor) for factor in currentFactorsList]
 
     # join all factors by variable
     for joinVariable in bayesNet.variablesSet():
@@ -132,9 +241,218 @@ def inferenceByEnumeration(bayesNet: bn, queryVariables: List[str], evidenceDict
 
 
 
+def _withPrunedEvidence(factor, bayesNet, queryVariables, evidenceDict):
+    """
+    Adds the evidence variables that pruning left out of a query result
+    back to it as conditioned variables, so the result is the factor the
+    query on the whole bayesNet would return.
+
+    Pruning leaves out CPTs that only scale the result, but a scale of 0
+    means the evidence is impossible, so None is returned (as the query
+    on the whole bayesNet would) when the evidence has probability 0 in
+    the part of bayesNet that was left out.
+    """
+    if factor is None or not prunedEvidenceIsPossible(bayesNet, queryVariables, evidenceDict):
+        return None
+    missingEvidenceVariables = sorted(set(evidenceDict.keys()) - factor.variablesSet())
+    if not missingEvidenceVariables:
+        return factor
+    return _rebuiltFactor(factor, bayesNet.getReducedVariableDomains(evidenceDict), missingEvidenceVariables)
+
+# what prunedEvidenceIsPossible works out once per pruned bayes net: the
+# CPTs that pruning leaves out, the evidence variables whose values decide
+# if they give the evidence probability 0, and the answers for the values
+# seen so far
+_droppedCPTsByPrunedBayesNet = weakref.WeakKeyDictionary()
+# the most answers prunedEvidenceIsPossible keeps per pruned bayes net
+MAX_CACHED_EVIDENCE_CHECKS = 1024
+
+def prunedEvidenceIsPossible(bayesNet, queryVariables, evidenceDict):
+    """
+    Returns False if the CPTs that bayesNet.getPrunedBayesNet(queryVariables,
+    evidence variables) leaves out give the evidence probability 0.
+
+    Those are the CPTs of the ancestors of the query and evidence
+    variables that the pruned bayes net doesn't keep (an evidence variable
+    that only stays as a root keeps a uniform CPT instead of its own).
+    They share no unobserved variable with the kept CPTs, so the
+    probability of the evidence is the product of the two parts, and the
+    left out part is summed here by variable elimination in log space.
+
+    The left out CPTs are found once per pruned bayes net.  When none of
+    them is the CPT of an evidence variable they sum to 1, so the answer
+    is True without any factor work; otherwise the answer is cached per
+    value of the evidence variables they contain, for up to
+    MAX_CACHED_EVIDENCE_CHECKS values per pruned bayes net.
+    """
+    if not evidenceDict:
+        return True
+    prunedBayesNet = bayesNet.getPrunedBayesNet(queryVariables, evidenceDict.keys())
+    if prunedBayesNet not in _droppedCPTsByPrunedBayesNet:
+        _droppedCPTsByPrunedBayesNet[prunedBayesNet] = _droppedCPTs(bayesNet, prunedBayesNet, queryVariables,
+                                                                    evidenceDict.keys())
+    droppedCPTVariables, checkedEvidenceVariables, answers = _droppedCPTsByPrunedBayesNet[prunedBayesNet]
+    if not checkedEvidenceVariables:
+        return True
+    return answers.get(tuple([evidenceDict[variable] for variable in checkedEvidenceVariables]),
+                       lambda: _droppedCPTsArePossible(bayesNet, droppedCPTVariables, evidenceDict))
+
+def _droppedCPTs(bayesNet, prunedBayesNet, queryVariables, evidenceVariables):
+    """
+    The variables whose CPTs prunedBayesNet leaves out, the evidence
+    variables in those CPTs (none if no evidence variable's own CPT is
+    left out) and an empty cache for the answers of
+    _droppedCPTsArePossible.
+    """
+    evidenceVariables = set(evidenceVariables)
+    inEdges = bayesNet.inEdges()
+    ancestors = set()
+    frontier = list(set(queryVariables) | evidenceVariables)
+    while frontier:
+        variable = frontier.pop()
+        if variable not in ancestors:
+            ancestors.add(variable)
+            frontier.extend(inEdges[variable])
+
+    prunedInEdges = prunedBayesNet.inEdges()
+    keptCPTVariables = set([variable for variable in prunedBayesNet.variablesSet()
+                            if variable not in evidenceVariables or prunedInEdges[variable]])
+    droppedCPTVariables = sorted(ancestors - keptCPTVariables)
+    checkedEvidenceVariables = []
+    if evidenceVariables & set(droppedCPTVariables):
+        checkedEvidenceVariables = sorted(evidenceVariables & set().union(
+            *[inEdges[variable] | {variable} for variable in droppedCPTVariables]))
+    return droppedCPTVariables, checkedEvidenceVariables, LRUCache(MAX_CACHED_EVIDENCE_CHECKS)
+
+def _droppedCPTsArePossible(bayesNet, droppedCPTVariables, evidenceDict):
+    " Whether the CPTs of droppedCPTVariables give the evidence a non-zero probability "
+    factors = [bn.LogFactor.fromFactor(bayesNet.getCPTWithEvidence(variable, evidenceDict))
+               for variable in droppedCPTVariables]
+    eliminationVariables = set().union(*[factor.variablesSet() for factor in factors]) - set(evidenceDict.keys())
+    for eliminationVariable in greedyEliminationOrder(bayesNet, eliminationVariables, evidenceDict.keys()):
+        factors, marginalFactor = joinAndEliminateByVariable(factors, eliminationVariable)
+        if marginalFactor is not None:
+            factors.append(marginalFactor)
+    return not factors or bool(np.any(joinFactors(factors).asLogArray() > -np.inf))
+
+def _rebuiltFactor(factor, variableDomainsDict, newConditionedVariables=()):
+    """
+    Returns factor with variableDomainsDict as its domains, and with
+    newConditionedVariables (whose domains must hold a single value)
+    added as conditioned variables.  A LogFactor stays a LogFactor, and
+    any other factor becomes an ArrayFactor.
+    """
+    if isinstance(factor, bn.LogFactor):
+        table, fromTable = factor.asLogArray(), bn.LogFactor.fromLogArray
+    else:
+        factor = bn.ArrayFactor.fromFactor(factor)
+        table, fromTable = factor.asArray(), bn.ArrayFactor.fromArray
+    variables = list(factor.variables())
+    numUnconditioned = len(factor.unconditionedVariables())
+    table = table.reshape(table.shape + (1,) * len(newConditionedVariables))
+    return fromTable(variables[:numUnconditioned], variables[numUnconditioned:] + list(newConditionedVariables),
+                     variableDomainsDict, table)
+
+
+# components whose CPTs hold fewer entries than this are answered in the
+# calling process even when a process pool is used
+MIN_PARALLEL_COMPONENT_SIZE = 1 << 20
+
+def _restrictedOrder(eliminationOrder, bayesNet):
+    " eliminationOrder without the variables that are not in bayesNet (None stays None) "
+    if eliminationOrder is None:
+        return None
+    return [variable for variable in eliminationOrder if variable in bayesNet.variablesSet()]
+
+def _queryComponents(bayesNet, queryVariables, evidenceVariables):
+    """
+    Splits queryVariables into the groups that are connected to each
+    other in the interaction graph of bayesNet once evidenceVariables are
+    assigned (see eliminationOrdering.interactionGraph).  Query variables
+    in different groups are independent given the evidence, so
+    P(queryVariables | evidence) is the product of P(group | evidence).
+    """
+    adjacency = interactionGraph(bayesNet, evidenceVariables)
+    remaining = set(queryVariables) - set(evidenceVariables)
+    groups = []
+    for queryVariable in sorted(remaining):
+        if queryVariable not in adjacency:
+            continue
+        component = set()
+        frontier = [queryVariable]
+        while frontier:
+            variable = frontier.pop()
+            if variable not in component:
+                component.add(variable)
+                frontier.extend(adjacency.pop(variable))
+        groups.append(sorted(component & remaining))
+    return groups
+
+def _tableEntries(bayesNet):
+    " The number of entries of all the CPTs of bayesNet "
+    domainsDict = bayesNet.variableDomainsDict()
+    inEdges = bayesNet.inEdges()
+    return sum([int(np.prod([len(domainsDict[var]) for var in set(inEdges[variable]) | {variable}]))
+                for variable in bayesNet.variablesSet()])
+
+def _inferenceByComponents(solveComponent, byEnumeration, bayesNet, queryGroups, evidenceDict, eliminationOrder,
+                           logSpace, processes):
+    """
+    Answers P(group | evidenceDict) for each group of queryGroups on the
+    pruned bayes net of that group alone, and joins the answers (an outer
+    product, since the groups are independent given the evidence).
+
+    solveComponent(subnet, group) answers one group in this process.
+    With processes > 1, the components with at least
+    MIN_PARALLEL_COMPONENT_SIZE CPT entries are answered on a process
+    pool instead (by inferenceByEnumeration if byEnumeration, otherwise
+    by inferenceByVariableElimination) while the others are answered here.
+    """
+    subnets = [bayesNet.getPrunedBayesNet(group, evidenceDict.keys()) for group in queryGroups]
+    parallel = []
+    if processes is not None and processes > 1:
+        parallel = [i for i, subnet in enumerate(subnets) if _tableEntries(subnet) >= MIN_PARALLEL_COMPONENT_SIZE]
+    if len(parallel) < 2:
+        parallel = []
+
+    results = [None] * len(queryGroups)
+    pool = multiprocessing.Pool(min(processes, len(parallel))) if parallel else None
+    try:
+        if pool is not None:
+            work = [(byEnumeration, subnets[i], queryGroups[i], evidenceDict,
+                     _restrictedOrder(eliminationOrder, subnets[i]), logSpace) for i in parallel]
+            pendingResults = pool.map_async(_solveComponentInProcess, work)
+        for i, (subnet, group) in enumerate(zip(subnets, queryGroups)):
+            if i not in parallel:
+                results[i] = solveComponent(subnet, group)
+        if pool is not None:
+            for i, result in zip(parallel, pendingResults.get()):
+                results[i] = result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if any([result is None for result in results]):
+        return None
+    # the answers carry the domains of their own pruned bayes nets, and a join needs shared ones
+    variableDomainsDict = bayesNet.getReducedVariableDomains(evidenceDict)
+    joined = joinFactors([_rebuiltFactor(result, variableDomainsDict) for result in results])
+    return _withPrunedEvidence(joined, bayesNet, [var for group in queryGroups for var in group], evidenceDict)
+
+def _solveComponentInProcess(args):
+    " Worker for _inferenceByComponents: answers one group with the module's inference functions "
+    byEnumeration, bayesNet, queryVariables, evidenceDict, eliminationOrder, logSpace = args
+    if byEnumeration:
+        return inferenceByEnumeration(bayesNet, queryVariables, evidenceDict, prune=False, logSpace=logSpace)
+    return inferenceByVariableElimination(bayesNet, queryVariables, evidenceDict, eliminationOrder,
+                                          prune=False, logSpace=logSpace)
+
+
 def inferenceByVariableEliminationWithCallTracking(callTrackingList=None):
 
-    def inferenceByVariableElimination(bayesNet: bn, queryVariables: List[str], evidenceDict: Dict, eliminationOrder: List[str]):
+    def inferenceByVariableElimination(bayesNet: bn, queryVariables: List[str], evidenceDict: Dict, eliminationOrder: List[str],
+                                       prune: bool = None, logSpace: bool = False, processes: int = None):
         """
         This function should perform a probabilistic inference query that
         returns the factor:
@@ -167,7 +485,22 @@ def inferenceByVariableEliminationWithCallTracking(callTrackingList=None):
         evidenceDict:     An assignment dict {variable : value} for the
                           variables which are presented as evidence
                           (conditioned) in the inference query. 
-        eliminationOrder: The order to eliminate the variables in.
+        eliminationOrder: The order to eliminate the variables in.  If None,
+                          the cheapest order found by the heuristics in
+                          eliminationOrdering is used.
+        prune:            If True, the query is answered on the pruned bayes
+                          net from BayesNet.getPrunedBayesNet, and the
+                          variables it leaves out are skipped in
+                          eliminationOrder.  If None, the bayes net is pruned
+                          only when no eliminationOrder is given, so that an
+                          explicit order is always followed exactly.
+        logSpace:         If True, the computation is done on log probabilities
+                          (see bayesNet.LogFactor), so that long products
+                          can't underflow to 0, and the result is a LogFactor.
+        processes:        When pruning splits the query into independent
+                          components (see _queryComponents), the components
+                          that are large enough are answered on a pool of
+                          this many processes.
 
         Hint: BayesNet.getAllCPTsWithEvidence will return all the Conditional 
         Probability Tables even if an empty dict (or None) is passed in for 
@@ -185,26 +518,44 @@ def inferenceByVariableEliminationWithCallTracking(callTrackingList=None):
         # this is for autograding -- don't modify
         joinFactorsByVariable = joinFactorsByVariableWithCallTracking(callTrackingList)
         eliminate             = eliminateWithCallTracking(callTrackingList)
-        if eliminationOrder is None: # set an arbitrary elimination order if None given
-            eliminationVariables = bayesNet.variablesSet() - set(queryVariables) -\
-                                   set(evidenceDict.keys())
-            eliminationOrder = sorted(list(eliminationVariables))
+        if prune is None:
+            prune = eliminationOrder is None
+        fullBayesNet = bayesNet
+        if prune:
+            # answer each group of query variables that is independent of the others on its own
+            queryGroups = _queryComponents(bayesNet, queryVariables, evidenceDict.keys())
+            if len(queryGroups) > 1:
+                return _inferenceByComponents(
+                    lambda subnet, group: inferenceByVariableElimination(subnet, group, evidenceDict,
+                        _restrictedOrder(eliminationOrder, subnet), prune=False, logSpace=logSpace),
+                    False, bayesNet, queryGroups, evidenceDict, eliminationOrder, logSpace, processes)
+        if prune: # drop the variables that can't change the result before any factor work
+            bayesNet = bayesNet.getPrunedBayesNet(queryVariables, evidenceDict.keys())
+            eliminationOrder = _restrictedOrder(eliminationOrder, bayesNet)
+        if eliminationOrder is None: # pick a heuristic elimination order if None given
+            eliminationOrder = chooseEliminationOrder(bayesNet, queryVariables, evidenceDict.keys())
 
         "*** YOUR CODE HERE ***"
+        # Joining and eliminating in one step records the same ('join', var), ('eliminate', var)
+        # calls, but never builds the joined table that is about to be summed out.
+        joinAndEliminateByVariable = joinAndEliminateByVariableWithCallTracking(callTrackingList)
         # Retrieve all relevant conditional probability tables (CPTs) given the evidence.
         relevant_factors = bayesNet.getAllCPTsWithEvidence(evidenceDict)
+        if logSpace:
+            relevant_factors = [bn.LogFactor.fromFactor(factor) for factor in relevant_factors]
         # Sequentially process each variable in the specified elimination order.
         for target_variable in eliminationOrder:
-            # Combine factors that involve the target variable.
-            relevant_factors, combined_factor = joinFactorsByVariable(relevant_factors, target_variable)
-            # If the combined factor has more than one unconditioned variable, marginalize it.
-            if len(combined_factor.unconditionedVariables()) > 1:
-                # Perform marginalization on the combined factor to eliminate the target variable.
-                marginalized_factor = eliminate(combined_factor, target_variable)
+            # Combine the factors that involve the target variable and marginalize it out.
+            # A combined factor with a single unconditioned variable is discarded (None).
+            relevant_factors, marginalized_factor = joinAndEliminateByVariable(relevant_factors, target_variable)
+            if marginalized_factor is not None:
                 # Append the marginalized factor to the list of relevant factors.
                 relevant_factors.append(marginalized_factor)
         # Normalize the final joined factor to ensure it represents valid probabilities.
         final_normalized_factor = normalize(joinFactors(relevant_factors))
+        if prune:
+            final_normalized_factor = _withPrunedEvidence(final_normalized_factor, fullBayesNet, queryVariables,
+                                                          evidenceDict)
         return final_normalized_factor
 
 
@@ -213,11 +564,150 @@ def inferenceByVariableEliminationWithCallTracking(callTrackingList=None):
 
 inferenceByVariableElimination = inferenceByVariableEliminationWithCallTracking()
 
-def sampleFromFactorRandomSource(randomSource=None):
-    if randomSource is None:
-        randomSource = random.Random()
+def inferenceByVariableEliminationBatch(bayesNet: bn, queryVariables: List[str], evidenceDicts: List[Dict],
+                                        eliminationOrder: List[str] = None):
+    """
+    Answers P(queryVariables | evidenceDict) for every evidenceDict in
+    evidenceDicts in one vectorised pass, and returns the posteriors
+    stacked in one array of shape
+    (len(evidenceDicts), domain sizes of the sorted queryVariables...).
+
+    Every evidenceDict must assign the same evidence variables.  The
+    rows for evidence with probability 0 (where
+    inferenceByVariableElimination returns None) are NaN.  See
+    VariableEliminationPlan.executeBatch, which also accepts the evidence
+    as {variable : array of values}; compile a plan directly to reuse it
+    across batches.
+    """
+    evidenceDicts = list(evidenceDicts)
+    evidenceVariables = evidenceDicts[0].keys() if evidenceDicts else ()
+    plan = VariableEliminationPlan(bayesNet, queryVariables, evidenceVariables, eliminationOrder)
+    return plan.executeBatch(evidenceDicts)
 
-    def sampleFromFactor(factor, conditionedAssignments=None):
+
+def inferenceByMaxProductVariableElimination(bayesNet: bn, evidenceDict: Dict, queryVariables: List[str] = None,
+                                             eliminationOrder: List[str] = None):
+    """
+    Returns the most likely assignment, as a dict {variable : value}, of
+    queryVariables given evidenceDict (the MAP assignment), or of every
+    unobserved variable if queryVariables is None (the MPE assignment).
+    Returns None if the evidence has probability 0.
+
+    This is variable elimination with max in place of sum for the
+    variables being assigned: the unobserved variables that are not
+    queried are summed out first, then each queried variable is
+    maximized out, and the index of its best value for every assignment
+    of the variables left in its factor is kept as a backpointer array.
+    Following the backpointers in reverse order gives the assignment, so
+    no posterior table is built or normalized.  Tables are kept as log
+    probabilities, so long products can't underflow to 0.
+
+    eliminationOrder: The order to eliminate the unobserved variables in.
+                      The summed variables must all come before the
+                      maximized ones.  If None, the summed variables are
+                      ordered by chooseEliminationOrder and the maximized
+                      ones by greedyEliminationOrder with min-fill.
+    """
+    evidenceVariables = set(evidenceDict.keys())
+    if queryVariables is None:
+        queryVariables = bayesNet.variablesSet() - evidenceVariables
+    else:
+        # only the variables that can change P(queryVariables | evidence) matter
+        if not prunedEvidenceIsPossible(bayesNet, queryVariables, evidenceDict):
+            return None
+        bayesNet = bayesNet.getPrunedBayesNet(queryVariables, evidenceVariables)
+    maxVariables = set(queryVariables) - evidenceVariables
+    sumVariables = bayesNet.variablesSet() - maxVariables - evidenceVariables
+
+    if eliminationOrder is None:
+        eliminationOrder = chooseEliminationOrder(bayesNet, maxVariables, evidenceVariables) + \
+            greedyEliminationOrder(bayesNet, maxVariables, evidenceVariables, heuristic='min-fill')
+    else:
+        eliminationOrder = _restrictedOrder(eliminationOrder, bayesNet)
+        if set(eliminationOrder) != maxVariables | sumVariables:
+            raise ValueError("The elimination order must contain every unobserved variable: " + \
+                             str(eliminationOrder))
+        if sumVariables and any([variable in maxVariables for variable in
+                                 eliminationOrder[:max([eliminationOrder.index(var) for var in sumVariables])]]):
+            raise ValueError("The summed variables must be eliminated before the maximized ones: " + \
+                             str(eliminationOrder))
+
+    # every CPT as (variables, table of log probabilities), without the evidence axes
+    factors = []
+    for CPT in bayesNet.getAllCPTsWithEvidence(evidenceDict):
+        CPT = bn.ArrayFactor.fromFactor(CPT)
+        variables = [variable for variable in CPT.variables() if variable not in evidenceVariables]
+        table = CPT.asArray()
+        table = table.reshape([length for variable, length in zip(CPT.variables(), table.shape)
+                               if variable not in evidenceVariables])
+        with np.errstate(divide='ignore'):
+            factors.append((variables, np.log(table)))
+
+    backpointers = []
+    for eliminationVariable in eliminationOrder:
+        joined = [factor for factor in factors if eliminationVariable in factor[0]]
+        factors = [factor for factor in factors if eliminationVariable not in factor[0]]
+        variables = sorted(set().union(*[set(factorVariables) for factorVariables, _ in joined]))
+        table = sum([_broadcastTable(factorVariables, factorTable, variables) for factorVariables, factorTable in joined])
+        axis = variables.index(eliminationVariable)
+        remainingVariables = variables[:axis] + variables[axis + 1:]
+        if eliminationVariable in maxVariables:
+            best = np.argmax(table, axis=axis)
+            backpointers.append((eliminationVariable, remainingVariables,
+                                 best.astype(np.min_scalar_type(max(table.shape[axis] - 1, 0)))))
+            factors.append((remainingVariables, np.take_along_axis(table, np.expand_dims(best, axis), axis).squeeze(axis)))
+        else:
+            factors.append((remainingVariables, bn.logSumExp(table, axis=axis)))
+
+    if sum([float(table) for _, table in factors]) == -np.inf:
+        return None
+    domainsDict = bayesNet.variableDomainsDict()
+    indices = {}
+    for variable, remainingVariables, best in reversed(backpointers):
+        indices[variable] = int(best[tuple([indices[var] for var in remainingVariables])])
+    return dict([(variable, domainsDict[variable][index]) for variable, index in indices.items()])
+
+def _broadcastTable(variables, table, outputVariables):
+    " table, whose axes are variables, with its axes reordered and expanded to broadcast over outputVariables "
+    table = np.transpose(table, [variables.index(variable) for variable in outputVariables if variable in variables])
+    lengths = iter(table.shape)
+    return table.reshape([next(lengths) if variable in variables else 1 for variable in outputVariables])
+
+
+class FactorSampler:
+    """
+    Samples assignments from factors, caching the cumulative probability
+    table of every (factor, conditioned assignment) it has sampled from,
+    so that later draws from the same row of the same factor only cost a
+    binary search.
+
+    Tables are cached by Factor.tableVersion, so copies of a factor (such
+    as the ones BayesNet.getCPT returns) share their cached tables, and a
+    factor that is modified gets new ones.  At most maxCacheSize tables
+    are kept, evicting the least recently used one.
+    """
+
+    def __init__(self, randomSource=None, maxCacheSize: int = 1024):
+        if randomSource is None:
+            randomSource = random.Random()
+        if maxCacheSize <= 0:
+            raise ValueError("A factor sampler must cache at least one table, got maxCacheSize: " + str(maxCacheSize))
+        self.randomSource = randomSource
+        self.maxCacheSize = maxCacheSize
+        self.__tables = OrderedDict()
+
+    def __len__(self):
+        " The number of cumulative tables cached "
+        return len(self.__tables)
+
+    def clearCache(self):
+        " Forgets the cumulative tables of every factor sampled from so far "
+        self.__tables = OrderedDict()
+
+    def __call__(self, factor, conditionedAssignments=None):
+        return self.sample(factor, conditionedAssignments)
+
+    def sample(self, factor, conditionedAssignments=None):
         """
         Sample an assignment for unconditioned variables in factor with
         probability equal to the probability in the row of factor
@@ -231,71 +721,371 @@ def sampleFromFactorRandomSource(randomSource=None):
 
         Useful for inferenceByLikelihoodWeightingSampling
 
-        Returns an assignmentDict that contains the conditionedAssignments but 
-        also a random assignment of the unconditioned variables given their 
-        probability.
+        Returns an assignmentDict that contains the assignments of the
+        conditioned variables of factor but also a random assignment of
+        the unconditioned variables given their probability.
         """
-        if conditionedAssignments is None and len(factor.conditionedVariables()) > 0:
+        return self.sampleMany(factor, 1, conditionedAssignments)[0]
+
+    def sampleMany(self, factor, numSamples: int, conditionedAssignments=None):
+        " Returns a list of numSamples independent draws of sample(factor, conditionedAssignments) "
+        conditionedValues, cumulative, unconditionedVariables, domains = \
+            self.__cumulativeTable(factor, conditionedAssignments)
+        total = cumulative[-1]
+        lastIndex = len(cumulative) - 1
+        samples = []
+        for _ in range(numSamples):
+            # the first row whose cumulative probability exceeds the pick
+            index = min(bisect.bisect_right(cumulative, self.randomSource.random() * total), lastIndex)
+            assignmentDict = dict(conditionedValues)
+            for variable, domain in zip(reversed(unconditionedVariables), reversed(domains)):
+                index, valueIndex = divmod(index, len(domain))
+                assignmentDict[variable] = domain[valueIndex]
+            samples.append(assignmentDict)
+        return samples
+
+    def __cumulativeTable(self, factor, conditionedAssignments):
+        """
+        Returns the assignments of the conditioned variables of factor,
+        the cumulative probabilities of the rows of factor with those
+        assignments (in row-major order of the unconditioned variables),
+        and the unconditioned variables and their domains.
+        """
+        conditionedVariables = sorted(factor.conditionedVariables())
+        if conditionedAssignments is None and len(conditionedVariables) > 0:
             raise ValueError("Conditioned assignments must be provided since \n" +
                             "this factor has conditionedVariables: " + "\n" +
                             str(factor.conditionedVariables()))
+        elif conditionedAssignments is not None and \
+                not set(conditionedAssignments.keys()).issuperset(set(conditionedVariables)):
+            raise ValueError("Factor's conditioned variables need to be a subset of the \n"
+                                + "conditioned assignments passed in. \n" + \
+                            "conditionedVariables: " + str(set(conditionedAssignments.keys())) + "\n" +
+                            "factor.conditionedVariables: " + str(set(conditionedVariables)))
+
+        conditionedValues = tuple([(var, conditionedAssignments[var]) for var in conditionedVariables])
+        key = (factor.tableVersion(), conditionedValues)
+        entry = self.__tables.get(key)
+        if entry is not None:
+            self.__tables.move_to_end(key)
+        else:
+            arrayFactor = bn.ArrayFactor.fromFactor(factor)
+            domainsDict = arrayFactor.variableDomainsDict()
+            indices = tuple([domainsDict.valueIndices(var)[conditionedAssignments[var]]
+                             if var in factor.conditionedVariables() else slice(None)
+                             for var in arrayFactor.variables()])
+            unconditionedVariables = [var for var in arrayFactor.variables()
+                                      if var not in factor.conditionedVariables()]
+            domains = [domainsDict[var] for var in unconditionedVariables]
+            cumulative = np.cumsum(arrayFactor.asArray()[indices].ravel()).tolist()
+            entry = (dict(conditionedValues), cumulative, unconditionedVariables, domains)
+            self.__tables[key] = entry
+            if len(self.__tables) > self.maxCacheSize:
+                self.__tables.popitem(last=False)
+        return entry
 
-        elif conditionedAssignments is not None:
-            conditionedVariables = set([var for var in conditionedAssignments.keys()])
+def sampleFromFactorRandomSource(randomSource=None):
+    """
+    Returns a FactorSampler drawing from randomSource: calling it samples
+    one assignment, and its sampleMany method draws many at once.
+    """
+    return FactorSampler(randomSource)
 
-            if not conditionedVariables.issuperset(set(factor.conditionedVariables())):
-                raise ValueError("Factor's conditioned variables need to be a subset of the \n"
-                                    + "conditioned assignments passed in. \n" + \
-                                "conditionedVariables: " + str(conditionedVariables) + "\n" +
-                                "factor.conditionedVariables: " + str(set(factor.conditionedVariables())))
+sampleFromFactor = sampleFromFactorRandomSource()
 
-            # Reduce the domains of the variables that have been
-            # conditioned upon for this factor 
-            newVariableDomainsDict = factor.variableDomainsDict()
-            for (var, assignment) in conditionedAssignments.items():
-                newVariableDomainsDict[var] = [assignment]
+def _numpyGenerator(randomSource):
+    """
+    Returns a numpy.random.Generator for randomSource: a Generator is
+    used as it is, a random.Random seeds a new Generator (so a seeded
+    random.Random gives reproducible samples), and None gives a freshly
+    seeded Generator.
+    """
+    if randomSource is None:
+        return np.random.default_rng()
+    if isinstance(randomSource, np.random.Generator):
+        return randomSource
+    return np.random.default_rng(randomSource.getrandbits(64))
 
-            # Get the (hopefully) smaller conditional probability table
-            # for this variable 
-            CPT = factor.specializeVariableDomains(newVariableDomainsDict)
+def _CPTRows(CPT, variable, parents):
+    """
+    Returns the CPT of variable as a 2d table with one row per
+    assignment of parents (in row-major order of their domain indices)
+    and one column per value of variable.
+    """
+    factorVariables = list(CPT.variables())
+    table = np.transpose(CPT.asArray(), [factorVariables.index(parent) for parent in parents] +
+                         [factorVariables.index(variable)])
+    return table.reshape(-1, table.shape[-1])
+
+def _cumulativeCPTTable(CPT, variable, parents):
+    " Returns the rows of _CPTRows as cumulativeRows "
+    return cumulativeRows(_CPTRows(CPT, variable, parents))
+
+def cumulativeRows(table):
+    """
+    Returns the rows of a 2d table of (unnormalized) probabilities as
+    cumulative probabilities, normalized to end at 1 and shifted by the
+    row number, so that the whole table is sorted and one searchsorted
+    call samples every row (see sampleCumulativeRows).
+
+    Rows with no probability mass are treated as uniform.
+    """
+    cumulative = np.cumsum(table, axis=1)
+    totals = cumulative[:, -1:]
+    emptyRows = totals[:, 0] <= 0.0
+    cumulative[emptyRows] = np.arange(1, table.shape[1] + 1)
+    totals = np.where(totals > 0.0, totals, table.shape[1])
+    cumulative = cumulative / totals
+    cumulative[:, -1] = 1.0
+    return cumulative + np.arange(table.shape[0])[:, None]
+
+def _parentRows(samples, parents, domainsDict, numSamples):
+    " The row of the CPT selected by the sampled values of parents, for every sample "
+    if not parents:
+        return np.zeros(numSamples, dtype=np.intp)
+    return np.ravel_multi_index([samples[parent] for parent in parents],
+                                [len(domainsDict[parent]) for parent in parents])
+
+def sampleCumulativeRows(cumulative, rows, randomSource):
+    " Samples a column index from the given row of a table of cumulativeRows for every sample "
+    domainSize = cumulative.shape[1]
+    picks = np.searchsorted(cumulative.ravel(), rows + randomSource.random(len(rows)), side='right')
+    return np.minimum(picks - rows * domainSize, domainSize - 1)
+
+def inferenceByLikelihoodWeightingSamplingRandomSource(randomSource=None):
+    randomSource = _numpyGenerator(randomSource)
+
+    def inferenceByLikelihoodWeightingSampling(bayesNet: bn, queryVariables: List[str], evidenceDict: Dict,
+                                               numSamples: int, prune: bool = True):
+        """
+        Approximates the factor
+
+        P(queryVariables | evidenceDict)
+
+        with likelihood weighting: numSamples assignments are drawn, all
+        at once, variable by variable in the order of
+        bayesNet.linearizeVariables(), with the evidence variables fixed
+        to their observed values; each sample is weighted by the
+        probability of the evidence given its parents in that sample,
+        and the weights are summed per assignment of the query
+        variables.
+
+        Samples are held as one column of domain indices per variable,
+        and each CPT is turned into a table of cumulative probabilities
+        once per call, so the cost grows with numSamples only through
+        numpy operations.
+
+        bayesNet:       The Bayes Net on which we are making a query.
+        queryVariables: A list of the variables which are unconditioned
+                        in the inference query.
+        evidenceDict:   An assignment dict {variable : value} for the
+                        variables which are presented as evidence
+                        (conditioned) in the inference query.
+        numSamples:     The number of weighted samples to draw.
+        prune:          If True, the samples are drawn from the pruned
+                        bayes net from BayesNet.getPrunedBayesNet.
+
+        Returns None if every sample has weight 0.
+        """
+        if numSamples <= 0:
+            raise ValueError("numSamples must be positive, got: " + str(numSamples))
+        if prune:
+            prunedBayesNet = bayesNet.getPrunedBayesNet(queryVariables, evidenceDict.keys())
+            return _withPrunedEvidence(inferenceByLikelihoodWeightingSampling(prunedBayesNet, queryVariables,
+                                                                              evidenceDict, numSamples, prune=False),
+                                       bayesNet, queryVariables, evidenceDict)
+
+        domainsDict = bayesNet.variableDomainsDict()
+        inEdges = bayesNet.inEdges()
+        samples = {}
+        weights = np.ones(numSamples)
+        for variable in bayesNet.linearizeVariables():
+            CPT = bayesNet.getCPT(variable)
+            parents = sorted(inEdges[variable])
+            rows = _parentRows(samples, parents, domainsDict, numSamples)
+            if variable in evidenceDict:
+                value = domainsDict.valueIndices(variable)[evidenceDict[variable]]
+                weights *= _CPTRows(CPT, variable, parents)[rows, value]
+                samples[variable] = np.full(numSamples, value, dtype=np.intp)
+            else:
+                samples[variable] = sampleCumulativeRows(_cumulativeCPTTable(CPT, variable, parents), rows, randomSource)
+
+        queryVariables = sorted(queryVariables)
+        evidenceVariables = sorted(evidenceDict.keys())
+        shape = [len(domainsDict[variable]) for variable in queryVariables]
+        if queryVariables:
+            codes = np.ravel_multi_index([samples[variable] for variable in queryVariables], shape)
         else:
-            CPT = factor
-        
-        # Get the probability of each row of the table (along with the
-        # assignmentDict that it corresponds to)
-        assignmentDicts = sorted([assignmentDict for assignmentDict in CPT.getAllPossibleAssignmentDicts()])
-        assignmentDictProbabilities = [CPT.getProbability(assignmentDict) for assignmentDict in assignmentDicts]
-
-        # calculate total probability in the factor and index each row by the 
-        # cumulative sum of probability up to and including that row
-        currentProbability = 0.0
-        probabilityRange = []
-        for i in range(len(assignmentDicts)):
-            currentProbability += assignmentDictProbabilities[i]
-            probabilityRange.append(currentProbability)
-
-        totalProbability = probabilityRange[-1]
-
-        # sample an assignment with probability equal to the probability in the row 
-        # for that assignment in the factor
-        pick = randomSource.uniform(0.0, totalProbability)
-        for i in range(len(assignmentDicts)):
-            if pick <= probabilityRange[i]:
-                return assignmentDicts[i]
-
-    return sampleFromFactor
+            codes = np.zeros(numSamples, dtype=np.intp)
+        table = np.bincount(codes, weights=weights, minlength=int(np.prod(shape)))
+        table = table.reshape(shape + [1] * len(evidenceVariables))
+        return normalize(bn.ArrayFactor.fromArray(queryVariables, evidenceVariables,
+                                                  bayesNet.getReducedVariableDomains(evidenceDict), table))
 
-sampleFromFactor = sampleFromFactorRandomSource()
+    return inferenceByLikelihoodWeightingSampling
+
+inferenceByLikelihoodWeightingSampling = inferenceByLikelihoodWeightingSamplingRandomSource()
+
+def ancestralSampleDtype(bayesNet):
+    """
+    Returns the numpy structured dtype of the samples of
+    ancestralSampleChunks: one field per variable of bayesNet, in sorted
+    order, holding the index of its value in
+    bayesNet.variableDomainsDict()[variable], as the smallest unsigned
+    integer type that fits.
+    """
+    domainsDict = bayesNet.variableDomainsDict()
+    return np.dtype([(variable, np.min_scalar_type(max(len(domainsDict[variable]) - 1, 0)))
+                     for variable in sorted(bayesNet.variablesSet())])
+
+def ancestralSampleChunks(bayesNet: bn, numSamples: int, randomSource=None, chunkSize: int = 1 << 16):
+    """
+    Draws numSamples joint samples from the prior of bayesNet, and yields
+    them as structured arrays (see ancestralSampleDtype) of at most
+    chunkSize samples each.
+
+    Every variable is sampled for a whole chunk at once, in the order of
+    bayesNet.linearizeVariables(), from the row of its CPT selected by
+    the values of its parents.  The cumulative CPT tables are built once
+    and shared by every chunk, so memory only grows with chunkSize.
+
+    randomSource is a numpy.random.Generator, or a random.Random that
+    seeds one.
+    """
+    if numSamples < 0 or chunkSize <= 0:
+        raise ValueError("numSamples must be non-negative and chunkSize positive, got: " + \
+                         str((numSamples, chunkSize)))
+    randomSource = _numpyGenerator(randomSource)
+    domainsDict = bayesNet.variableDomainsDict()
+    inEdges = bayesNet.inEdges()
+    dtype = ancestralSampleDtype(bayesNet)
+    steps = []
+    for variable in bayesNet.linearizeVariables():
+        parents = sorted(inEdges[variable])
+        steps.append((variable, parents, _cumulativeCPTTable(bayesNet.getCPT(variable), variable, parents)))
+
+    for start in range(0, numSamples, chunkSize):
+        chunkLength = min(chunkSize, numSamples - start)
+        samples = {}
+        chunk = np.empty(chunkLength, dtype=dtype)
+        for variable, parents, cumulative in steps:
+            samples[variable] = sampleCumulativeRows(cumulative, _parentRows(samples, parents, domainsDict, chunkLength),
+                                            randomSource)
+            chunk[variable] = samples[variable]
+        yield chunk
+
+def ancestralSamples(bayesNet: bn, numSamples: int, randomSource=None, chunkSize: int = 1 << 16):
+    " Returns numSamples joint samples from the prior of bayesNet as one structured array (see ancestralSampleChunks) "
+    samples = np.empty(numSamples, dtype=ancestralSampleDtype(bayesNet))
+    start = 0
+    for chunk in ancestralSampleChunks(bayesNet, numSamples, randomSource, chunkSize):
+        samples[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    return samples
+
+def writeAncestralSamples(bayesNet: bn, numSamples: int, path: str, randomSource=None, chunkSize: int = 1 << 16):
+    """
+    Writes numSamples joint samples from the prior of bayesNet to the .npy
+    file at path, one chunk at a time through a memory map, so only one
+    chunk is held in memory.  Returns the memory-mapped array (load it
+    later with numpy.load(path, mmap_mode='r')).
+    """
+    samples = np.lib.format.open_memmap(path, mode='w+', dtype=ancestralSampleDtype(bayesNet), shape=(numSamples,))
+    start = 0
+    for chunk in ancestralSampleChunks(bayesNet, numSamples, randomSource, chunkSize):
+        samples[start:start + len(chunk)] = chunk
+        samples.flush()
+        start += len(chunk)
+    return samples
+
+RESAMPLING_METHODS = ('systematic', 'stratified', 'multinomial')
+
+def _uniforms(rng, n):
+    " n uniform draws from [0, 1), from rng (a random.Random or numpy.random.Generator) or the random module "
+    if isinstance(rng, np.random.Generator):
+        return rng.random(n)
+    randomSource = random if rng is None else rng
+    return np.array([randomSource.random() for _ in range(n)], dtype=np.float64)
+
+def _picksBelow(scaledCumulative, n, method, rng):
+    """
+    For cumulative weights scaled so that they total n, returns how many of
+    the n picks of systematic or stratified resampling fall below each of
+    them.  Pick j lies in [j, j + 1), so this is worked out from the offsets
+    of the picks without searching for them: O(1) per weight.
+    """
+    if method == 'systematic':
+        picks = np.clip(np.ceil(scaledCumulative - _uniforms(rng, 1)[0]), 0, n).astype(np.intp)
+    else:
+        offsets = _uniforms(rng, n)
+        whole = np.minimum(np.floor(scaledCumulative).astype(np.intp), n)
+        partial = offsets[np.minimum(whole, n - 1)] < scaledCumulative - whole
+        picks = whole + ((whole < n) & partial)
+    # every pick is below the total, however the subtraction above rounds
+    picks[-1] = n
+    return picks
 
 class DiscreteDistribution(dict):
     """
     A DiscreteDistribution models belief distributions and weight distributions
     over a finite set of discrete keys.
+
+    total, argMax and entropy are computed once and cached until the
+    distribution is modified, so reading them repeatedly is O(1).
+    Modifications through dict methods called on the dict class directly
+    (dict.__setitem__(dist, ...)) bypass this and must not be used.
     """
+    # the cached aggregates by name, or None once the distribution is modified
+    __aggregates = None
+
     def __getitem__(self, key):
         self.setdefault(key, 0)
         return dict.__getitem__(self, key)
 
+    def __modified(self):
+        self.__aggregates = None
+
+    def __cached(self, name, compute):
+        " The cached aggregate called name, computed with compute() if the cache is missing it "
+        if self.__aggregates is None:
+            self.__aggregates = {}
+        if name not in self.__aggregates:
+            self.__aggregates[name] = compute()
+        return self.__aggregates[name]
+
+    def __setitem__(self, key, value):
+        self.__modified()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.__modified()
+        dict.__delitem__(self, key)
+
+    def __ior__(self, other):
+        self.__modified()
+        return dict.__ior__(self, other)
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self.__modified()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.__modified()
+        dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self.__modified()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.__modified()
+        return dict.popitem(self)
+
+    def clear(self):
+        self.__modified()
+        dict.clear(self)
+
     def copy(self):
         """
         Return a copy of the distribution.
@@ -306,6 +1096,9 @@ class DiscreteDistribution(dict):
         """
         Return the key with the highest value.
         """
+        return self.__cached('argMax', self.__computeArgMax)
+
+    def __computeArgMax(self):
         if len(self.keys()) == 0:
             return None
         all = list(self.items())
@@ -317,7 +1110,21 @@ class DiscreteDistribution(dict):
         """
         Return the sum of values for all keys.
         """
-        return float(sum(self.values()))
+        return self.__cached('total', lambda: float(sum(self.values())))
+
+    def entropy(self):
+        """
+        Return the entropy, in nats, of the distribution the values give once
+        normalized (0.0 if the total value is 0).
+        """
+        return self.__cached('entropy', self.__computeEntropy)
+
+    def __computeEntropy(self):
+        total = self.total()
+        if total <= 0:
+            return 0.0
+        probabilities = [value / total for value in self.values() if value > 0]
+        return float(sum([p * math.log(1.0 / p) for p in probabilities]))
     
 
     def normalize(self):
@@ -350,18 +1157,25 @@ class DiscreteDistribution(dict):
 
         # Normalize the values if the sum is not zero.
         if sum_values != 0:
-            for key in dict_keys:
+            # scaling every value keeps the arg max and the entropy
+            scaleInvariant = dict([(name, value) for (name, value) in (self.__aggregates or {}).items()
+                                   if name in ('argMax', 'entropy')])
+            for key in list(dict_keys):
                 self[key] /= sum_values
+            self.__aggregates = scaleInvariant
         # If the sum is zero, normalization cannot be performed.
         else:
             return
 
 
-    def sample(self):
+    def sample(self, n: int = None, rng=None):
         """
         Draw a random sample from the distribution and return the key, weighted
         by the values associated with each key.
 
+        If n is given, return a list of n independent samples instead, drawn
+        with resample(n, 'multinomial', rng).
+
         >>> dist = DiscreteDistribution()
         >>> dist['a'] = 1
         >>> dist['b'] = 2
@@ -379,6 +1193,8 @@ class DiscreteDistribution(dict):
         0.0
         """
         "*** YOUR CODE HERE ***"
+        if n is not None:
+            return self.resample(n, 'multinomial', rng)
         if self.total() != 1:
             self.normalize()
         singleSample = random.random()
@@ -389,6 +1205,437 @@ class DiscreteDistribution(dict):
             singleSample -= self[key]
         "*** END YOUR CODE HERE ***"
 
+    def resample(self, n: int, method: str = 'systematic', rng=None):
+        """
+        Draw n keys with probability proportional to their values, and return
+        them as a list.  The cumulative weights are built once and all the
+        draws are placed on them together, instead of a scan of the keys per
+        draw: for k keys this costs O(n + k) for systematic and stratified
+        draws, whose picks are in order so each key's count follows from
+        its cumulative weight, and O(n log k) for multinomial ones.  The
+        distribution itself is not modified.
+
+        method is one of
+        multinomial: n independent draws
+        stratified:  one draw in each of the n equal slices of [0, 1)
+        systematic:  one shared offset, repeated at steps of 1/n
+
+        Stratified and systematic draws still pick each key
+        value/total * n times in expectation, but with less variance.
+
+        rng is a random.Random or numpy.random.Generator to draw with;
+        if None the random module is used (so random.seed applies).
+
+        >>> dist = DiscreteDistribution()
+        >>> dist['a'] = 1
+        >>> dist['b'] = 3
+        >>> sorted(dist.resample(4))
+        ['a', 'b', 'b', 'b']
+        """
+        if method not in RESAMPLING_METHODS:
+            raise ValueError("Unknown resampling method: " + str(method) + \
+                             ", expected one of " + str(RESAMPLING_METHODS))
+        keys, weights = self._keysAndWeights()
+        cumulative = np.cumsum(weights)
+        total = cumulative[-1] if len(cumulative) else 0.0
+        if n > 0 and not total > 0:
+            raise ValueError("Can't sample from a distribution whose total weight is: " + str(total))
+        if n <= 0:
+            return []
+        if method == 'multinomial':
+            indices = np.minimum(np.searchsorted(cumulative, _uniforms(rng, n) * total, side='right'), len(keys) - 1)
+        else:
+            scaledCumulative = cumulative * (n / total)
+            # rounding can leave the last value just below n, which would drop a pick
+            scaledCumulative[-1] = n
+            counts = np.diff(_picksBelow(scaledCumulative, n, method, rng), prepend=0)
+            indices = np.repeat(np.arange(len(keys)), counts)
+        return [keys[i] for i in indices]
+
+    def _keysAndWeights(self):
+        " The keys of the distribution as a list, and their values as a float64 array "
+        keys = list(self.keys())
+        return keys, np.array([self[key] for key in keys], dtype=np.float64)
+
+
+# the position indices of positionIndexFor, one per list of positions
+_positionIndices = {}
+
+class PositionIndex:
+    """
+    Numbers a fixed list of positions (the legal positions of a layout
+    and the jail), so that a distribution over them can be stored as a
+    vector: position i of positions has id i.
+    """
+    def __init__(self, positions):
+        self.positions = tuple(positions)
+        self.ids = dict([(position, i) for i, position in enumerate(self.positions)])
+        if len(self.ids) != len(self.positions):
+            raise ValueError("Positions can't be repeated in a position index: " + str(positions))
+        self.coordinates = np.array(self.positions, dtype=np.intp).reshape(len(self.positions), 2)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, position):
+        return position in self.ids
+
+    def idOf(self, position):
+        " The id of position "
+        return self.ids[position]
+
+    def positionOf(self, positionId):
+        " The position with id positionId "
+        return self.positions[positionId]
+
+def positionIndexFor(positions):
+    """
+    Returns the PositionIndex of positions, built once for every list of
+    positions (so once per layout for InferenceModule.allPositions).
+    """
+    key = tuple(positions)
+    if key not in _positionIndices:
+        _positionIndices[key] = PositionIndex(key)
+    return _positionIndices[key]
+
+class PositionDistribution(DiscreteDistribution):
+    """
+    A DiscreteDistribution over the positions of a PositionIndex, stored
+    as a float64 vector with one entry per position id instead of a dict
+    entry per position.
+
+    It reads like a DiscreteDistribution whose keys are all the positions
+    of the index (positions without weight have value 0), so code written
+    for dict-based distributions keeps working.  Keys outside the index
+    are kept in the dict itself; reading one that was never set (such as
+    the walls the display looks up) gives 0 without adding it.  Every
+    dict method that writes goes to the vector for the positions of the
+    index, and since those positions can't stop being keys, deleting or
+    popping one sets its value to 0.
+    asArray gives the vector, for vectorised updates; since the vector
+    can be changed directly, total, argMax and entropy are not cached but
+    computed with numpy on every call.
+    """
+    def __init__(self, positionIndex: PositionIndex, weights=None):
+        DiscreteDistribution.__init__(self)
+        self.positionIndex = positionIndex
+        if weights is None:
+            weights = np.zeros(len(positionIndex))
+        self.__weights = np.asarray(weights, dtype=np.float64)
+        if self.__weights.shape != (len(positionIndex),):
+            raise ValueError("Expected one weight per position of the index, got shape: " + \
+                             str(self.__weights.shape))
+
+    def asArray(self):
+        """
+        Returns the vector of weights, indexed by position id.  This is the
+        vector the distribution reads from, so modifying it changes the
+        distribution.
+        """
+        return self.__weights
+
+    def __getitem__(self, key):
+        positionId = self.positionIndex.ids.get(key)
+        if positionId is None:
+            return dict.get(self, key, 0)
+        return float(self.__weights[positionId])
+
+    def __setitem__(self, key, value):
+        positionId = self.positionIndex.ids.get(key)
+        if positionId is None:
+            dict.__setitem__(self, key, value)
+        else:
+            self.__weights[positionId] = value
+
+    def __delitem__(self, key):
+        positionId = self.positionIndex.ids.get(key)
+        if positionId is None:
+            dict.__delitem__(self, key)
+        else:
+            self.__weights[positionId] = 0.0
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        distribution = self.copy()
+        distribution.update(other)
+        return distribution
+
+    def setdefault(self, key, default=None):
+        if key in self.positionIndex.ids:
+            return self[key]
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        if len(args) > 1:
+            raise TypeError("update expected at most 1 argument, got " + str(len(args)))
+        other = args[0] if args else ()
+        if isinstance(other, Mapping):
+            other = other.items()
+        elif hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for key, value in itertools.chain(other, kwargs.items()):
+            self[key] = value
+
+    def pop(self, key, *default):
+        positionId = self.positionIndex.ids.get(key)
+        if positionId is None:
+            return dict.pop(self, key, *default)
+        value = float(self.__weights[positionId])
+        self.__weights[positionId] = 0.0
+        return value
+
+    def popitem(self):
+        """
+        Removes and returns a (key, value) pair: the last key outside the
+        index if there is one, and otherwise the last position with a
+        non-zero value (which is set to 0).
+        """
+        if dict.__len__(self) > 0:
+            return dict.popitem(self)
+        nonZero = np.flatnonzero(self.__weights)
+        if len(nonZero) == 0:
+            raise KeyError("popitem(): every value of the distribution is 0")
+        key = self.positionIndex.positionOf(int(nonZero[-1]))
+        return key, self.pop(key)
+
+    def clear(self):
+        self.__weights[:] = 0.0
+        dict.clear(self)
+
+    def __contains__(self, key):
+        return key in self.positionIndex.ids or dict.__contains__(self, key)
+
+    def __iter__(self):
+        yield from self.positionIndex.positions
+        yield from dict.__iter__(self)
+
+    def __len__(self):
+        return len(self.positionIndex) + dict.__len__(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        return (PositionDistribution, (self.positionIndex, self.__weights.copy()), None, None,
+                iter(dict.items(self)))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def copy(self):
+        """
+        Return a copy of the distribution.
+        """
+        distribution = PositionDistribution(self.positionIndex, self.__weights.copy())
+        dict.update(distribution, dict.items(self))
+        return distribution
+
+    def argMax(self):
+        """
+        Return the key with the highest value.
+        """
+        if len(self) == 0:
+            return None
+        best = None
+        if len(self.__weights) > 0:
+            best = self.positionIndex.positionOf(int(np.argmax(self.__weights)))
+        for key, value in dict.items(self):
+            if best is None or value > self[best]:
+                best = key
+        return best
+
+    def total(self):
+        """
+        Return the sum of values for all keys.
+        """
+        return float(self.__weights.sum()) + self.outsideIndexTotal()
+
+    def outsideIndexTotal(self):
+        " Return the sum of values for the keys outside the index "
+        return float(sum(dict.values(self)))
+
+    def entropy(self):
+        """
+        Return the entropy, in nats, of the distribution the values give once
+        normalized (0.0 if the total value is 0).
+        """
+        _, weights = self._keysAndWeights()
+        total = weights.sum()
+        if total <= 0:
+            return 0.0
+        probabilities = weights[weights > 0] / total
+        return float((probabilities * np.log(1.0 / probabilities)).sum())
+
+    def normalize(self):
+        """
+        Normalize the distribution such that the total value of all keys sums
+        to 1.  In the case where the total value of the distribution is 0, do
+        nothing.
+        """
+        total = self.total()
+        if total != 0:
+            self.__weights /= total
+            for key in list(dict.keys(self)):
+                dict.__setitem__(self, key, dict.__getitem__(self, key) / total)
+
+    def _keysAndWeights(self):
+        if dict.__len__(self) == 0:
+            return self.positionIndex.positions, self.__weights
+        return (list(self.positionIndex.positions) + list(dict.keys(self)),
+                np.concatenate([self.__weights, np.array(list(dict.values(self)), dtype=np.float64)]))
+
+    def sample(self, n: int = None, rng=None):
+        """
+        Draw a random sample from the distribution and return the key, weighted
+        by the values associated with each key (or a list of n samples, as in
+        DiscreteDistribution.sample).
+        """
+        if n is not None:
+            return self.resample(n, 'multinomial', rng)
+        if self.total() != 1:
+            self.normalize()
+        singleSample = random.random()
+        cumulative = np.cumsum(self.__weights)
+        positionId = int(np.searchsorted(cumulative, singleSample, side='left'))
+        if positionId < len(cumulative):
+            return self.positionIndex.positionOf(positionId)
+        singleSample -= cumulative[-1] if len(cumulative) else 0.0
+        for key, value in dict.items(self):
+            if singleSample <= value:
+                return key
+            singleSample -= value
+
+
+class AliasSampler:
+    """
+    Draws keys of a distribution with probability proportional to their
+    values in O(1) per draw, with Vose's alias method: every key gets a
+    slot with a threshold and an alias, and a draw picks a slot and keeps
+    its key or takes its alias, from a single random number.
+
+    The sampler is a snapshot: it does not follow later changes to the
+    distribution it was built from.
+    """
+    def __init__(self, distribution):
+        """
+        distribution: A DiscreteDistribution (or any dict of key : value)
+                      with a positive total value.
+        """
+        self.keys = [key for key, value in distribution.items() if value > 0]
+        values = [distribution[key] for key in self.keys]
+        total = float(sum(values))
+        if not total > 0:
+            raise ValueError("Can't build an alias sampler for a distribution whose total weight is: " + str(total))
+
+        numKeys = len(self.keys)
+        scaled = [value * numKeys / total for value in values]
+        self.thresholds = [1.0] * numKeys
+        self.aliases = list(range(numKeys))
+        small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            lesser, greater = small.pop(), large.pop()
+            self.thresholds[lesser] = scaled[lesser]
+            self.aliases[lesser] = greater
+            scaled[greater] -= 1.0 - scaled[lesser]
+            (small if scaled[greater] < 1.0 else large).append(greater)
+        # what is left over is only off 1.0 by rounding, and keeps its own key
+
+    def sample(self, rng=None):
+        """
+        Draw a key, using one random number from rng (a random.Random or
+        numpy.random.Generator) or from the random module if rng is None.
+        """
+        pick = (random.random() if rng is None else rng.random()) * len(self.keys)
+        slot = min(int(pick), len(self.keys) - 1)
+        if pick - slot < self.thresholds[slot]:
+            return self.keys[slot]
+        return self.keys[self.aliases[slot]]
+
+    def sampleMany(self, n: int, rng=None):
+        " Draw a list of n independent keys, as sample(rng) does one "
+        picks = _uniforms(rng, n) * len(self.keys)
+        slots = np.minimum(picks.astype(np.intp), len(self.keys) - 1)
+        chosen = np.where(picks - slots < np.asarray(self.thresholds)[slots], slots, np.asarray(self.aliases)[slots])
+        return [self.keys[i] for i in chosen]
+
+
+class TransitionMatrix:
+    """
+    The transition model of a ghost for one Pacman position, as a sparse
+    matrix over a PositionIndex in compressed sparse row (CSR) form: the
+    entries of row i, for the ghost at the position with id i, are
+    columnIds[rowPointers[i]:rowPointers[i + 1]] (the ids of the positions
+    it can move to) with their probabilities.
+    """
+    def __init__(self, positionIndex: PositionIndex, rowPointers, columnIds, probabilities):
+        self.positionIndex = positionIndex
+        self.rowPointers = np.asarray(rowPointers, dtype=np.intp)
+        self.columnIds = np.asarray(columnIds, dtype=np.intp)
+        self.probabilities = np.asarray(probabilities, dtype=np.float64)
+        self.rowLengths = np.diff(self.rowPointers)
+
+    @classmethod
+    def fromRows(cls, positionIndex: PositionIndex, rows):
+        """
+        Builds the matrix from rows, one dict {position : probability} per
+        position id.  Returns None if a row has a position outside
+        positionIndex.
+        """
+        rowPointers = [0]
+        columnIds = []
+        probabilities = []
+        for row in rows:
+            for position, probability in row.items():
+                if position not in positionIndex:
+                    return None
+                columnIds.append(positionIndex.idOf(position))
+                probabilities.append(probability)
+            rowPointers.append(len(columnIds))
+        return cls(positionIndex, rowPointers, columnIds, probabilities)
+
+    def propagate(self, weights):
+        """
+        Returns the vector of weights after one transition: entry j is the
+        sum over i of weights[i] times the probability of moving from
+        position id i to position id j (the product of the transposed
+        matrix with weights).
+        """
+        rowWeights = np.repeat(np.asarray(weights, dtype=np.float64), self.rowLengths)
+        return np.bincount(self.columnIds, weights=rowWeights * self.probabilities,
+                           minlength=len(self.positionIndex))
+
+class TransitionMatrixCache(LRUCache):
+    """
+    Keeps the TransitionMatrix built for each key (a Pacman position),
+    evicting the least recently used one once it holds more than maxSize.
+    """
+    def __init__(self, maxSize: int = 256):
+        LRUCache.__init__(self, maxSize)
+
 
 class InferenceModule:
     """
@@ -513,6 +1760,9 @@ class InferenceModule:
         """
         self.legalPositions = [p for p in gameState.getWalls().asList(False) if p[1] > 1]
         self.allPositions = self.legalPositions + [self.getJailPosition()]
+        self.positionIndex = positionIndexFor(self.allPositions)
+        # the transitions of a new layout can't reuse the cached ones
+        self.transitionSamplers = LRUCache(MAX_TRANSITION_SAMPLERS)
         self.initializeUniformly(gameState)
 
     #########################
@@ -550,16 +1800,22 @@ class ExactInference(InferenceModule):
     """
     The exact dynamic inference module should use forward algorithm updates to
     compute the exact belief function at each time step.
+
+    The beliefs are kept as probabilities, not in log space like a
+    bayesNet.LogFactor: every update normalizes them, so no product
+    builds up over the time steps.  One update multiplies each belief by
+    a single probability, so the total can't underflow to 0 either; it
+    is only 0 when the observation is impossible at every position.
     """
     def initializeUniformly(self, gameState):
         """
         Begin with a uniform distribution over legal ghost positions (i.e., not
         including the jail position).
         """
-        self.beliefs = DiscreteDistribution()
-        for p in self.legalPositions:
-            self.beliefs[p] = 1.0
+        self.beliefs = PositionDistribution(self.positionIndex)
+        self.beliefs.asArray()[[self.positionIndex.idOf(p) for p in self.legalPositions]] = 1.0
         self.beliefs.normalize()
+        self.transitionMatrices = TransitionMatrixCache()
     
 
 
@@ -578,12 +1834,33 @@ class ExactInference(InferenceModule):
         current position. However, this is not a problem, as Pacman's current
         position is known.
         """
-        ghostPositions = self.allPositions
-        for pos in ghostPositions:
-            pacPosition = gameState.getPacmanPosition()
-            jailPosition = self.getJailPosition()
-            self.beliefs[pos] *= self.getObservationProb(observation, pacPosition, pos, jailPosition)
+        self.beliefs.asArray()[:] *= self.observationProbs(observation, gameState)
         self.beliefs.normalize()
+
+    def observationProbs(self, observation: int, gameState: busters.GameState):
+        """
+        Returns the vector of getObservationProb(observation, pacmanPosition,
+        position, jailPosition) for every position of self.positionIndex.
+
+        The probability only depends on the distance between Pacman and the
+        position (and on whether it is the jail), so getObservationProb is
+        called once per distance rather than once per position.
+        """
+        pacPosition = gameState.getPacmanPosition()
+        jailPosition = self.getJailPosition()
+        coordinates = self.positionIndex.coordinates
+        distances = np.abs(coordinates - np.array(pacPosition, dtype=np.intp)).sum(axis=1)
+        probs = np.empty(len(self.positionIndex))
+        for distance in np.unique(distances):
+            atDistance = np.flatnonzero(distances == distance)
+            position = self.positionIndex.positionOf(int(atDistance[0]))
+            if position == jailPosition:
+                position = self.positionIndex.positionOf(int(atDistance[-1]))
+            probs[atDistance] = self.getObservationProb(observation, pacPosition, position, jailPosition)
+        if jailPosition in self.positionIndex:
+            probs[self.positionIndex.idOf(jailPosition)] = \
+                self.getObservationProb(observation, pacPosition, jailPosition, jailPosition)
+        return probs
     
 
     def elapseTime(self, gameState: busters.GameState):
@@ -595,19 +1872,44 @@ class ExactInference(InferenceModule):
         Pacman's current position. However, this is not a problem, as Pacman's
         current position is known.
         """
-        beliefClone = DiscreteDistribution()
-        currPos = self.allPositions
-        for curPos in currPos:
-            newPosDist = self.getPositionDistribution(gameState, curPos)
+        # the ghost's moves only depend on its and Pacman's positions, so the
+        # transition matrix of a Pacman position is built once and reused
+        pacmanPosition = gameState.getPacmanPosition()
+        matrix = self.transitionMatrices.get(pacmanPosition, lambda: self.transitionMatrix(gameState))
+        if matrix is not None and self.beliefs.outsideIndexTotal() == 0:
+            self.beliefs = PositionDistribution(self.positionIndex, matrix.propagate(self.beliefs.asArray()))
+            self.beliefs.normalize()
+            return
+
+        # the beliefs or the moves reach positions outside the index
+        beliefClone = PositionDistribution(self.positionIndex)
+        weights = self.beliefs.asArray()
+        # positions without belief contribute nothing, so their successors aren't computed
+        for curId in np.flatnonzero(weights):
+            newPosDist = self.getPositionDistribution(gameState, self.positionIndex.positionOf(int(curId)))
             for nextPos, prob in newPosDist.items():
-                beliefClone[nextPos] += self.beliefs[curPos] * prob
+                beliefClone[nextPos] += weights[curId] * prob
         self.beliefs = beliefClone
         self.beliefs.normalize()
 
+    def transitionMatrix(self, gameState: busters.GameState):
+        """
+        Returns the TransitionMatrix of getPositionDistribution from every
+        position of self.positionIndex, for Pacman's position in gameState
+        (or None if the ghost can move outside the index).
+        """
+        return TransitionMatrix.fromRows(self.positionIndex,
+                                         [self.getPositionDistribution(gameState, position)
+                                          for position in self.positionIndex.positions])
+
     def getBeliefDistribution(self):
         return self.beliefs
 
 
+# the transition samplers a ParticleFilter keeps; one step needs at most one
+# per particle, for the current Pacman position
+MAX_TRANSITION_SAMPLERS = 4096
+
 class ParticleFilter(InferenceModule):
     """
     A particle filter for approximately tracking a single ghost.
@@ -615,6 +1917,7 @@ class ParticleFilter(InferenceModule):
     def __init__(self, ghostAgent, numParticles=300):
         InferenceModule.__init__(self, ghostAgent)
         self.setNumParticles(numParticles)
+        self.transitionSamplers = LRUCache(MAX_TRANSITION_SAMPLERS)
 
     def setNumParticles(self, numParticles):
         self.numParticles = numParticles
@@ -678,8 +1981,7 @@ class ParticleFilter(InferenceModule):
             discreteDist[part] += self.getObservationProb(observation, pacPos, part, jailPos)
         # When all particles receive zero weight, particles should be reinitialized by calling initializeUniformly
         if discreteDist.total() != 0:
-            discreteDist.normalize()
-            self.particles = [discreteDist.sample() for i in range(self.numParticles)]
+            self.particles = discreteDist.sample(self.numParticles)
         else:
             self.initializeUniformly(gameState)
 
@@ -691,12 +1993,23 @@ class ParticleFilter(InferenceModule):
         """
         # Initialize a list to store resampled particle positions
         particleList = []
+        pacmanPosition = gameState.getPacmanPosition()
         # Resample particles based on their position distribution
         for oldPos in self.particles:
-            # Get the position distribution for the current particle
-            newPosDist = self.getPositionDistribution(gameState, oldPos)
-            # Sample a new position from the newPosDist and add it to the new particles list
-            particleList.append(newPosDist.sample())
+            # Sample a new position from the cached sampler of the particle's transition
+            particleList.append(self.transitionSampler(gameState, oldPos, pacmanPosition).sample())
         # Update the particles with the resampled positions
         self.particles = particleList
 
+    def transitionSampler(self, gameState, ghostPosition, pacmanPosition):
+        """
+        Returns an AliasSampler of getPositionDistribution(gameState,
+        ghostPosition).  The transition only depends on the ghost's and
+        Pacman's positions and on the ghost agent, so a sampler is built
+        once for each of those and reused by every particle (and every
+        later step) with the same ones, up to MAX_TRANSITION_SAMPLERS
+        samplers (the least recently used one is dropped first).
+        """
+        return self.transitionSamplers.get((ghostPosition, pacmanPosition, self.ghostAgent),
+                                           lambda: AliasSampler(self.getPositionDistribution(gameState, ghostPosition)))
+
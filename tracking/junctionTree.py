@@ -0,0 +1,372 @@
+"""
+Junction tree (clique tree) inference.
+
+A CliqueTree is built from the structure of a bayes net alone: the
+moral graph is triangulated by eliminating the variables in a heuristic
+order, the cliques of the triangulated graph are joined into a tree, and
+each CPT is assigned to a clique that contains it.  A JunctionTree puts
+the CPTs of a bayes net on that structure and calibrates it with two
+passes of messages over the tree, after which the marginal of any
+variables that share a clique costs a sum over that clique only.
+"""
+from typing import Dict, List
+import numpy as np
+from bayesNet import ArrayFactor, normalize
+from eliminationOrdering import interactionGraph, greedyEliminationOrder
+from inference import LRUCache
+
+
+class CliqueTree:
+    """
+    The clique tree of a bayes net structure: its cliques, the tree edges
+    between them, the clique each CPT is assigned to, and the order in
+    which calibration passes messages.
+
+    Only the variables and edges of the bayes net are used, so a clique
+    tree can be shared by every bayes net with the same structure (see
+    cliqueTreeFor).
+    """
+
+    def __init__(self, bayesNet, eliminationOrder: List[str] = None):
+        """
+        bayesNet:         The Bayes Net whose structure is used.
+        eliminationOrder: The order in which the moral graph is
+                          triangulated, over all the variables.  If None,
+                          greedyEliminationOrder with min-fill is used.
+        """
+        variables = bayesNet.variablesSet()
+        if eliminationOrder is None:
+            eliminationOrder = greedyEliminationOrder(bayesNet, variables, heuristic='min-fill')
+        if set(eliminationOrder) != set(variables) or len(eliminationOrder) != len(variables):
+            raise ValueError("The elimination order must contain every variable of the bayes net once: " + \
+                             str(eliminationOrder))
+
+        # triangulate the moral graph: each variable forms a clique with its
+        # neighbors at the time it is eliminated
+        adjacency = interactionGraph(bayesNet)
+        candidates = []
+        for variable in eliminationOrder:
+            neighbors = adjacency.pop(variable)
+            candidates.append(frozenset(neighbors | {variable}))
+            for neighbor in neighbors:
+                adjacency[neighbor].discard(variable)
+                adjacency[neighbor].update(neighbors - {neighbor})
+        maximalCliques = []
+        for clique in candidates:
+            if clique not in maximalCliques and not any([clique < other for other in candidates]):
+                maximalCliques.append(clique)
+        self.cliques = [sorted(clique) for clique in maximalCliques]
+        self.cliquesWith = dict([(variable, [i for i, clique in enumerate(self.cliques) if variable in clique])
+                                 for variable in variables])
+
+        # a maximum spanning tree over the separator sizes is a junction tree
+        cliqueSets = [set(clique) for clique in self.cliques]
+        pairs = sorted([(-len(cliqueSets[i] & cliqueSets[j]), i, j)
+                        for i in range(len(self.cliques)) for j in range(i + 1, len(self.cliques))
+                        if cliqueSets[i] & cliqueSets[j]])
+        components = list(range(len(self.cliques)))
+
+        def component(i):
+            while components[i] != i:
+                components[i] = components[components[i]]
+                i = components[i]
+            return i
+
+        self.neighbors = [[] for clique in self.cliques]
+        self.separators = {}
+        for _, i, j in pairs:
+            if component(i) != component(j):
+                components[component(i)] = component(j)
+                self.neighbors[i].append(j)
+                self.neighbors[j].append(i)
+                self.separators[(i, j)] = self.separators[(j, i)] = sorted(cliqueSets[i] & cliqueSets[j])
+
+        # each CPT goes to the smallest clique containing the variable and its parents
+        inEdges = bayesNet.inEdges()
+        self.cliqueOf = {}
+        self.assignedVariables = [[] for clique in self.cliques]
+        for variable in sorted(variables):
+            family = inEdges[variable] | {variable}
+            clique = min([i for i in range(len(self.cliques)) if family <= cliqueSets[i]],
+                         key=lambda i: len(self.cliques[i]))
+            self.cliqueOf[variable] = clique
+            self.assignedVariables[clique].append(variable)
+
+        # collect towards the root of each tree of the forest, then distribute back
+        self.collectSchedule = []
+        self.roots = []
+        self.rootOf = [None] * len(self.cliques)
+        visited = set()
+        for root in range(len(self.cliques)):
+            if root in visited:
+                continue
+            visited.add(root)
+            self.roots.append(root)
+            stack = [(root, None)]
+            order = []
+            while stack:
+                clique, parent = stack.pop()
+                order.append((clique, parent))
+                self.rootOf[clique] = root
+                for neighbor in self.neighbors[clique]:
+                    if neighbor != parent:
+                        visited.add(neighbor)
+                        stack.append((neighbor, clique))
+            self.collectSchedule += [(clique, parent) for clique, parent in reversed(order) if parent is not None]
+        self.distributeSchedule = [(parent, clique) for clique, parent in reversed(self.collectSchedule)]
+
+        for clique in self.cliques:
+            if len(clique) > 52:
+                raise ValueError("einsum supports at most 52 variables in one clique, a clique has " + \
+                                 str(len(clique)) + ": " + str(clique))
+
+    def cliqueContaining(self, variables):
+        """
+        Returns the index of the smallest clique that contains all of
+        variables, or None if no clique does.
+        """
+        variables = list(variables)
+        if not variables:
+            return min(range(len(self.cliques)), key=lambda i: len(self.cliques[i])) if self.cliques else None
+        containing = set(self.cliquesWith.get(variables[0], []))
+        for variable in variables[1:]:
+            containing &= set(self.cliquesWith.get(variable, []))
+        if not containing:
+            return None
+        return min(containing, key=lambda i: len(self.cliques[i]))
+
+
+MAX_CACHED_CLIQUE_TREES = 64
+
+_cliqueTrees = LRUCache(MAX_CACHED_CLIQUE_TREES) # {bayes net structure : CliqueTree}
+
+
+def cliqueTreeFor(bayesNet):
+    """
+    Returns the CliqueTree for the structure of bayesNet, built once per
+    structure (the variables and their parents) and then reused.  The
+    trees of the MAX_CACHED_CLIQUE_TREES most recently used structures
+    are kept.
+    """
+    inEdges = bayesNet.inEdges()
+    structure = frozenset([(variable, inEdges[variable]) for variable in bayesNet.variablesSet()])
+    return _cliqueTrees.get(structure, lambda: CliqueTree(bayesNet))
+
+
+class JunctionTree:
+    """
+    The CPTs of a bayes net on its clique tree, with the evidence and the
+    messages of the last calibration.
+
+    Compiling takes a snapshot of the bayes net's CPTs, so build a new
+    junction tree after changing them.
+    """
+
+    def __init__(self, bayesNet, cliqueTree: CliqueTree = None):
+        """
+        bayesNet:   The Bayes Net on which queries will be made.
+        cliqueTree: The clique tree to use.  If None, the one from
+                    cliqueTreeFor(bayesNet) is used.
+        """
+        self.cliqueTree = cliqueTreeFor(bayesNet) if cliqueTree is None else cliqueTree
+        self.variableDomainsDict = bayesNet.variableDomainsDict()
+
+        # the potential of a clique is the product of the CPTs assigned to it
+        self.basePotentials = []
+        for clique, assignedVariables in zip(self.cliqueTree.cliques, self.cliqueTree.assignedVariables):
+            labels = dict([(variable, i) for i, variable in enumerate(clique)])
+            einsumArguments = []
+            for variable in assignedVariables:
+                CPT = ArrayFactor.fromFactor(bayesNet.getCPT(variable))
+                einsumArguments += [CPT.asArray(), [labels[var] for var in CPT.variables()]]
+            # variables of the clique that no assigned CPT mentions get a constant axis
+            covered = sorted(set().union(*[set(axisLabels) for axisLabels in einsumArguments[1::2]]))
+            potential = np.einsum(*einsumArguments, covered, optimize=True) if einsumArguments else np.ones(())
+            shape = [len(self.variableDomainsDict[variable]) for variable in clique]
+            potential = potential.reshape([shape[i] if i in covered else 1 for i in range(len(clique))])
+            self.basePotentials.append(np.broadcast_to(potential, shape))
+
+        self.evidenceDict = {}
+        self.potentials = list(self.basePotentials)
+        self.messages = {} # {(from clique, to clique) : message over their separator}
+        # whether the evidence in each tree of the forest (by root) has a non-zero probability,
+        # and the clique to check it at once it is unknown
+        self.treeHasEvidenceMass = {}
+        self.evidenceMassClique = dict([(root, root) for root in self.cliqueTree.roots])
+
+    def calibrate(self, evidenceDict: Dict = None):
+        """
+        Enters the evidence in evidenceDict (replacing any earlier
+        evidence) and passes every message of the tree: first towards
+        the root, then back out.  Returns this junction tree.
+
+        Use absorbEvidence and retractEvidence to change one evidence
+        variable of a calibrated tree.
+        """
+        evidenceDict = {} if evidenceDict is None else evidenceDict
+        for variable, value in evidenceDict.items():
+            self._evidenceIndex(variable, value)
+        self.evidenceDict = dict(evidenceDict)
+        self.potentials = [self._potentialWithEvidence(clique) for clique in range(len(self.cliqueTree.cliques))]
+        self.messages = {}
+        self.treeHasEvidenceMass = {}
+        self.evidenceMassClique = dict([(root, root) for root in self.cliqueTree.roots])
+        for sender, receiver in self.cliqueTree.collectSchedule + self.cliqueTree.distributeSchedule:
+            self.messages[(sender, receiver)] = self._computeMessage(sender, receiver)
+        return self
+
+    def absorbEvidence(self, variable: str, value):
+        """
+        Adds the evidence variable = value (replacing the value variable
+        had, if it was evidence already) without recalibrating the tree:
+        only the potential of the clique holding variable's CPT changes,
+        and the messages pointing away from it are dropped.  The next
+        query recomputes just the dropped messages on the path from that
+        clique to the queried one, so its cost depends on the length of
+        that path rather than the size of the bayes net.
+        """
+        self._evidenceIndex(variable, value)
+        self.evidenceDict[variable] = value
+        self._evidenceChanged(variable)
+
+    def retractEvidence(self, variable: str):
+        """
+        Removes the evidence on variable, updating the tree in the same
+        way as absorbEvidence.
+        """
+        if variable not in self.evidenceDict:
+            raise ValueError("Variable is not evidence: " + str(variable))
+        del self.evidenceDict[variable]
+        self._evidenceChanged(variable)
+
+    def _evidenceChanged(self, variable):
+        clique = self.cliqueTree.cliqueOf[variable]
+        self.potentials[clique] = self._potentialWithEvidence(clique)
+        # the messages into clique are all still there, so its belief is cheap to get
+        root = self.cliqueTree.rootOf[clique]
+        self.treeHasEvidenceMass.pop(root, None)
+        self.evidenceMassClique[root] = clique
+        # a message that is already missing has every message beyond it missing as well
+        # (they can only be computed from it), so the walk stops there
+        stack = [(clique, neighbor) for neighbor in self.cliqueTree.neighbors[clique]]
+        while stack:
+            sender, receiver = stack.pop()
+            if self.messages.pop((sender, receiver), None) is not None:
+                stack += [(receiver, neighbor) for neighbor in self.cliqueTree.neighbors[receiver] if neighbor != sender]
+
+    def _evidenceIndex(self, variable, value):
+        if variable not in self.cliqueTree.cliqueOf:
+            raise ValueError("Evidence variable not in the bayes net: " + str(variable))
+        try:
+            return self.variableDomainsDict.valueIndices(variable)[value]
+        except KeyError:
+            raise ValueError("Evidence value not in the variable's domain: " + \
+                             str(variable) + " = " + str(value))
+
+    def _potentialWithEvidence(self, clique):
+        " The potential of clique, with the entries that disagree with the evidence set to 0 "
+        potential = self.basePotentials[clique]
+        variables = self.cliqueTree.cliques[clique]
+        for variable in self.cliqueTree.assignedVariables[clique]:
+            if variable in self.evidenceDict:
+                axis = variables.index(variable)
+                indicator = np.zeros(potential.shape[axis])
+                indicator[self._evidenceIndex(variable, self.evidenceDict[variable])] = 1.0
+                potential = potential * indicator.reshape([-1 if i == axis else 1 for i in range(potential.ndim)])
+        return potential
+
+    def _computeMessage(self, sender, receiver):
+        """
+        The message from sender to receiver: the potential of sender times
+        the messages from its other neighbors, summed down to their
+        separator.  Messages are scaled to sum to 1, which normalizing the
+        marginals undoes, so long chains can't underflow.
+        """
+        clique = self.cliqueTree.cliques[sender]
+        labels = dict([(variable, i) for i, variable in enumerate(clique)])
+        einsumArguments = [self.potentials[sender], list(range(len(clique)))]
+        for neighbor in self.cliqueTree.neighbors[sender]:
+            if neighbor != receiver:
+                einsumArguments += [self.messages[(neighbor, sender)],
+                                    [labels[variable] for variable in self.cliqueTree.separators[(neighbor, sender)]]]
+        message = np.einsum(*einsumArguments, [labels[variable] for variable in self.cliqueTree.separators[(sender, receiver)]],
+                            optimize=len(einsumArguments) > 4)
+        total = message.sum()
+        return message / total if total > 0 else message
+
+    def _ensureMessagesInto(self, clique):
+        """
+        Computes the messages that are missing among the ones the belief
+        of clique depends on (the messages pointing towards it).
+        """
+        missing = []
+        stack = [(neighbor, clique) for neighbor in self.cliqueTree.neighbors[clique]]
+        while stack:
+            sender, receiver = stack.pop()
+            if (sender, receiver) in self.messages:
+                continue
+            missing.append((sender, receiver))
+            stack += [(neighbor, sender) for neighbor in self.cliqueTree.neighbors[sender] if neighbor != receiver]
+        for sender, receiver in reversed(missing):
+            self.messages[(sender, receiver)] = self._computeMessage(sender, receiver)
+
+    def cliqueBelief(self, clique):
+        """
+        Returns the (unnormalized) joint of the variables of clique and the
+        evidence: its potential times the messages from all its neighbors,
+        with one axis per variable in self.cliqueTree.cliques[clique].
+        """
+        self._ensureMessagesInto(clique)
+        variables = self.cliqueTree.cliques[clique]
+        labels = dict([(variable, i) for i, variable in enumerate(variables)])
+        einsumArguments = [self.potentials[clique], list(range(len(variables)))]
+        for neighbor in self.cliqueTree.neighbors[clique]:
+            einsumArguments += [self.messages[(neighbor, clique)],
+                                [labels[variable] for variable in self.cliqueTree.separators[(neighbor, clique)]]]
+        # planning the contraction order only pays off with more than two operands
+        return np.einsum(*einsumArguments, list(range(len(variables))), optimize=len(einsumArguments) > 4)
+
+    def query(self, queryVariables: List[str]):
+        """
+        Returns the factor P(queryVariables | evidence), as
+        inferenceByVariableElimination would, for query variables that
+        are all in one clique; the cost is a sum over that clique.
+        """
+        queryVariables = sorted(set(queryVariables))
+        observed = [variable for variable in queryVariables if variable in self.evidenceDict]
+        if observed:
+            raise ValueError("Query variables can't also be evidence variables: " + str(observed))
+        clique = self.cliqueTree.cliqueContaining(queryVariables)
+        if clique is None:
+            raise ValueError("The query variables are not all in one clique of the junction tree: " + \
+                             str(queryVariables) + ", use inferenceByVariableElimination instead")
+
+        # as with variable elimination, there is no answer when the evidence has probability 0,
+        # even if it is in another tree of the forest
+        for root in self.cliqueTree.roots:
+            if root not in self.treeHasEvidenceMass:
+                self.treeHasEvidenceMass[root] = self.cliqueBelief(self.evidenceMassClique[root]).any()
+            if not self.treeHasEvidenceMass[root]:
+                return None
+
+        variables = self.cliqueTree.cliques[clique]
+        table = np.einsum(self.cliqueBelief(clique), list(range(len(variables))),
+                          [variables.index(variable) for variable in queryVariables])
+        evidenceVariables = sorted(self.evidenceDict.keys())
+        reducedDomainsDict = dict([(variable, self.variableDomainsDict[variable]) for variable in queryVariables])
+        for variable in evidenceVariables:
+            reducedDomainsDict[variable] = [self.evidenceDict[variable]]
+        table = table.reshape(table.shape + (1,) * len(evidenceVariables))
+        return normalize(ArrayFactor.fromArray(queryVariables, evidenceVariables, reducedDomainsDict, table))
+
+    def marginal(self, variable: str):
+        " Returns the factor P(variable | evidence) "
+        return self.query([variable])
+
+    def marginals(self):
+        """
+        Returns a dict {variable : P(variable | evidence)} for every
+        variable that is not evidence.
+        """
+        return dict([(variable, self.marginal(variable)) for variable in sorted(self.cliqueTree.cliqueOf)
+                     if variable not in self.evidenceDict])